@@ -110,7 +110,8 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
                        Ctrees trees2=None, int start2=0, int end2=0,
                        bint approx=True, bint debug=False,
                        bint disc=False, bint complement=False,
-                       str twoterms=None, bint adjacent=False):
+                       str twoterms=None, bint adjacent=False,
+                       int minprods=1):
     """Find the largest fragments in treebank(s) with the fast tree kernel.
 
     - scenario 1: recurring fragments in single treebank, use::
@@ -132,6 +133,14 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
             one of which has a POS tag matching the given regex.
     :param adjacent: only extract fragments from sentences with adjacent
             indices.
+    :param minprods: only compare pairs of trees with at least this number
+            of distinct productions in common, as found with the production
+            index of ``trees2``. Pairs without any common production have no
+            fragments in common, so the default of 1 gives the same result
+            as comparing all pairs (which is what 0 does); higher values skip
+            pairs with little overlap and may miss fragments. Applies to the
+            pairs selected with ``twoterms`` and ``adjacent`` as well; values
+            > 1 require a production index.
     :returns: a dictionary; keys are fragments as strings; values are
             either counts (if approx=True), or bitsets describing fragments of
             ``trees1``.
@@ -148,6 +157,9 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
         dict fragments = {}
         set inter = set(), contentwordprods = None, lexicalprods = None
         list tmp = []
+        object candidates
+        bint prefilter
+        uint64_t numpairs = 0, numskipped = 0
     if twoterms:
         contentword = re.compile(twoterms)
         contentwordprods = {n for n in range(len(vocab.prods))
@@ -156,6 +168,13 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
                         if vocab.islexical(n)}
     if trees2 is None:
         trees2 = trees1
+    if minprods > 1 and trees2.prodindex is None:
+        raise ValueError('minprods > 1 requires a production index.')
+    # with minprods=1 the prefilter does not change the fragments, but the
+    # complement and debug output are defined for all pairs.
+    prefilter = minprods > 1 or (minprods == 1
+                                 and trees2.prodindex is not None
+                                 and not complement and not debug)
     SLOTS = BITNSLOTS(max(trees1.maxnodes, trees2.maxnodes) + 1)
     matrix = <uint64_t * >malloc(trees2.maxnodes * SLOTS * sizeof(uint64_t))
     scratch = <uint64_t * >malloc((SLOTS + 2) * sizeof(uint64_t))
@@ -169,12 +188,17 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
         anodes = &trees1.nodes[a.offset]
         if adjacent:
             m = n + 1
-            if m < trees2.len:
+            if m < trees2.len and (minprods <= 1 or len(sharedprods(
+                    a, anodes, trees2, m, m + 1, minprods))):
                 extractfrompair(a, anodes, trees2, n, m, complement, debug,
                                 vocab, inter, minterms, matrix, scratch, SLOTS)
         elif twoterms:
-            for m in twoterminals(a, anodes, trees2,
-                                  contentwordprods, lexicalprods):
+            candidates = twoterminals(a, anodes, trees2,
+                                      contentwordprods, lexicalprods)
+            if minprods > 1:
+                candidates &= sharedprods(a, anodes, trees2, start2, end2,
+                                          minprods)
+            for m in candidates:
                 if trees1 is trees2 and m <= n:
                     continue
                 elif start2 > m or m > end2:
@@ -186,10 +210,30 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
         else:  # all pairs
             if trees1 is trees2:
                 start2 = max(n + 1, start2)
-            for m in range(start2, end2):
-                extractfrompair(a, anodes, trees2, n, m,
-                                complement, debug, vocab, inter, minterms, matrix,
-                                scratch, SLOTS)
+            # only visit trees sharing productions with 'a'
+            candidates = None
+            if prefilter:
+                candidates = sharedprods(a, anodes, trees2, start2, end2,
+                                         minprods)
+                numpairs += max(end2 - start2, 0)
+                numskipped += max(end2 - start2, 0) - len(candidates)
+                if len(candidates) == end2 - start2:  # no pairs skipped
+                    candidates = None
+                # with minprods=1 the prefilter does not affect the result;
+                # stop using it when it turns out to skip few pairs.
+                if (minprods == 1 and numpairs >= 1000
+                        and numskipped < 0.1 * numpairs):
+                    prefilter = False
+            if candidates is None:
+                for m in range(start2, end2):
+                    extractfrompair(a, anodes, trees2, n, m,
+                                    complement, debug, vocab, inter, minterms,
+                                    matrix, scratch, SLOTS)
+            else:
+                for m in candidates:
+                    extractfrompair(a, anodes, trees2, n, m,
+                                    complement, debug, vocab, inter, minterms,
+                                    matrix, scratch, SLOTS)
         collectfragments(fragments, inter, anodes, asent, vocab,
                          disc, approx, False, tmp, SLOTS)
     free(matrix)
@@ -660,6 +704,30 @@ cdef twoterminals(NodeArray a, Node * anodes,
     return candidates
 
 
+cdef sharedprods(NodeArray a, Node * anodes, Ctrees trees2,
+                 int start, int end, int minprods):
+    """Select trees ``start <= m < end`` sharing productions with ``a``.
+
+    :param minprods: the minimum number of distinct productions that a tree
+            should have in common with ``a``."""
+    cdef int i, j, numprods = len(trees2.prodindex)
+    cdef set prods = set()
+    cdef list bitmaps, atleast  # atleast[j]: trees sharing > j productions
+    for i in range(a.len):
+        if 0 <= anodes[i].prod < numprods:
+            prods.add(anodes[i].prod)
+    if minprods <= 1:
+        bitmaps = [trees2.prodindex.get(i) for i in prods]
+        return RoaringBitmap().union(*bitmaps).clamp(start, end)
+    atleast = [RoaringBitmap() for _ in range(minprods)]
+    for i in prods:
+        tmp = trees2.prodindex.get(i).clamp(start, end)
+        for j in range(minprods - 1, 0, -1):
+            atleast[j] |= atleast[j - 1] & tmp
+        atleast[0] |= tmp
+    return atleast[minprods - 1]
+
+
 cdef extractcompbitsets(uint64_t * bitset, Node * a,
                         int i, int n, set results, short SLOTS, uint64_t * scratch):
     """Like ``extractbitsets()`` but following complement of ``bitset``."""
@@ -15,6 +15,11 @@ BITPAR_NONINT = re.compile('(?:^|\n)[0-9]+\.[0-9]+[ \t]')
 LEXICON_NONINT = re.compile('[ \t][0-9]+[./][0-9]+[ \t\n]')
 # Detect rule format of bitpar
 BITPARRE = re.compile(r'^[-.e0-9]+\b')
+# Compiled grammar files (cf. Grammar.tofile()): magic string, version of
+# file format, and number of uint64 fields in header following magic string.
+GRAMMARMAGIC = b'DISCOGRM'
+GRAMMARVERSION = 1
+GRAMMARHEADER = 17
 
 # comparison functions for sorting rules on LHS/RHS labels.
 cdef int cmp0(const void * p1, const void * p2) nogil:
@@ -393,6 +398,161 @@ cdef class Grammar:
         # sentinel rule
         dest[0][m].lhs = dest[0][m].rhs1 = dest[0][m].rhs2 = self.nonterminals
 
+    def tofile(self, filename):
+        """Store grammar in a binary file that can be memory mapped.
+
+        The file contains the arrays of rules as they are indexed in memory,
+        so that ``Grammar.fromfile()`` does not need to parse, sort, and
+        index the rules again. Labels, probabilistic models, and the original
+        rules and lexicon are stored as well; the mapping to a coarse grammar
+        is not stored."""
+        cdef size_t n, numrules = (self.numrules + 2 * self.numbinary
+                                   + self.numunary + 4)
+        cdef array offsets = clone(array(b'I' if PY2 else 'I'),
+                                   4 * self.nonterminals, False)
+        cdef list strings = [
+            self.start.encode('utf8'),
+            '\n'.join(self.modelnames).encode('utf8'),
+            '\n'.join(self.tolabel).encode('utf8'),
+            self.origrules.encode('utf8'),
+            self.origlexicon.encode('utf8')]
+        for n in range(4 * self.nonterminals):
+            offsets.data.as_uints[n] = self.bylhs[n] - self.bylhs[0]
+        header = np.array([
+            GRAMMARVERSION, sizeof(ProbRule),
+            self.nonterminals, self.phrasalnonterminals,
+            self.numrules, self.numunary, self.numbinary, self.maxfanout,
+            self.bitpar | (self.binarized << 1) | (self.logprob << 2),
+            self.currentmodel, len(self.modelnames), len(self.lexical)]
+            + [len(a) for a in strings], dtype=np.uint64)
+        assert len(header) == GRAMMARHEADER
+        with open(filename, 'wb') as out:
+            out.write(GRAMMARMAGIC)
+            header.tofile(out)
+            out.write(( < char * > self.bylhs[0])[
+                :numrules * sizeof(ProbRule)])
+            np.ascontiguousarray(self.models, dtype='d').tofile(out)
+            offsets.tofile(out)
+            out.write(( < char * > self.revmap)[
+                :self.numrules * sizeof(uint32_t)])
+            out.write(( < char * > self.fanout)[
+                :self.nonterminals * sizeof(uint8_t)])
+            for a in strings:
+                out.write(a)
+
+    @classmethod
+    def fromfile(cls, filename):
+        """Load a grammar stored with ``Grammar.tofile()``.
+
+        The arrays with rules and weights are memory mapped copy-on-write, so
+        that they can be shared with other processes loading the same file,
+        while switching to another model only copies the pages being
+        modified. Lexical rules and label dictionaries are rebuilt."""
+        cdef Grammar ob = Grammar.__new__(Grammar)
+        cdef Py_buffer buffer
+        cdef Py_ssize_t size = 0
+        cdef char * ptr = NULL
+        cdef uint64_t * header = NULL
+        cdef uint32_t * offsets = NULL
+        cdef ProbRule * rules = NULL
+        cdef LexicalRule lexrule
+        cdef size_t n, offset, numrules, numweights, nummodels
+        cdef int result
+        filename = os.path.abspath(filename)
+        inp = open(filename, 'rb')
+        try:
+            buf = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_COPY)
+        finally:
+            inp.close()
+        if buf[:len(GRAMMARMAGIC)] != GRAMMARMAGIC:
+            raise ValueError('not a compiled grammar file: %r' % filename)
+        result = getbufptr(buf, & ptr, & size, & buffer)
+        if result != 0:
+            raise ValueError('could not get buffer from mmap.')
+        header = <uint64_t * > & ptr[len(GRAMMARMAGIC)]
+        if header[0] != GRAMMARVERSION or header[1] != sizeof(ProbRule):
+            releasebuf( & buffer)
+            raise ValueError('incompatible grammar file version %d; '
+                             'expected version %d. Recreate %r.' % (
+                                 header[0], GRAMMARVERSION, filename))
+        ob._state = (filename, buf)
+        ob.nonterminals, ob.phrasalnonterminals = header[2], header[3]
+        ob.numrules, ob.numunary, ob.numbinary = header[4], header[5], header[6]
+        ob.maxfanout = header[7]
+        ob.bitpar = header[8] & 1
+        ob.binarized = (header[8] >> 1) & 1
+        ob.logprob = (header[8] >> 2) & 1
+        ob.currentmodel, nummodels = header[9], header[10]
+        numweights = ob.numrules + header[11]
+        numrules = ob.numrules + 2 * ob.numbinary + ob.numunary + 4
+        offset = len(GRAMMARMAGIC) + GRAMMARHEADER * sizeof(uint64_t)
+        rules = <ProbRule * > & ptr[offset]
+        offset += numrules * sizeof(ProbRule)
+        ob.models = np.frombuffer(buf, dtype='d', count=nummodels * numweights,
+                                  offset=offset).reshape(nummodels, numweights)
+        offset += nummodels * numweights * sizeof(double)
+        offsets = <uint32_t * > & ptr[offset]
+        offset += 4 * ob.nonterminals * sizeof(uint32_t)
+        ob.revmap = <uint32_t * > & ptr[offset]
+        offset += ob.numrules * sizeof(uint32_t)
+        ob.fanout = <uint8_t * > & ptr[offset]
+        offset += ob.nonterminals * sizeof(uint8_t)
+        strings = []
+        for n in range(12, GRAMMARHEADER):
+            strings.append(buf[offset:offset + header[n]].decode('utf8'))
+            offset += header[n]
+        releasebuf( & buffer)
+        ob.start, modelnames, labels, ob.origrules, ob.origlexicon = strings
+        ob.modelnames = modelnames.split('\n')
+        ob.tolabel = labels.split('\n')
+        ob.toid = {label: n for n, label in enumerate(ob.tolabel)}
+        # point to the sections of the contiguous array of rules
+        ob.bylhs = <ProbRule ** >malloc(sizeof(ProbRule * )
+                                        * ob.nonterminals * 4)
+        if ob.bylhs is NULL:
+            raise MemoryError('allocation error')
+        for n in range(4 * ob.nonterminals):
+            ob.bylhs[n] = &(rules[offsets[n]])
+        ob.unary = &(ob.bylhs[1 * ob.nonterminals])
+        ob.lbinary = &(ob.bylhs[2 * ob.nonterminals])
+        ob.rbinary = &(ob.bylhs[3 * ob.nonterminals])
+        ob.mask = <uint64_t * >malloc(
+            BITNSLOTS(ob.numrules) * sizeof(uint64_t))
+        if ob.mask is NULL:
+            raise MemoryError('allocation error')
+        ob.setmask(None)
+        # lexical rules are not stored in binary form; use weights of the
+        # current model.
+        ob._convertlexicon({label: ob.fanout[n]
+                            for n, label in enumerate(ob.tolabel)})
+        if len(ob.lexical) != numweights - ob.numrules:
+            raise ValueError('mismatch in number of lexical rules.')
+        tmp = ob.models[ob.currentmodel, ob.numrules:]
+        if ob.logprob:
+            tmp = -np.log(tmp)
+        for n, lexrule in enumerate(ob.lexical):
+            lexrule.prob = tmp[n]
+        ob._getrulenos(ob.origrules.splitlines())
+        return ob
+
+    @cython.wraparound(True)
+    def _getrulenos(self, list rulelines):
+        """Map rules as strings to rule numbers; cf. ``_convertrules()``."""
+        cdef uint32_t n = 0
+        self.rulenos = {}
+        for line in rulelines:
+            if not line.strip():
+                continue
+            fields = line.split()
+            if self.bitpar:
+                rule = fields[1:]
+                yf = ''.join(map(str, range(len(rule) - 1)))
+            else:
+                rule = fields[:-2]
+                yf = fields[-2]
+            self.rulenos[yf + ' ' + ' '.join(rule)] = n
+            n += 1
+
     def register(self, name, weights):
         """Register a probabilistic model given a name and a sequence of
         floats ``weights``, with weights in the same order as
@@ -408,6 +568,8 @@ cdef class Grammar:
             raise ValueError('length mismatch: %d grammar rules, '
                              '%d weights given.' % (
                                  self.numrules + len(self.lexical), len(weights)))
+        if not self.models.flags.owndata:  # memory mapped; make a copy
+            self.models = np.array(self.models)
         self.models.resize(m + 1, self.numrules + len(self.lexical))
         self.modelnames.append(name)
         tmp = self.models[m]
@@ -651,18 +813,28 @@ cdef class Grammar:
                                     self.origrules, self.origlexicon)
 
     def __reduce__(self):
-        """Helper function for pickling."""
+        """Helper function for pickling.
+
+        A grammar loaded with ``fromfile()`` is pickled by filename, so that
+        processes unpickling it share the memory mapped file."""
+        if self._state is not None and not self.models.flags.owndata:
+            return (_loadgrammar, (self._state[0],
+                                   self.modelnames[self.currentmodel],
+                                   self.logprob))
         return (Grammar, (self.origrules, self.origlexicon,
                           self.start, self.binarized))
 
     def __dealloc__(self):
         if self.bylhs is NULL:
             return
-        free(self.bylhs[0])
+        if self._state is None:
+            free(self.bylhs[0])
+            free(self.fanout)
+            free(self.revmap)
+        else:  # arrays are part of memory mapped file
+            self.models = self._state = None
         free(self.bylhs)
-        free(self.fanout)
         free(self.mask)
-        free(self.revmap)
         if self.chainvec is not NULL:
             free(self.chainvec)
         if self.mapping is not NULL:
@@ -674,6 +846,13 @@ cdef class Grammar:
         self.chainvec = self.mapping = self.splitmapping = NULL
 
 
+def _loadgrammar(filename, model, logprob):
+    """Helper function for unpickling a grammar stored in a file."""
+    grammar = Grammar.fromfile(filename)
+    grammar.switch(model, logprob)
+    return grammar
+
+
 cdef inline double convertweight(const char * weight):
     """Convert weight to double; weight may be a fraction '1/2',
     decimal float '0.5' or hex float '0x1.0p-1'. Returns 0 on error."""
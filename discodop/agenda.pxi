@@ -353,6 +353,158 @@ cdef class DoubleAgenda(Agenda):
         return entry.key, entry.value
 
 
+@cython.final
+cdef class RadixAgenda:
+    """Monotone priority queue implemented as a radix heap.
+
+    Keys are small integers (e.g., indices into an array of items), and
+    priorities are non-negative C doubles. An entry is stored in one of 65
+    buckets according to the highest bit in which the bit pattern of its
+    priority differs from that of the last popped priority; since the bit
+    patterns of non-negative doubles are ordered in the same way as the
+    doubles themselves, this does not require quantizing the priorities.
+    Implements decrease-key by adding a new entry and skipping the old one
+    when it is encountered.
+
+    The priority queue is monotone: a priority should not be lower than the
+    last popped priority; if it is, the item is popped next, but the order
+    among such items is not defined. Equivalent values are popped in
+    last-in, first-out order."""
+
+    def __cinit__(self):
+        cdef int n
+        for n in range(65):
+            self.buckets[n] = NULL
+            self.bucketlen[n] = self.bucketcap[n] = 0
+        self.prios = NULL
+        self.numkeys = self.length = self.last = self.popped = 0
+
+    def __dealloc__(self):
+        cdef int n
+        for n in range(65):
+            free(self.buckets[n])
+        free(self.prios)
+
+    cdef int _push(self, uint32_t key, uint64_t prio) except -1:
+        """Add entry to the appropriate bucket."""
+        cdef int n = bitlength(prio ^ self.last) if prio > self.last else 0
+        cdef RadixEntry * entry
+        if self.bucketlen[n] == self.bucketcap[n]:
+            self.bucketcap[n] = (2 * self.bucketcap[n]
+                                 if self.bucketcap[n] else 64)
+            self.buckets[n] = <RadixEntry * >realloc(
+                self.buckets[n], self.bucketcap[n] * sizeof(RadixEntry))
+            if self.buckets[n] is NULL:
+                raise MemoryError('allocation error')
+        entry = &(self.buckets[n][self.bucketlen[n]])
+        entry.prio = prio
+        entry.key = key
+        self.bucketlen[n] += 1
+        return 0
+
+    cdef int setitem(self, uint32_t key, double value) except -1:
+        """Like agenda[key] = value, but bypass Python API."""
+        cdef uint64_t prio = 0
+        cdef size_t n
+        if value < 0:
+            raise ValueError('negative priority: %g' % value)
+        elif value != 0:  # NB: turns -0.0 into 0
+            memcpy(&prio, &value, sizeof(prio))
+        if key >= self.numkeys:
+            n = max(2 * self.numkeys, key + 1, 1024)
+            self.prios = <uint64_t * >realloc(self.prios, n * sizeof(uint64_t))
+            if self.prios is NULL:
+                raise MemoryError('allocation error')
+            memset(&(self.prios[self.numkeys]), 0,
+                   (n - self.numkeys) * sizeof(uint64_t))
+            self.numkeys = n
+        if self.prios[key] == 0:
+            self.length += 1
+        elif self.prios[key] == prio + 1:
+            return 0
+        self.prios[key] = prio + 1
+        return self._push(key, prio)
+
+    cdef int setifbetter(self, uint32_t key, double value) except -1:
+        """Sets an item, but only if item is new or has lower score."""
+        if self.contains(key) and value >= self.getitem(key):
+            return 0
+        return self.setitem(key, value)
+
+    cdef bint contains(self, uint32_t key):
+        """Like ``key in agenda``, but bypass Python API."""
+        return key < self.numkeys and self.prios[key] != 0
+
+    cdef double getitem(self, uint32_t key):
+        """Like agenda[key], but bypass Python API; key must be in agenda."""
+        cdef uint64_t prio = self.prios[key] - 1
+        cdef double value = 0.0
+        memcpy(&value, &prio, sizeof(value))
+        return value
+
+    cdef long popkey(self) except -1:
+        """Remove the item with the best priority and return its key."""
+        cdef RadixEntry entry
+        cdef uint64_t minprio
+        cdef size_t n, m
+        cdef int i
+        while self.length:
+            while self.bucketlen[0]:
+                self.bucketlen[0] -= 1
+                entry = self.buckets[0][self.bucketlen[0]]
+                if self.prios[entry.key] == entry.prio + 1:
+                    self.prios[entry.key] = 0
+                    self.length -= 1
+                    self.popped = entry.prio
+                    return entry.key
+            # move the entries of the first non-empty bucket to lower buckets,
+            # relative to the new minimum.
+            i = 1
+            while self.bucketlen[i] == 0:
+                i += 1
+            minprio = ~(<uint64_t>0)
+            m = 0
+            for n in range(self.bucketlen[i]):
+                entry = self.buckets[i][n]
+                if self.prios[entry.key] == entry.prio + 1:  # skip old entries
+                    self.buckets[i][m] = entry
+                    m += 1
+                    if entry.prio < minprio:
+                        minprio = entry.prio
+            self.bucketlen[i] = 0
+            if m:
+                self.last = minprio
+            for n in range(m):
+                self._push(self.buckets[i][n].key, self.buckets[i][n].prio)
+        for i in range(65):
+            self.bucketlen[i] = 0
+        raise IndexError('pop from empty agenda')
+
+    def popitem(self):
+        """:returns: best scoring (key, value) pair; removed from agenda."""
+        cdef long key = self.popkey()
+        cdef double value = 0.0
+        memcpy(&value, &self.popped, sizeof(value))
+        return key, value
+
+    def __setitem__(self, key, value):
+        self.setitem(key, value)
+
+    def __getitem__(self, key):
+        if not self.contains(key):
+            raise KeyError(key)
+        return self.getitem(key)
+
+    def __contains__(self, key):
+        return self.contains(key)
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length != 0
+
+
 # A quicksort nsmallest implementation.
 cdef list nsmallest(int n, list entries):
     """Return an _unsorted_ list of the n smallest DoubleEntry objects.
@@ -510,7 +662,7 @@ def merge(*iterables, key=None):
     already be sorted with this key."""
     cdef list heap = []
     cdef uint64_t cnt
-    cdef Entry entry = None, dummy = None
+    cdef Entry entry = None
     if key is None:
         def key(x):
             return x
@@ -534,9 +686,9 @@ def merge(*iterables, key=None):
                 item = next(iterable)
                 entry.key = (item, iterable)
                 entry.value = key(item)
-                dummy = heapreplace(heap, entry)
+                heapreplace(heap, entry)
         except StopIteration:
-            dummy = heappop(heap, entry)
+            heappop(heap, entry)
 
     if heap:  # only a single iterator remains, skip heap
         entry = heappop(heap, entry)
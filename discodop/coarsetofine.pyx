@@ -2,14 +2,19 @@
 """
 from __future__ import print_function
 from libc.stdint cimport uint8_t, uint32_t, uint64_t
+from libc.math cimport exp as cexp
 from .tree import Tree
 from .treetransforms import mergediscnodes, unbinarize, fanout, addbitsets
-from .containers cimport Grammar, Chart, ChartItem, Edge, Edges, MoreEdges, \
-    LexicalRule, RankedEdge, cellidx, compactcellidx, \
-    CFGtoSmallChartItem, CFGtoFatChartItem
-from .kbest import lazykbest
+from .containers cimport Grammar, Chart, ChartItem, SmallChartItem, Edge, \
+    Edges, MoreEdges, LexicalRule, RankedEdge, LCFRSWhitelist, cellidx, \
+    compactcellidx, CFGtoSmallChartItem, CFGtoFatChartItem
+from .kbest import KBest
 import numpy as np
 
+cdef extern from "macros.h":
+    int BITNSLOTS(int nb)
+    void SETBIT(uint64_t a[], int b)
+
 include "constants.pxi"
 
 # alternative: take coarse chart, return fine chart w/whitelist.
@@ -45,17 +50,22 @@ def prunechart(Chart coarsechart, Grammar fine, k,
     :param bitpar: prune from bitpar derivations instead of actual chart
     :returns: ``(whitelist, items, msg)``
 
-    For LCFRS, the white list is indexed as follows:
-                    :whitelisted: ``whitelist[label][item] == None``
+    For LCFRS, the white list is an ``LCFRSWhitelist`` with the coarse items;
+    for sentences of 64 words or more, it is a list indexed as follows:
+                    :whitelisted: ``item in whitelist[label]``
                     :blocked: ``item not in whitelist[label]``
 
-    For a CFG, indexing is as follows:
-            :whitelisted: ``whitelist[span][label] == None``
-            :blocked: ``label not in whitelist[cell]``
+    For a CFG, the white list is an array with a bitset of fine labels for
+    each compact span:
+            :whitelisted: ``TESTBIT(&(whitelist[cell, 0]), label)``
+            :blocked: ``not TESTBIT(&(whitelist[cell, 0]), label)``
     """
     cdef set items
-    cdef list whitelist
+    cdef LCFRSWhitelist itemwhitelist
     cdef ChartItem chartitem
+    cdef uint64_t[:, ::1] cfgwhitelist, labelbits
+    cdef size_t finespan, slots = BITNSLOTS(fine.nonterminals)
+    cdef uint32_t label, finelabel, n
     if fine.mapping is NULL:
         raise ValueError('need to call fine.getmapping(coarse, ...).')
     if splitprune and markorigin:
@@ -65,53 +75,84 @@ def prunechart(Chart coarsechart, Grammar fine, k,
     if 0 < k < 1:  # threshold on posterior probabilities
         items, msg = posteriorthreshold(coarsechart, k)
     else:  # construct a list of the k-best nonterminals to prune with
-        if bitpar:
-            items = bitparkbestitems(coarsechart, k, finecfg)
-        elif k == 0:
-            coarsechart.filter()
-            items = set(coarsechart.getitems())
+        if bitpar or k == 0:
+            if bitpar:
+                items = bitparkbestitems(coarsechart, k, finecfg)
+            else:
+                coarsechart.filter()
+                items = set(coarsechart.getitems())
+            numderivs = len(coarsechart.rankededges[coarsechart.root()][:k])
         else:
-            _ = lazykbest(coarsechart, k, derivs=False)
-            items = set(coarsechart.rankededges)
+            # only the items are needed, so derivations are not converted
+            # to RankedEdge objects.
+            kbest = KBest(coarsechart, k)
+            items = set(kbest.getitems())
+            numderivs = len(kbest)
         msg = ('coarse items before pruning: %d; after: %d, '
                'based on %d/%d derivations' % (
-                   len(coarsechart.getitems()), len(items),
-                   len(coarsechart.rankededges[coarsechart.root()][:k]), k))
+                   len(coarsechart.getitems()), len(items), numderivs, k))
     # project items to fine grammar
     if finecfg:
-        cfgwhitelist = [set() for _ in range(compactcellidx(
-                        coarsechart.lensent - 1, coarsechart.lensent,
-                        coarsechart.lensent, 1) + 1)]
+        # the fine labels that each coarse label maps to, as bitsets
+        labelbits = np.zeros((coarsechart.grammar.nonterminals, slots),
+                             dtype=np.uint64)
+        for finelabel in range(1, fine.nonterminals):
+            if fine.mapping[finelabel] == 0:  # never blocked
+                for label in range(coarsechart.grammar.nonterminals):
+                    SETBIT(&(labelbits[label, 0]), finelabel)
+            else:
+                SETBIT(&(labelbits[fine.mapping[finelabel], 0]), finelabel)
+        cfgwhitelist = np.zeros((compactcellidx(
+                coarsechart.lensent - 1, coarsechart.lensent,
+                coarsechart.lensent, 1) + 1, slots), dtype=np.uint64)
         for item in items:
             label = coarsechart.label(item)
             finespan = coarsechart.asCFGspan(item, fine.nonterminals)
-            for finelabel in range(1, fine.nonterminals):
-                if (fine.mapping[finelabel] == 0
-                        or fine.mapping[finelabel] == label):
-                    cfgwhitelist[finespan].add(finelabel)
-        return cfgwhitelist, None, msg
-    else:
-        whitelist = [None] * fine.nonterminals
-        kbestspans = [set() for _ in coarsechart.grammar.toid]
-        kbestspans[0] = None
-        # uses ids of labels in coarse chart
+            for n in range(slots):
+                cfgwhitelist[finespan, n] |= labelbits[label, n]
+        return cfgwhitelist.base, None, msg
+    elif coarsechart.lensent < 8 * sizeof(uint64_t):
+        itemwhitelist = LCFRSWhitelist(fine, len(items), splitprune,
+                                       markorigin)
         for item in items:
-            # we can use coarsechart here because we only use the item to
-            # define a span, which is the same for the fine chart.
             chartitem = coarsechart.asChartItem(item)
-            label = chartitem.label
-            chartitem.label = 0
-            kbestspans[label].add(chartitem)
-        # now construct a list which references these coarse items:
-        for label in range(fine.nonterminals):
-            if splitprune and markorigin and fine.fanout[label] != 1:
-                if fine.splitmapping[label] is not NULL:
-                    whitelist[label] = [kbestspans[fine.splitmapping[label][n]]
-                                        for n in range(fine.fanout[label])]
-            else:
-                if fine.mapping[label] != 0:
-                    whitelist[label] = kbestspans[fine.mapping[label]]
-        return whitelist, items, msg
+            itemwhitelist.add(chartitem.label,
+                              (<SmallChartItem>chartitem).vec)
+        return itemwhitelist, items, msg
+    return whitelistsets(coarsechart, fine, items, splitprune, markorigin
+                         ), items, msg
+
+
+def whitelistsets(Chart coarsechart, Grammar fine, items,
+                  bint splitprune, bint markorigin):
+    """Produce a white list for LCFRS with a set of spans per fine label.
+
+    Equivalent to an ``LCFRSWhitelist`` of ``items``, but also works with
+    sentences of 64 words or more; see ``prunechart()`` for the parameters.
+    """
+    cdef list whitelist = [None] * fine.nonterminals
+    cdef ChartItem chartitem
+    cdef uint32_t label
+    kbestspans = [set() for _ in coarsechart.grammar.toid]
+    kbestspans[0] = None
+    # uses ids of labels in coarse chart
+    for item in items:
+        # we can use coarsechart here because we only use the item to
+        # define a span, which is the same for the fine chart.
+        chartitem = coarsechart.asChartItem(item)
+        label = chartitem.label
+        chartitem.label = 0
+        kbestspans[label].add(chartitem)
+    # now construct a list which references these coarse items:
+    for label in range(fine.nonterminals):
+        if splitprune and markorigin and fine.fanout[label] != 1:
+            if fine.splitmapping[label] is not NULL:
+                whitelist[label] = [kbestspans[fine.splitmapping[label][n]]
+                                    for n in range(fine.fanout[label])]
+        else:
+            if fine.mapping[label] != 0:
+                whitelist[label] = kbestspans[fine.mapping[label]]
+    return whitelist
 
 
 def bitparkbestitems(Chart chart, int k, bint finecfg):
@@ -147,28 +188,30 @@ def posteriorthreshold(Chart chart, double threshold):
     """Prune labeled spans from chart below given posterior threshold.
 
     :returns: dictionary of remaining items."""
+    cdef double[:] inside, outside
+    cdef double sentprob
+    cdef size_t idx, numitems = 0
+    cdef list order
     if not 0 < threshold < 1:
         raise ValueError('probability threshold should be between 0 and 1.')
     if not chart.itemsinorder:
         raise ValueError('need list of chart items in topological order.')
-    origlogprob = chart.grammar.logprob
-    chart.grammar.switch(
-        chart.grammar.modelnames[chart.grammar.currentmodel],
-        logprob=False)
-    getinside(chart)
-    getoutside(chart)
-    chart.grammar.switch(
-        chart.grammar.modelnames[chart.grammar.currentmodel],
-        logprob=origlogprob)
-    sentprob = chart.inside[chart.root()]
+    order = topologicalorder(chart)
+    getinside(chart, order)
+    getoutside(chart, order)
+    inside, outside = chart.inside, chart.outside
+    sentprob = inside[chart.itemid(chart.root())]
     threshold *= sentprob
     if not sentprob:
         raise ValueError('sentence has zero posterior prob.: %g' % sentprob)
-    posterior = {item for item in chart.getitems()
-                 if chart.inside[item] * chart.outside[item] > threshold}
+    posterior = set()
+    for item in order:
+        idx = chart.itemid(item)
+        numitems += 1
+        if inside[idx] * outside[idx] > threshold:
+            posterior.add(item)
 
     unfiltered = len(chart.getitems())
-    numitems = len(chart.outside)
     numremain = len(posterior)
     msg = ('coarse items before pruning=%d; filtered: %d;'
            ' pruned: %d; sentprob=%g' % (
@@ -176,29 +219,77 @@ def posteriorthreshold(Chart chart, double threshold):
     return posterior, msg
 
 
-def getinside(Chart chart):
-    """Compute inside probabilities for a chart given its parse forest."""
-    cdef size_t n
+cpdef list topologicalorder(Chart chart):
+    """Return the items of derivations headed by the root, children first.
+
+    Each item comes after the items of its edges. NB: the order in which items
+    were added to the chart is not enough; an item may get more edges after
+    another item has been added, e.g., with unary rules."""
+    cdef list result = [], agenda = [chart.root()]
+    # state of each item: 0 = not seen; 1 = children on agenda; 2 = done
+    cdef uint8_t[:] state = np.zeros(chart.numitemids(), dtype=np.uint8)
+    cdef size_t n, idx
     cdef Edge * edge
     cdef Edges edges
     cdef MoreEdges * edgelist
-    # this needs to be bottom up, so need order in which items were added
-    # currently separate list, chart.itemsinorder
-    # NB: sorting items by length is not enough,
-    # unaries have to be in the right order...
+    chart.itemids = None  # the items of the chart may have changed
+    while agenda:
+        item = agenda.pop()
+        idx = chart.itemid(item)
+        if state[idx] == 1:
+            state[idx] = 2
+            result.append(item)
+            continue
+        elif state[idx] == 2:
+            continue
+        state[idx] = 1
+        agenda.append(item)
+        edges = chart.getedges(item)
+        edgelist = edges.head if edges is not None else NULL
+        while edgelist is not NULL:
+            for n in range(edges.len if edgelist is edges.head
+                           else EDGES_SIZE):
+                edge = &(edgelist.data[n])
+                if edge.rule is NULL:
+                    continue
+                leftitem = chart._left(item, edge)
+                if state[chart.itemid(leftitem)] == 0:
+                    agenda.append(leftitem)
+                if edge.rule.rhs2 != 0:
+                    rightitem = chart._right(item, edge)
+                    if state[chart.itemid(rightitem)] == 0:
+                        agenda.append(rightitem)
+            edgelist = edgelist.prev
+    return result
 
+
+def getinside(Chart chart, list order=None):
+    """Compute inside probabilities for a chart given its parse forest.
+
+    The result is stored in an array aligned with the items of the chart,
+    ``chart.inside[chart.itemid(item)]``.
+
+    :param order: the result of :py:func:`topologicalorder`; computed if not
+        given."""
+    cdef size_t n, idx
+    cdef double prob
+    cdef double[:] inside
+    cdef bint logprob = chart.grammar.logprob
+    cdef Edge * edge
+    cdef Edges edges
+    cdef MoreEdges * edgelist
     # choices for probs:
     # - normal => underflow (current)
     # - logprobs => loss of precision w/addition
     # - normal, scaled => how?
-
-    # packing parse forest:
-    # revitems = {item: n for n, item in enumerate(self.itemsinorder)}
-    # now self.inside[n] and self.outside[n] can be double arrays.
-    chart.inside = dict.fromkeys(chart.getitems(), 0.0)
+    if order is None:
+        order = topologicalorder(chart)
+    chart.inside = np.zeros(chart.numitemids())
+    inside = chart.inside
 
     # traverse items in bottom-up order
-    for item in chart.itemsinorder:
+    for item in order:
+        idx = chart.itemid(item)
         edges = chart.getedges(item)
         edgelist = edges.head if edges is not None else NULL
         while edgelist is not NULL:
@@ -208,38 +299,50 @@ def getinside(Chart chart):
                 if edge.rule is NULL:
                     label = chart.label(item)
                     word = chart.sent[chart.lexidx(edge)]
-                    prob = ( < LexicalRule > chart.grammar.lexicalbylhs[
-                        label].get(word, 1.0)).prob
+                    lexrule = chart.grammar.lexicalbylhs[label].get(word)
+                    if lexrule is None:
+                        prob = 1.0
+                    else:
+                        prob = (<LexicalRule>lexrule).prob
+                        if logprob:
+                            prob = cexp(-prob)
                 elif edge.rule.rhs2 == 0:
-                    leftitem = chart._left(item, edge)
-                    prob = (edge.rule.prob
-                            * chart.inside[leftitem])
+                    prob = (cexp(-edge.rule.prob) if logprob
+                            else edge.rule.prob)
+                    prob *= inside[chart.itemid(chart._left(item, edge))]
                 else:
-                    leftitem = chart._left(item, edge)
-                    rightitem = chart._right(item, edge)
-                    prob = (edge.rule.prob
-                            * chart.inside[leftitem]
-                            * chart.inside[rightitem])
-                # chart.addprob(item, prob)
-                chart.inside[item] += prob
+                    prob = (cexp(-edge.rule.prob) if logprob
+                            else edge.rule.prob)
+                    prob *= (inside[chart.itemid(chart._left(item, edge))]
+                             * inside[chart.itemid(chart._right(item, edge))])
+                inside[idx] += prob
             edgelist = edgelist.prev
 
 
-def getoutside(Chart chart):
-    """Compute outside probabilities for a chart given its parse forest."""
-    cdef size_t n
+def getoutside(Chart chart, list order=None):
+    """Compute outside probabilities for a chart given its parse forest.
+
+    Requires inside probabilities from :py:func:`getinside`; the result is
+    stored in an array aligned with the items of the chart,
+    ``chart.outside[chart.itemid(item)]``.
+
+    :param order: the result of :py:func:`topologicalorder`; computed if not
+        given."""
+    cdef size_t n, leftidx, rightidx
+    cdef double outsideprob, prob
+    cdef bint logprob = chart.grammar.logprob
+    cdef double[:] inside = chart.inside, outside
     cdef Edge * edge
     cdef Edges edges
     cdef MoreEdges * edgelist
-    cdef double outsideprob
-    # cdef double sentprob = chart.inside[chart.root()]
     # traverse items in top-down order
-    # could use list with idx of item in itemsinorder
-    chart.outside = dict.fromkeys(chart.getitems(), 0.0)
-    chart.outside[chart.root()] = 1.0
-    for item in reversed(chart.itemsinorder):
-        # can we define outside[item] simply as sentprob - inside[item] ?
-        # chart.outside[item] = sentprob - chart.inside[item]
+    chart.outside = np.zeros(chart.numitemids())
+    outside = chart.outside
+    outside[chart.itemid(chart.root())] = 1.0
+    if order is None:
+        order = topologicalorder(chart)
+    for item in reversed(order):
+        outsideprob = outside[chart.itemid(item)]
         edges = chart.getedges(item)
         edgelist = edges.head if edges is not None else NULL
         while edgelist is not NULL:
@@ -247,21 +350,16 @@ def getoutside(Chart chart):
                            else EDGES_SIZE):
                 edge = &(edgelist.data[n])
                 if edge.rule is NULL:
-                    pass
-                elif edge.rule.rhs2 == 0:
-                    leftitem = chart._left(item, edge)
-                    chart.outside[leftitem] += (edge.rule.prob
-                                                * chart.outside[item])
+                    continue
+                prob = cexp(-edge.rule.prob) if logprob else edge.rule.prob
+                if edge.rule.rhs2 == 0:
+                    leftidx = chart.itemid(chart._left(item, edge))
+                    outside[leftidx] += prob * outsideprob
                 else:
-                    leftitem = chart._left(item, edge)
-                    rightitem = chart._right(item, edge)
-                    outsideprob = chart.outside[item]
-                    chart.outside[leftitem] += (edge.rule.prob
-                                                * chart.inside[rightitem]
-                                                * outsideprob)
-                    chart.outside[rightitem] += (edge.rule.prob
-                                                 * chart.inside[leftitem]
-                                                 * outsideprob)
+                    leftidx = chart.itemid(chart._left(item, edge))
+                    rightidx = chart.itemid(chart._right(item, edge))
+                    outside[leftidx] += prob * inside[rightidx] * outsideprob
+                    outside[rightidx] += prob * inside[leftidx] * outsideprob
             edgelist = edgelist.prev
 
 
@@ -293,17 +391,20 @@ def doctftest(coarse, fine, sent, tree, k, split, verbose=False):
     l, _, _ = prunechart(chart, fine, k, split, True, False, False)
     if verbose:
         print("\nitems in 50-best of coarse chart")
-        _ = lazykbest(chart, k, derivs=False)
-        for a in chart.rankededges:
+        for a in KBest(chart, k).getitems():
             print(coarse.tolabel[( < ChartItem > a).label],
                             bin(( < ChartItem > a).vec))
         print("\nwhitelist:")
-        for n, x in enumerate(l):
-            if isinstance(x, dict):
-                print(fine.tolabel[n], map(bin, x))
-            elif x:
-                for m, y in enumerate(x):
-                    print(fine.tolabel[n], m, map(bin, y))
+        if isinstance(l, LCFRSWhitelist):
+            for label, vec in l:
+                print(coarse.tolabel[label], bin(vec))
+        else:
+            for n, x in enumerate(l):
+                if isinstance(x, dict):
+                    print(fine.tolabel[n], map(bin, x))
+                elif x:
+                    for m, y in enumerate(x):
+                        print(fine.tolabel[n], m, map(bin, y))
     print(' F I N E ')
     chart2, _ = plcfrs.parse(sent, fine, tags=tags, whitelist=l,
                              splitprune=split, markorigin=True)
@@ -410,5 +511,5 @@ def test():
         print("time elapsed", clock() - begin, "s")
 
 
-__all__ = ['prunechart', 'bitparkbestitems', 'posteriorthreshold',
-           'getinside', 'getoutside']
+__all__ = ['prunechart', 'whitelistsets', 'bitparkbestitems',
+           'posteriorthreshold', 'getinside', 'getoutside']
@@ -11,6 +11,12 @@ ELSE:
 # reserve 8 bytes for linked list pointer; 16 bytes per edge.
 DEF EDGES_SIZE = (256 - 8) // 16
 
+# The maximum number of blocks of edges in a chunk of a DenseCFGChart's pool.
+DEF EDGES_CHUNKSIZE = 4096
+
+# The number of random numbers drawn at once when sampling derivations.
+DEF RANDOMBATCH = 4096
+
 # The arity of the heap. A typical heap is binary (2).
 # Higher values result in a heap with a smaller depth,
 # but increase the number of comparisons between siblings that need to be done.
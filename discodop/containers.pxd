@@ -45,6 +45,7 @@ cdef class Grammar:
     cdef readonly str origrules, origlexicon, start
     cdef readonly list tolabel, lexical, modelnames, rulemapping
     cdef readonly dict toid, lexicalbyword, lexicalbylhs, lexicalbynum, rulenos
+    cdef object _state  # (filename, mmap) of compiled grammar file, if any
     cdef _convertrules(self, list rulelines, dict fanoutdict)
     cdef _indexrules(self, ProbRule ** dest, int idx, int filterlen)
     cpdef rulestr(self, int n)
@@ -66,19 +67,20 @@ cdef class Grammar:
 # [x] sampling; not well tested.
 # [x] unroll list of edges in parse forest: list w/blocks of 1000 edges
 #     in arrays
+# [x] inside-outside parsing; current numpy arrays can be replaced with compact
+# 		indexed arrays, to save 50%, and be consistent with chart API
+# [x] recognition phase before making parse forest (pcfg.recognize)
 
 # chart improvements todo:
 # [ ] better to use e.g., C++ vector or other existing dynamic array for edges
-# [ ] inside-outside parsing; current numpy arrays can be replaced with compact
-# 		indexed arrays, to save 50%, and be consistent with chart API
 # [ ] symbolic parsing; separate viterbi stage
 # [ ] can we exploit bottom-up order of parser or previous ctf stages
 # 		to pack the parse forest?
-# [ ] is it useful to have a recognition phase before making parse forest?
 cdef class Chart:
     cdef readonly dict rankededges  # [item][n] => DoubleEntry(RankedEdge, prob)
     cdef object itemsinorder  # array or list
-    cdef dict inside, outside
+    cdef readonly object inside, outside  # arrays indexed by itemid()
+    cdef dict itemids  # item => index in itemsinorder
     cdef Grammar grammar
     cdef readonly list sent
     cdef short lensent
@@ -98,6 +100,21 @@ cdef class Chart:
     cdef ChartItem asChartItem(self, item)
     cdef size_t asCFGspan(self, item, size_t nonterminals)
     cdef Edges getedges(self, item)
+    cdef size_t itemid(self, item) except? -1
+    cdef size_t numitemids(self)
+
+
+@cython.final
+cdef class LCFRSWhitelist:
+    cdef uint64_t * vecs  # open addressing table of (coarse label, vec) keys
+    cdef uint32_t * labels  # coarse label of each slot; 0 for empty slots
+    cdef uint64_t mask  # size of table - 1; size is a power of 2
+    cdef readonly size_t length
+    cdef Grammar fine
+    cdef bint splitprune, markorigin
+    cdef int add(self, uint32_t label, uint64_t vec) except -1
+    cdef bint contains(self, uint32_t label, uint64_t vec) nogil
+    cdef bint check(self, uint32_t label, uint64_t vec)
 
 
 cdef struct ProbRule:  # total: 32 bytes.
@@ -315,7 +332,7 @@ cdef inline RankedEdge new_RankedEdge(
 
 # defined here because circular import.
 cdef inline size_t cellidx(short start, short end, short lensent,
-                           uint32_t nonterminals):
+                           uint32_t nonterminals) nogil:
     """Return an index for a regular three dimensional array.
 
     ``chart[start][end][0] => chart[idx]`` """
@@ -323,7 +340,7 @@ cdef inline size_t cellidx(short start, short end, short lensent,
 
 
 cdef inline size_t compactcellidx(short start, short end, short lensent,
-                                  uint32_t nonterminals):
+                                  uint32_t nonterminals) nogil:
     """Return an index to a triangular array, given start < end.
     The result of this function is the index to chart[start][end][0]."""
     return nonterminals * (lensent * start
@@ -375,6 +375,18 @@ cdef class Chart:
     def __contains__(self, item):
         return self.hasitem(item)
 
+    cdef size_t itemid(self, item) except? -1:
+        """Return index for item in arrays of size ``numitemids()``.
+
+        By default, this is the position of the item in ``itemsinorder``."""
+        if self.itemids is None:
+            self.itemids = {a: n for n, a in enumerate(self.itemsinorder)}
+        return self.itemids[item]
+
+    cdef size_t numitemids(self):
+        """Return the size of an array with a value for each item."""
+        return len(self.itemsinorder)
+
     cdef Edges getedges(self, item):
         """Get edges for item. NB: may return ``None``."""
         return self.parseforest[item] if item in self.parseforest else None
@@ -395,15 +407,7 @@ cdef class Chart:
                     free(tmp)
                 del self.parseforest[item]
         else:
-            # FIXME: maybe better as method in DenseCFGChart
-            for item in set(self.getitems()) - items:
-                edgelist = (< EdgesStruct * >self.parseforest)[item].head
-                while edgelist is not NULL:
-                    tmp = edgelist
-                    edgelist = edgelist.prev
-                    free(tmp)
-                (< EdgesStruct * >self.parseforest)[item].len = 0
-                (< EdgesStruct * >self.parseforest)[item].head = NULL
+            self._dropitems(set(self.getitems()) - items)
 
     def __str__(self):
         """Pretty-print chart and *k*-best derivations."""
@@ -417,10 +421,10 @@ cdef class Chart:
                 ('vitprob=%g' % (
                     exp(-self.subtreeprob(item)) if self.logprob
                     else self.subtreeprob(item))).ljust(17),
-                ((' ins=%g' % self.inside[item]).ljust(14)
-                 if self.inside else ''),
-                ((' out=%g' % self.outside[item]).ljust(14)
-                 if self.outside else ''))))
+                ((' ins=%g' % self.inside[self.itemid(item)]).ljust(14)
+                 if self.inside is not None else ''),
+                ((' out=%g' % self.outside[self.itemid(item)]).ljust(14)
+                 if self.outside is not None else ''))))
             edges = self.getedges(item)
             edgelist = edges.head if edges is not None else NULL
             while edgelist is not NULL:
@@ -455,6 +459,129 @@ cdef class Chart:
         # spans: ...
 
 
+@cython.final
+cdef class LCFRSWhitelist:
+    """A coarse-to-fine whitelist of items for the PLCFRS parser.
+
+    The label and bit vector of each coarse item that was not pruned are
+    stored in a hash table with open addressing. An item of the fine grammar
+    is whitelisted if the coarse label it maps to is whitelisted for its span;
+    with ``splitprune``, each component of a discontinuous item is looked up
+    separately. Fine labels without a mapping are never pruned. Only for
+    sentences of less than 64 words; i.e., ``SmallChartItem`` bit vectors.
+
+    :param fine: the grammar of the next stage; must have a mapping to the
+        coarse grammar established by ``fine.getmapping()``.
+    :param numitems: the expected number of coarse items."""
+
+    def __cinit__(self, Grammar fine, size_t numitems=0,
+                  bint splitprune=False, bint markorigin=False):
+        cdef size_t size = 16
+        while size < 2 * numitems:
+            size <<= 1
+        self.vecs = <uint64_t *>malloc(size * sizeof(uint64_t))
+        self.labels = <uint32_t *>calloc(size, sizeof(uint32_t))
+        if self.vecs is NULL or self.labels is NULL:
+            raise MemoryError('allocation error')
+        self.mask = size - 1
+        self.length = 0
+        self.fine = fine
+        self.splitprune = splitprune
+        self.markorigin = markorigin
+
+    def __dealloc__(self):
+        free(self.vecs)
+        free(self.labels)
+
+    cdef int add(self, uint32_t label, uint64_t vec) except -1:
+        """Add a coarse item."""
+        cdef uint64_t * newvecs
+        cdef uint32_t * newlabels
+        cdef uint64_t n, newmask, size = self.mask + 1, slot = whitelisthash(
+            label, vec) & self.mask
+        while self.labels[slot] != 0:
+            if self.labels[slot] == label and self.vecs[slot] == vec:
+                return 0
+            slot = (slot + 1) & self.mask
+        self.labels[slot] = label
+        self.vecs[slot] = vec
+        self.length += 1
+        if 2 * self.length > size:  # keep load factor below 0.5
+            # fill new table first; on failure, the old table remains valid.
+            newvecs = <uint64_t *>malloc(2 * size * sizeof(uint64_t))
+            newlabels = <uint32_t *>calloc(2 * size, sizeof(uint32_t))
+            if newvecs is NULL or newlabels is NULL:
+                free(newvecs)
+                free(newlabels)
+                raise MemoryError('allocation error')
+            newmask = 2 * size - 1
+            for n in range(size):
+                if self.labels[n] != 0:
+                    slot = whitelisthash(self.labels[n], self.vecs[n]) & newmask
+                    while newlabels[slot] != 0:
+                        slot = (slot + 1) & newmask
+                    newlabels[slot] = self.labels[n]
+                    newvecs[slot] = self.vecs[n]
+            free(self.vecs)
+            free(self.labels)
+            self.vecs, self.labels, self.mask = newvecs, newlabels, newmask
+        return 0
+
+    cdef bint contains(self, uint32_t label, uint64_t vec) nogil:
+        """Test whether a coarse item is in the table."""
+        cdef uint64_t slot = whitelisthash(label, vec) & self.mask
+        while self.labels[slot] != 0:
+            if self.labels[slot] == label and self.vecs[slot] == vec:
+                return True
+            slot = (slot + 1) & self.mask
+        return False
+
+    cdef bint check(self, uint32_t label, uint64_t vec):
+        """Test whether an item of the fine grammar is whitelisted."""
+        cdef uint32_t coarse = self.fine.mapping[label]
+        cdef uint32_t * components = NULL
+        cdef int a, b, n = 0
+        if self.splitprune and self.markorigin and self.fine.fanout[label] != 1:
+            components = self.fine.splitmapping[label]
+            if components is NULL:
+                return True
+        elif coarse == 0:
+            return True
+        elif not self.splitprune:
+            return self.contains(coarse, vec)
+        # look up each component of a discontinuous item separately
+        a = nextset(vec, 0)
+        while a != -1:
+            b = nextunset(vec, a)
+            # given a=3, b=6, make bitvector: 1000000 - 1000 = 111000
+            if not self.contains(coarse if components is NULL
+                                 else components[n], (1UL << b) - (1UL << a)):
+                return False
+            a = nextset(vec, b)
+            n += 1
+        return True
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, SmallChartItem item):
+        return self.check(item.label, item.vec)
+
+    def __iter__(self):
+        """Yield the coarse items as tuples ``(label, vec)``."""
+        cdef uint64_t n
+        for n in range(self.mask + 1):
+            if self.labels[n] != 0:
+                yield self.labels[n], self.vecs[n]
+
+
+cdef inline uint64_t whitelisthash(uint32_t label, uint64_t vec) nogil:
+    """Hash function for the coarse items of an LCFRSWhitelist."""
+    cdef uint64_t result = (vec ^ (<uint64_t>label << 40) ^ label
+                            ) * 0x9E3779B97F4A7C15UL
+    return result ^ (result >> 29)
+
+
 def numedges(Edges edges):
     cdef MoreEdges * edgelist
     cdef size_t result
@@ -1061,4 +1188,4 @@ cdef inline void releasebuf(Py_buffer * buf):
 
 __all__ = ['Grammar', 'Chart', 'Ctrees', 'LexicalRule', 'SmallChartItem',
            'FatChartItem', 'Edges', 'RankedEdge', 'Vocabulary', 'FixedVocabulary',
-           'numedges']
+           'LCFRSWhitelist', 'numedges']
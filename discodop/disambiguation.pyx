@@ -10,12 +10,13 @@ from __future__ import print_function
 import re
 from heapq import nlargest
 from math import exp, log, isinf, fsum
-from random import random
+from random import getrandbits
 from bisect import bisect_right
 from operator import itemgetter, attrgetter
 from itertools import count
 from functools import partial
 from collections import defaultdict
+import numpy as np
 from . import plcfrs, _fragments
 from .tree import Tree, writediscbrackettree
 from .kbest import lazykbest, getderiv
@@ -23,9 +24,12 @@ from .grammar import lcfrsproductions
 from .treetransforms import addbitsets, unbinarize, canonicalize, \
     collapseunary, mergediscnodes, binarize
 from .bit import pyintnextset, pyintbitcount
-from libc.stdint cimport uint8_t, uint32_t, uint64_t, intptr_t
+from .coarsetofine import topologicalorder, getinside, getoutside
+from libc.stdint cimport uint8_t, int32_t, uint32_t, uint64_t
+from libc.stdlib cimport malloc, free
+from libc.math cimport exp as cexp, log as clog, INFINITY
 from .bit cimport abitcount
-from .plcfrs cimport DoubleEntry, new_DoubleEntry
+from .plcfrs cimport DoubleEntry, DoubleAgenda, new_DoubleEntry
 from .containers cimport Grammar, ProbRule, LexicalRule, Chart, Edges, \
     MoreEdges, SmallChartItem, FatChartItem, Edge, RankedEdge, \
     new_RankedEdge, logprobadd, logprobsum, yieldranges
@@ -42,6 +46,8 @@ include "constants.pxi"
 
 REMOVEIDS = re.compile('@[-0-9]+')
 REMOVEWORDTAGS = re.compile('@[^ )]+')
+TEMPLATESLOTS = re.compile(r'\{([0-9]+)\}')
+TEMPLATETOKENS = re.compile(r'\(([^ ()]+)|\)')
 cdef str NONCONSTLABEL = ''
 cdef str NEGATIVECONSTLABEL = '-#-'
 
@@ -96,6 +102,9 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
             :'sl-dop': Simplicity-Likelihood DOP; select most likely parse from the
                     ``sldop_n`` parse trees with the shortest derivations.
             :'sl-dop-simple': Approximation of Simplicity-Likelihood DOP
+            :'max-rule-product', 'variational': decode using posterior
+                    probabilities of rules in the parse forest; does not use
+                    ``derivations`` and ``entries``, cf. ``maxrule()``.
     :param backtransform:
             Dependending on the value of this parameter, one of two ways is
             employed to turn derivations into parse trees:
@@ -106,7 +115,8 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
                     coincide with parse trees.
             :list of strings: assume Double-DOP and recover derivations by
                     substituting fragments in this list for flattened rules in
-                    derivations.
+                    derivations; the templates may be compiled with
+                    :func:`compilebacktransform`.
     :param k: when ``method='sl-dop``, number of derivations to consider.
     :param bitpar: whether bitpar was used in nbest mode.
     :returns:
@@ -124,8 +134,11 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
     cdef bint dopreduction = backtransform is None
     cdef DoubleEntry entry
     cdef LexicalRule lexrule
+    cdef TreeNodes nodes = TreeNodes(chart, backtransform,
+                                     '@1' if mpd or shortest else '')
     cdef dict parsetrees = {}, derivs = {}
-    cdef str treestr, deriv
+    cdef str deriv
+    cdef object treestr  # a tree ID, or a string with bitpar
     cdef double prob, maxprob
     cdef int m
 
@@ -147,12 +160,14 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
     elif method == 'mcc':
         return maxconstituentscorrect(derivations, chart,
                                       backtransform, mcc_labda, mcc_labels)
+    elif method in ('max-rule-product', 'variational'):
+        return maxrule(method, chart, backtransform)
 
     if not dopreduction and not bitpar:  # Double-DOP
         for entry in entries:
             prob = entry.value
             try:
-                treestr = recoverfragments(entry.key, chart, backtransform)
+                treestr = nodes.recover(entry.key)
             except:
                 continue
             if shortest:
@@ -171,7 +186,9 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
                 derivs[treestr] = entry.key
     else:  # DOP reduction / bitpar
         for (deriv, prob), entry in zip(derivations, entries):
-            if dopreduction:
+            if dopreduction and not bitpar:
+                treestr = nodes.recoverdopreduction(entry.key)
+            elif dopreduction:
                 treestr = REMOVEIDS.sub('@1' if mpd or shortest else '', deriv)
             else:
                 try:
@@ -217,20 +234,22 @@ cpdef marginalize(method, list derivations, list entries, Chart chart,
             elif treestr in parsetrees and (dopreduction or not mpd):
                 parsetrees[treestr].append(-prob)
 
+    # only now produce strings, once for each distinct parse tree
     if mpd and dopreduction:
-        results = [(REMOVEIDS.sub('', treestr), logprobsum(probs),
+        results = [(REMOVEIDS.sub('', nodes.tostring(treestr)),
+                    logprobsum(probs),
                     fragmentsinderiv(derivs[treestr], chart, backtransform))
                    for treestr, probs in parsetrees.items()]
     elif shortest and dopreduction:
-        results = [(REMOVEIDS.sub('', treestr), (-a, b),
+        results = [(REMOVEIDS.sub('', nodes.tostring(treestr)), (-a, b),
                     fragmentsinderiv(derivs[treestr], chart, backtransform))
                    for treestr, (a, b) in parsetrees.items()]
     elif shortest:
-        results = [(treestr, (-a, b),
+        results = [(nodes.tostring(treestr), (-a, b),
                     fragmentsinderiv(derivs[treestr], chart, backtransform))
                    for treestr, (a, b) in parsetrees.items()]
     else:
-        results = [(treestr, logprobsum(probs),
+        results = [(nodes.tostring(treestr), logprobsum(probs),
                     fragmentsinderiv(derivs[treestr], chart, backtransform))
                    for treestr, probs in parsetrees.items()]
 
@@ -355,6 +374,152 @@ def gettree(cells, span):
                            gettree(cells, leftspan), gettree(cells, rightspan))
 
 
+cdef maxrule(str method, Chart chart, list backtransform):
+    """Find the parse tree with the best product of rule scores.
+
+    Rule scores are obtained from posterior probabilities of edges in the
+    parse forest, computed with the inside-outside algorithm. Labels are
+    projected by removing the IDs of a DOP reduction; posteriors of edges
+    that become identical in this projection are summed.
+
+    :param method:
+            :'max-rule-product': the score of a rule is its posterior
+                    probability (Petrov & Klein 2007).
+            :'variational': the score of a rule is its posterior divided by
+                    the posterior of its parent, i.e., its conditional
+                    probability (Matsuzaki et al. 2005).
+
+    The cost depends on the size of the parse forest, not on the number of
+    derivations; no derivations need to be extracted."""
+    cdef double[:] inside, outside
+    cdef list order
+    cdef double sentprob, outsideprob, prob, score
+    cdef bint variational = method == 'variational'
+    cdef bint logprob = chart.grammar.logprob
+    cdef Edges edges
+    cdef MoreEdges * edgelist
+    cdef Edge * edge
+    cdef DoubleAgenda agenda
+    cdef size_t n
+    cdef dict labels = {}, projected = {}  # caches for projectitem()
+    cdef dict rules = {}  # rules[parent][children] = posterior
+    cdef dict posterior = {}  # posterior[item] = posterior
+    cdef dict spans = {}  # spans[span] = [item1, item2, ...]
+    cdef dict best = {}  # best[item] = (score, children)
+    cdef dict backptr, unaries
+    if backtransform is not None:
+        raise ValueError('%s requires a DOP reduction or a grammar '
+                         'without fragments.' % method)
+    # rule probabilities are converted on the fly; switching the grammar
+    # would rewrite all its rules for every sentence.
+    order = topologicalorder(chart)
+    getinside(chart, order)
+    getoutside(chart, order)
+    inside, outside = chart.inside, chart.outside
+    sentprob = inside[chart.itemid(chart.root())]
+    if not sentprob:
+        return [], '%s failed; sentence has zero posterior prob.' % method
+    # collect posteriors of projected rules
+    for item in order:
+        pitem = projectitem(chart, item, labels, projected)
+        outsideprob = outside[chart.itemid(item)] / sentprob
+        if pitem not in rules:
+            rules[pitem] = {}
+            posterior[pitem] = 0.0
+            spans.setdefault(pitem[1], []).append(pitem)
+        posterior[pitem] += inside[chart.itemid(item)] * outsideprob
+        cell = rules[pitem]
+        edges = chart.getedges(item)
+        edgelist = edges.head if edges is not None else NULL
+        while edgelist is not NULL:
+            for n in range(edges.len if edgelist is edges.head
+                           else EDGES_SIZE):
+                edge = &(edgelist.data[n])
+                if edge.rule is NULL:  # terminal index
+                    children = chart.lexidx(edge)
+                    prob = chart.lexprob(item, edge)
+                    if logprob:
+                        prob = cexp(-prob)
+                    prob *= outsideprob
+                elif edge.rule.rhs2 == 0:
+                    left = chart._left(item, edge)
+                    children = (projectitem(chart, left, labels, projected), )
+                    prob = cexp(-edge.rule.prob) if logprob else edge.rule.prob
+                    prob *= inside[chart.itemid(left)] * outsideprob
+                else:
+                    left = chart._left(item, edge)
+                    right = chart._right(item, edge)
+                    children = (projectitem(chart, left, labels, projected),
+                                projectitem(chart, right, labels, projected))
+                    prob = cexp(-edge.rule.prob) if logprob else edge.rule.prob
+                    prob *= (inside[chart.itemid(left)]
+                             * inside[chart.itemid(right)] * outsideprob)
+                cell[children] = cell.get(children, 0.0) + prob
+            edgelist = edgelist.prev
+
+    # viterbi search over projected items, smallest spans first;
+    # scores are negative log probabilities.
+    for span in sorted(spans, key=pyintbitcount):
+        agenda = DoubleAgenda()
+        backptr = {}
+        unaries = {}  # unaries[child] = [(parent, score), ...]
+        for pitem in spans[span]:
+            for children, prob in (<dict>rules[pitem]).items():
+                score = -clog(prob / posterior[pitem] if variational
+                              else prob)
+                if isinstance(children, tuple) and len(children) == 1:
+                    if children[0] != pitem:
+                        unaries.setdefault(children[0], []).append(
+                            (pitem, children, score))
+                    continue
+                elif isinstance(children, tuple):
+                    if children[0] not in best or children[1] not in best:
+                        continue
+                    score += best[children[0]][0] + best[children[1]][0]
+                if pitem not in agenda or score < agenda[pitem]:
+                    agenda[pitem] = score
+                    backptr[pitem] = children
+        # unary rules; scores of rules are at most 1, so the first time an
+        # item is popped its score is optimal.
+        while agenda:
+            pitem, score = agenda.popitem()
+            best[pitem] = (score, backptr[pitem])
+            for parent, children, prob in unaries.get(pitem, ()):
+                if parent not in best and (parent not in agenda
+                                           or score + prob < agenda[parent]):
+                    agenda[parent] = score + prob
+                    backptr[parent] = children
+    pitem = projectitem(chart, chart.root(), labels, projected)
+    if pitem not in best or isinf(best[pitem][0]):
+        return [], '%s failed. sentprob: %g' % (method, sentprob)
+    return [(maxruletree(best, pitem), exp(-best[pitem][0]), None)], (
+            'sentprob: %g' % sentprob)
+
+
+cdef tuple projectitem(Chart chart, item, dict labels, dict projected):
+    """Return tuple ``(label, span)`` for a chart item.
+
+    IDs of a DOP reduction are removed from the label; span is a bitset."""
+    cdef uint32_t label
+    if item in projected:
+        return projected[item]
+    label = chart.label(item)
+    if label not in labels:
+        labels[label] = REMOVEIDS.sub('', chart.grammar.tolabel[label])
+    result = projected[item] = (labels[label],
+                                sum([1 << n for n in chart.indices(item)]))
+    return result
+
+
+cdef str maxruletree(dict best, tuple pitem):
+    """Produce tree from backpointers of ``maxrule()``."""
+    children = best[pitem][1]
+    if isinstance(children, tuple):
+        return '(%s %s)' % (pitem[0], ' '.join(
+            [maxruletree(best, child) for child in children]))
+    return '(%s %d)' % (pitem[0], children)
+
+
 cdef sldop(dict derivations, Chart chart, list sent, list tags,
            int m, int sldop_n, list backtransform, entries, bint bitpar):
     """'Proper' method for sl-dop.
@@ -479,8 +644,9 @@ cpdef str recoverfragments(deriv, Chart chart, list backtransform):
     """Reconstruct a DOP derivation from a derivation with flattened fragments.
 
     :param deriv: a RankedEdge or a string representing a derivation.
-    :param backtransform: a list with fragments (as string templates)
-            corresponding to grammar rules.
+    :param backtransform: a list with fragments (as string templates, or
+            compiled with :func:`compilebacktransform`) corresponding to
+            grammar rules.
     :returns: expanded derivation as a string.
 
     The flattened fragments in the derivation should be left-binarized, expect
@@ -493,21 +659,24 @@ cpdef str recoverfragments(deriv, Chart chart, list backtransform):
     (containing the string '}<'). Note that this means getmapping() has to have
     been called on `chart.grammar`, even when not doing coarse-to-fine
     parsing."""
+    cdef list result = []
     if isinstance(deriv, RankedEdge):
-        result = recoverfragments_(deriv, chart, backtransform)
+        recoverfragments_(deriv, chart, backtransform, result)
     elif isinstance(deriv, str):
         deriv = Tree(deriv)
-        result = recoverfragments_str(deriv, chart, backtransform)
+        recoverfragments_str(deriv, chart, backtransform, result)
     else:
         raise ValueError('derivation has unexpected type %r.' % type(deriv))
-    return REMOVEWORDTAGS.sub('', result)
+    return REMOVEWORDTAGS.sub('', ''.join(result))
 
 
-cdef str recoverfragments_(RankedEdge deriv, Chart chart,
-                           list backtransform):
+cdef recoverfragments_(RankedEdge deriv, Chart chart,
+                       list backtransform, list result):
     cdef RankedEdge child
     cdef list children = []
-    cdef str frag = backtransform[deriv.edge.rule.no]  # template
+    cdef tuple template = gettemplate(backtransform, deriv.edge.rule.no)
+    cdef tuple segments = template[0], slots = template[1]
+    cdef int n
     # NB: this is the only code that uses the .head field of RankedEdge
 
     # collect all children w/on the fly left-factored debinarization
@@ -533,36 +702,28 @@ cdef str recoverfragments_(RankedEdge deriv, Chart chart,
     children.append((< DoubleEntry > chart.rankededges[
                     chart.left(deriv)][deriv.left]).key)
 
-    # recursively expand all substitution sites
-    children = ['(%s %d)' % (chart.grammar.tolabel[chart.label(child.head)],
-                             chart.lexidx(child.edge)) if child.edge.rule is NULL
-                else recoverfragments_(child, chart, backtransform)
-                for child in reversed(children)]
-
-    # substitute results in template
-    return frag.format(*children)
-
-    # even better: build result incrementally; use a list of strings
-    # extended in recursive calls w/strings from backtransform.
-    # step 1: collect RankedEdges in a list (children);
-    # 		i.e., exctract nodes from binarized constituent.
-    # step 2: iterate over parts of template, alternately adding string from it
-    # 		and making a recursive call to insert the relevant child RankedEdge
-    # new backtransform format:
-    # backtransform[prod] = (list_of_strs, list_of_idx)
-    # backtransform[34] = (['(NP (DT ', ') (NN ', '))'], [0, 1])
-    # alternatively: (better locality?)
-    # frag = backtransform[34] = ['(NP (DT ', 0, ') (NN ', 1, '))']
-    # result += frag[0]
-    # for n in range(1, len(result), 2):
-    # 	foo(result, children[frag[n]])
-    # 	result += frag[n + 1]
-
-
-cdef str recoverfragments_str(deriv, Chart chart, list backtransform):
+    children.reverse()
+    # alternately add literal parts of the template and expand the
+    # substitution site in the next slot.
+    result.append(segments[0])
+    for n in range(len(slots)):
+        child = children[slots[n]]
+        if child.edge.rule is NULL:
+            result.append('(%s %d)' % (
+                chart.grammar.tolabel[chart.label(child.head)],
+                chart.lexidx(child.edge)))
+        else:
+            recoverfragments_(child, chart, backtransform, result)
+        result.append(segments[n + 1])
+
+
+cdef recoverfragments_str(deriv, Chart chart, list backtransform,
+                          list result):
     cdef list children = []
-    cdef str frag
-    frag = backtransform[chart.grammar.rulenos[nodeprod(deriv)]]
+    cdef tuple template = gettemplate(
+        backtransform, chart.grammar.rulenos[nodeprod(deriv)])
+    cdef tuple segments = template[0], slots = template[1]
+    cdef int n
     # collect children w/on the fly left-factored debinarization
     if len(deriv) >= 2:  # is there a right child?
         # keep going while left child is part of same binarized constituent
@@ -580,14 +741,222 @@ cdef str recoverfragments_str(deriv, Chart chart, list backtransform):
     # left-most child
     children.append(deriv[0])
 
-    # recursively expand all substitution sites
-    children = [recoverfragments_str(child, chart, backtransform)
-                if isinstance(child[0], Tree)
-                else ('(%s %d)' % (child.label, child[0]))
-                for child in reversed(children)]
-
-    # substitute results in template
-    return frag.format(*children)
+    children.reverse()
+    result.append(segments[0])
+    for n in range(len(slots)):
+        child = children[slots[n]]
+        if isinstance(child[0], Tree):
+            recoverfragments_str(child, chart, backtransform, result)
+        else:
+            result.append('(%s %d)' % (child.label, child[0]))
+        result.append(segments[n + 1])
+
+
+def compilebacktransform(backtransform):
+    """Compile backtransform templates into literal segments and slots.
+
+    A template is compiled into a tuple ``(segments, slots, tree)``; the tree
+    for a fragment is obtained by interleaving the segments with the
+    expansions of the children referred to in ``slots``. ``tree`` is the
+    fragment as nested tuples, as used by :class:`TreeNodes`. Compiled
+    templates are left as is.
+
+    >>> compilebacktransform(['(NP (DT {0}) {1})'])
+    [(('(NP (DT ', ') ', ')'), (0, 1), ('NP', (('DT', (0,)), 1)))]"""
+    return [compiletemplate(frag) if isinstance(frag, str) else frag
+            for frag in backtransform]
+
+
+cdef tuple compiletemplate(str frag):
+    """Compile a single backtransform template; cf. compilebacktransform."""
+    cdef list parts = TEMPLATESLOTS.split(frag)
+    cdef tuple segments = tuple(parts[::2])
+    cdef tuple slots = tuple([int(a) for a in parts[1::2]])
+    return segments, slots, parsetemplate(segments, slots)
+
+
+cdef str expandtemplate(tuple template, list children):
+    """Substitute strings in ``children`` in a compiled template."""
+    cdef tuple segments = template[0], slots = template[1]
+    cdef list result = [segments[0]]
+    cdef int n
+    for n in range(len(slots)):
+        result.append(children[slots[n]])
+        result.append(segments[n + 1])
+    return ''.join(result)
+
+
+cdef inline tuple gettemplate(list backtransform, int n):
+    """Return compiled template for rule ``n``; compile it if necessary."""
+    frag = backtransform[n]
+    if isinstance(frag, str):
+        return compiletemplate(frag)
+    return frag
+
+
+cdef class TreeNodes:
+    """Recover parse trees from derivations as hash-consed tree nodes.
+
+    Every distinct (sub)tree gets an integer ID, such that derivations of the
+    same parse tree are recovered as the same ID without building strings.
+    A node is a tuple ``(label, children)`` where ``children`` is a tuple of
+    node IDs, or ``(label, idx)`` for a preterminal with terminal index
+    ``idx``. Sub-derivations shared between derivations are recovered only
+    once, since ``RankedEdge`` objects in ``chart.rankededges`` are
+    shared."""
+    cdef Chart chart
+    cdef list backtransform
+    cdef list nodes  # node ID => node
+    cdef dict ids  # node => node ID
+    cdef dict memo  # RankedEdge => node ID
+    cdef dict labels  # label ID => label with annotations removed
+    cdef str idrepl
+
+    def __init__(self, Chart chart, list backtransform=None, str idrepl=''):
+        """Create an empty table of nodes for the derivations of a chart.
+
+        :param idrepl: with DOP reduction, replace ``@123`` IDs in labels
+                with this string."""
+        self.chart = chart
+        self.backtransform = backtransform
+        self.idrepl = idrepl
+        self.nodes = []
+        self.ids = {}
+        self.memo = {}
+        self.labels = {}
+
+    cdef int intern(self, tuple node) except -1:
+        """Return the ID of node, adding it if it is new."""
+        result = self.ids.get(node)
+        if result is None:
+            result = self.ids[node] = len(self.nodes)
+            self.nodes.append(node)
+        return result
+
+    cdef str label(self, RankedEdge deriv, object pattern, str repl):
+        """Return label of ``deriv.head`` with annotations removed."""
+        cdef uint32_t labelid = self.chart.label(deriv.head)
+        result = self.labels.get(labelid)
+        if result is None:
+            result = self.labels[labelid] = pattern.sub(
+                repl, self.chart.grammar.tolabel[labelid])
+        return result
+
+    cpdef int recover(self, RankedEdge deriv) except -1:
+        """Recover the ID of the tree for a Double-DOP derivation.
+
+        The derivation has flattened fragments; cf. :func:`recoverfragments`.
+        """
+        cdef RankedEdge child
+        cdef list children = [], slots = []
+        cdef Chart chart = self.chart
+        cdef RankedEdge key = deriv
+        cdef tuple template
+        result = self.memo.get(key)
+        if result is not None:
+            return result
+        template = gettemplate(self.backtransform, deriv.edge.rule.no)
+        # collect all children w/on the fly left-factored debinarization
+        if deriv.edge.rule.rhs2:  # is there a right child?
+            # keep going while left child is part of same binarized
+            # constituent.
+            while chart.grammar.mapping[deriv.edge.rule.rhs1] == 0:
+                # one of the right children
+                children.append((< DoubleEntry > chart.rankededges[
+                                chart.right(deriv)][deriv.right]).key)
+                # move on to next node in this binarized constituent
+                deriv = (< DoubleEntry > chart.rankededges[
+                    chart.left(deriv)][deriv.left]).key
+            # last right child
+            if deriv.edge.rule.rhs2:  # is there a right child?
+                children.append((< DoubleEntry > chart.rankededges[
+                                chart.right(deriv)][deriv.right]).key)
+        elif chart.grammar.mapping[deriv.edge.rule.rhs1] == 0:
+            deriv = (< DoubleEntry > chart.rankededges[
+                chart.left(deriv)][deriv.left]).key
+        # left-most child
+        children.append((< DoubleEntry > chart.rankededges[
+                        chart.left(deriv)][deriv.left]).key)
+        # recursively recover all substitution sites
+        for child in reversed(children):
+            slots.append(self.intern((self.label(
+                child, REMOVEWORDTAGS, ''), chart.lexidx(child.edge)))
+                if child.edge.rule is NULL else self.recover(child))
+        result = self.memo[key] = self.instantiate(template[2], slots)
+        return result
+
+    cdef int instantiate(self, tuple node, list slots) except -1:
+        """Substitute the tree IDs in ``slots`` in a parsed template."""
+        return self.intern((node[0], tuple([
+            slots[child] if isinstance(child, int)
+            else self.instantiate(child, slots)
+            for child in node[1]])))
+
+    cpdef int recoverdopreduction(self, RankedEdge deriv) except -1:
+        """Recover the ID of the tree for a DOP reduction derivation.
+
+        The IDs of fragment-internal nodes are replaced."""
+        cdef Chart chart = self.chart
+        result = self.memo.get(deriv)
+        if result is not None:
+            return result
+        if deriv.edge.rule is NULL:  # lexical rule, left child is terminal
+            result = self.intern((self.label(deriv, REMOVEIDS, self.idrepl),
+                                  chart.lexidx(deriv.edge)))
+        elif deriv.edge.rule.rhs2:
+            result = self.intern((self.label(deriv, REMOVEIDS, self.idrepl), (
+                self.recoverdopreduction((< DoubleEntry > chart.rankededges[
+                    chart.left(deriv)][deriv.left]).key),
+                self.recoverdopreduction((< DoubleEntry > chart.rankededges[
+                    chart.right(deriv)][deriv.right]).key))))
+        else:
+            result = self.intern((self.label(deriv, REMOVEIDS, self.idrepl), (
+                self.recoverdopreduction((< DoubleEntry > chart.rankededges[
+                    chart.left(deriv)][deriv.left]).key), )))
+        self.memo[deriv] = result
+        return result
+
+    def tostring(self, treeid):
+        """Return tree with given ID as string in bracket notation.
+
+        A string is returned as is."""
+        if isinstance(treeid, str):
+            return treeid
+        result = []
+        self._tostring(treeid, result)
+        return ''.join(result)
+
+    cdef _tostring(self, int treeid, list result):
+        cdef tuple node = self.nodes[treeid]
+        result.append('(')
+        result.append(node[0])
+        if isinstance(node[1], int):
+            result.append(' %d)' % node[1])
+            return
+        for child in node[1]:
+            result.append(' ')
+            self._tostring(child, result)
+        result.append(')')
+
+
+cdef tuple parsetemplate(tuple segments, tuple slots):
+    """Parse the segments and slots of a template into nested tuples.
+
+    For example, the segments ``('(NP ', ' (NP|<l:n;n> ', ' ', '))')`` and
+    slots ``(0, 2, 1)`` of the template ``'(NP {0} (NP|<l:n;n> {2} {1}))'``
+    become ``('NP', (0, ('NP|<l:n;n>', (2, 1))))``."""
+    cdef list stack = [(None, [])]
+    cdef int n
+    for n, segment in enumerate(segments):
+        for match in TEMPLATETOKENS.finditer(segment):
+            if match.group(1) is not None:  # opening paren + label
+                stack.append((REMOVEWORDTAGS.sub('', match.group(1)), []))
+            else:  # closing paren
+                label, children = stack.pop()
+                stack[len(stack) - 1][1].append((label, tuple(children)))
+        if n < len(slots):  # substitution site
+            stack[len(stack) - 1][1].append(slots[n])
+    return stack[0][1][0]
 
 
 def fragmentsinderiv(deriv, chart, list backtransform):
@@ -617,7 +986,7 @@ cdef fragmentsinderiv_(RankedEdge deriv, Chart chart,
                        list backtransform, list result):
     cdef RankedEdge child
     cdef list children = []
-    cdef str frag = backtransform[deriv.edge.rule.no]  # template
+    cdef tuple template = gettemplate(backtransform, deriv.edge.rule.no)
 
     # collect all children w/on the fly left-factored debinarization
     if deriv.edge.rule.rhs2:  # is there a right child?
@@ -642,7 +1011,7 @@ cdef fragmentsinderiv_(RankedEdge deriv, Chart chart,
     children.append((< DoubleEntry > chart.rankededges[
                     chart.left(deriv)][deriv.left]).key)
 
-    result.append(frag.format(*['(%s %s)' % (
+    result.append(expandtemplate(template, ['(%s %s)' % (
         chart.grammar.tolabel[chart.label(deriv.head)].split('@')[0],
         ('%d=%s' % (chart.lexidx(deriv.edge),
                     chart.sent[chart.lexidx(deriv.edge)])
@@ -662,8 +1031,8 @@ cdef fragmentsinderiv_(RankedEdge deriv, Chart chart,
 
 cdef fragmentsinderiv_str(deriv, Chart chart, list backtransform, list result):
     cdef list children = []
-    cdef str frag
-    frag = backtransform[chart.grammar.rulenos[nodeprod(deriv)]]
+    cdef tuple template = gettemplate(
+        backtransform, chart.grammar.rulenos[nodeprod(deriv)])
     # collect children w/on the fly left-factored debinarization
     if len(deriv) >= 2:  # is there a right child?
         # keep going while left child is part of same binarized constituent
@@ -681,7 +1050,7 @@ cdef fragmentsinderiv_str(deriv, Chart chart, list backtransform, list result):
     # left-most child
     children.append(deriv[0])
 
-    result.append(frag.format(*['(%s %s)' % (
+    result.append(expandtemplate(template, ['(%s %s)' % (
         child.label.split('@')[0],
         ('%d=%s' % (child[0], chart.sent[child[0]]) if '@' in child.label
          else yieldranges(sorted(child.leaves()))))
@@ -812,99 +1181,269 @@ cpdef viterbiderivation(Chart chart):
 
 
 def getsamples(Chart chart, k, debin=None):
-    """Samples *k* derivations from a chart."""
-    cdef dict tables = {}
-    cdef Edge * edge
-    cdef Edges edges
-    cdef MoreEdges * edgelist
-    cdef double prob, prev
-    cdef size_t n
-    chartidx = {}
-    for item in chart.getitems():
-        chartidx[item] = []
-        edges = chart.getedges(item)
-        edgelist = edges.head if edges is not None else NULL
-        while edgelist is not NULL:
-            for n in range(edges.len if edgelist is edges.head
-                           else EDGES_SIZE):
-                edge = &(edgelist.data[n])
-                # HACK: store pointer to edge as Python int
-                if edge.rule is NULL:
-                    chartidx[item].append(
-                        (chart.subtreeprob(item), < intptr_t > edge))
-                else:
-                    prob = edge.rule.prob
-                    # FIXME: work w/inside prob?
-                    # prob += chart.subtreeprob(chart._left(item, edge))
-                    # if edge.rule.rhs2:
-                    # 	prob += chart.subtreeprob(chart._right(item, edge))
-                    chartidx[item].append((prob, < intptr_t > edge))
-            edgelist = edgelist.prev
-        # sort edges so that highest prob (=lowest neglogprob) comes first
-        chartidx[item].sort()
-    for item in chartidx:
-        tables[item] = []
-        prev = 0.0
-        for prob, _ in chartidx[item]:
-            prev += exp(-prob)
-            tables[item].append(prev)
-    result = []
-    for _ in range(k):
-        result.append(samplechart(
-            chart.root(), chart, chartidx, tables, debin))
-    return result
+    """Samples *k* derivations from a chart.
 
+    :returns: a list of tuples ``(deriv, prob)``; cf.
+            :py:meth:`DerivationSampler.sample`."""
+    return DerivationSampler(chart).sample(k, debin)
 
-cdef samplechart(item, Chart chart,
-                 dict chartidx, dict tables, str debin):
-    """Samples a derivation from a chart."""
-    cdef Edge * edge
-    cdef RankedEdge rankededge
-    cdef double prob
-    cdef list lst = tables[item]
-    rnd = random() * lst[len(lst) - 1]
-    idx = bisect_right(lst, rnd)
-    _, ptr = chartidx[item][idx]
-    edge = <Edge * > < intptr_t > ptr  # hack: convert Python int into pointer
-    label = chart.label(item)
-    if edge.rule is NULL:  # terminal
-        idx = chart.lexidx(edge)
-        rankededge = new_RankedEdge(item, edge, -1, -1)
+
+cdef class DerivationSampler:
+    """Sample derivations from a chart in proportion to their probability.
+
+    Each edge of an item is weighted by its rule probability times the inside
+    probabilities of the items it points to. For each item, a Walker/Vose
+    alias table over these weights is stored in arrays indexed by the number
+    of the item in topological order, so that sampling an edge takes constant
+    time. The tables are built once and can be used for any number of
+    samples; random numbers are drawn in batches, from a generator seeded
+    with the ``random`` module, such that ``random.seed()`` makes the
+    samples reproducible.
+
+    >>> sampler = DerivationSampler(chart)  # doctest: +SKIP
+    >>> derivations = sampler.sample(1000)  # doctest: +SKIP
+    """
+    cdef Chart chart
+    cdef list items  # item number => item; children precede their parents
+    cdef uint32_t numitems
+    cdef uint32_t * offsets  # item number => index of its first edge
+    cdef Edge ** edges
+    cdef int32_t * left  # edge => item number of left child, or -1
+    cdef int32_t * right  # edge => item number of right child, or -1
+    cdef double * threshold  # edge => probability of choosing it over alias
+    cdef uint32_t * alias  # edge => alternative edge
+    cdef double * inside  # item number => inside probability as -log p
+    cdef object rng  # numpy RandomState
+    cdef double[:] rnd  # batch of uniform random numbers
+    cdef size_t rndidx
+
+    def __cinit__(self):
+        self.offsets = self.alias = NULL
+        self.edges = NULL
+        self.left = self.right = NULL
+        self.threshold = self.inside = NULL
+
+    def __init__(self, Chart chart):
+        cdef dict itemnums = {}
+        cdef Edges edges
+        cdef MoreEdges * edgelist
+        cdef Edge * edge
+        cdef double prob
+        cdef size_t n, m, idx, numedges = 0
+        if not chart:
+            raise ValueError('chart has no root item.')
+        self.chart = chart
+        self.items = topologicalorder(chart)
+        self.numitems = len(self.items)
+        self.offsets = <uint32_t *>malloc(
+            (self.numitems + 1) * sizeof(uint32_t))
+        self.inside = <double *>malloc(self.numitems * sizeof(double))
+        if self.offsets is NULL or self.inside is NULL:
+            raise MemoryError('allocation error')
+        for m, item in enumerate(self.items):
+            itemnums[item] = m
+            self.offsets[m] = numedges
+            # items in unary cycles may be referred to before their inside
+            # probability is known; such edges get zero probability.
+            self.inside[m] = INFINITY
+            edges = chart.getedges(item)
+            edgelist = edges.head if edges is not None else NULL
+            while edgelist is not NULL:
+                numedges += (edges.len if edgelist is edges.head
+                             else EDGES_SIZE)
+                edgelist = edgelist.prev
+        self.offsets[self.numitems] = numedges
+        self.edges = <Edge **>malloc(numedges * sizeof(Edge *))
+        self.left = <int32_t *>malloc(numedges * sizeof(int32_t))
+        self.right = <int32_t *>malloc(numedges * sizeof(int32_t))
+        self.threshold = <double *>malloc(numedges * sizeof(double))
+        self.alias = <uint32_t *>malloc(numedges * sizeof(uint32_t))
+        if (self.edges is NULL or self.left is NULL or self.right is NULL
+                or self.threshold is NULL or self.alias is NULL):
+            raise MemoryError('allocation error')
+        for m, item in enumerate(self.items):
+            n = self.offsets[m]
+            edges = chart.getedges(item)
+            edgelist = edges.head if edges is not None else NULL
+            while edgelist is not NULL:
+                for idx in range(edges.len if edgelist is edges.head
+                                 else EDGES_SIZE):
+                    edge = &(edgelist.data[idx])
+                    self.edges[n] = edge
+                    self.left[n] = self.right[n] = -1
+                    if edge.rule is NULL:
+                        prob = chart.subtreeprob(item)
+                    else:
+                        self.left[n] = itemnums[chart._left(item, edge)]
+                        prob = edge.rule.prob + self.inside[self.left[n]]
+                        if edge.rule.rhs2:
+                            self.right[n] = itemnums[
+                                chart._right(item, edge)]
+                            prob += self.inside[self.right[n]]
+                    # temporarily store weight of edge as -log p
+                    self.threshold[n] = prob
+                    n += 1
+                edgelist = edgelist.prev
+            self.inside[m] = self.buildtable(m)
+        self.rng = np.random.RandomState(getrandbits(32))
+        self.rnd = self.rng.random_sample(RANDOMBATCH)
+        self.rndidx = 0
+
+    def __dealloc__(self):
+        free(self.offsets)
+        free(self.edges)
+        free(self.left)
+        free(self.right)
+        free(self.threshold)
+        free(self.alias)
+        free(self.inside)
+
+    cdef double buildtable(self, uint32_t m) except? -1:
+        """Replace the weights of the edges of item ``m`` with an alias table.
+
+        Uses Vose's method; returns the inside probability as -log p."""
+        cdef uint32_t start = self.offsets[m], end = self.offsets[m + 1]
+        cdef uint32_t cnt = end - start, n, s, l
+        cdef uint32_t numsmall = 0, numlarge = 0
+        cdef uint32_t * small
+        cdef uint32_t * large
+        cdef double minprob = INFINITY, total = 0
+        if cnt == 0:
+            return INFINITY
+        for n in range(start, end):
+            minprob = min(minprob, self.threshold[n])
+        if minprob == INFINITY:  # all edges have zero probability
+            for n in range(start, end):
+                self.threshold[n] = 1.0
+                self.alias[n] = n
+            return INFINITY
+        # scale by largest probability to avoid underflow
+        for n in range(start, end):
+            self.threshold[n] = cexp(minprob - self.threshold[n])
+            total += self.threshold[n]
+        small = <uint32_t *>malloc(2 * cnt * sizeof(uint32_t))
+        if small is NULL:
+            raise MemoryError('allocation error')
+        large = small + cnt
+        for n in range(start, end):
+            self.threshold[n] *= cnt / total
+            self.alias[n] = n
+            if self.threshold[n] < 1.0:
+                small[numsmall] = n
+                numsmall += 1
+            else:
+                large[numlarge] = n
+                numlarge += 1
+        while numsmall and numlarge:
+            numsmall -= 1
+            s = small[numsmall]
+            l = large[numlarge - 1]
+            self.alias[s] = l
+            self.threshold[l] += self.threshold[s] - 1.0
+            if self.threshold[l] < 1.0:
+                numlarge -= 1
+                small[numsmall] = l
+                numsmall += 1
+        # remaining entries are 1 up to rounding errors
+        while numlarge:
+            numlarge -= 1
+            self.threshold[large[numlarge]] = 1.0
+        while numsmall:
+            numsmall -= 1
+            self.threshold[small[numsmall]] = 1.0
+        free(small)
+        return minprob - clog(total)
+
+    cdef inline double random(self):
+        """Return next random number from current batch."""
+        if self.rndidx >= <size_t>self.rnd.shape[0]:
+            self.rnd = self.rng.random_sample(RANDOMBATCH)
+            self.rndidx = 0
+        self.rndidx += 1
+        return self.rnd[self.rndidx - 1]
+
+    cdef inline uint32_t sampleedge(self, uint32_t m):
+        """Sample an edge of item ``m`` in constant time."""
+        cdef uint32_t start = self.offsets[m]
+        cdef uint32_t cnt = self.offsets[m + 1] - start
+        cdef double x = self.random() * cnt
+        cdef uint32_t n = <uint32_t>x
+        if n >= cnt:
+            n = cnt - 1
+        # use fractional part of x for the biased coin
+        if x - n < self.threshold[start + n]:
+            return start + n
+        return self.alias[start + n]
+
+    def sample(self, int k, str debin=None):
+        """Sample *k* derivations.
+
+        The sampled derivations are added to ``chart.rankededges``, such that
+        they can be used in the same way as *k*-best derivations.
+
+        :param debin: perform on-the-fly debinarization, identify
+                intermediate nodes using the substring ``debin``.
+        :returns: a list of tuples ``(deriv, prob)`` where ``deriv`` is a
+                string and ``prob`` a log probability."""
+        if self.inside[self.numitems - 1] == INFINITY:
+            # edges would be sampled uniformly, which need not terminate
+            # with unary cycles.
+            raise ValueError('cannot sample; all derivations have zero '
+                             'probability.')
+        if self.chart.rankededges is None:
+            self.chart.rankededges = {}
+        return [self._sample(self.numitems - 1, debin) for _ in range(k)]
+
+    cdef tuple _sample(self, uint32_t m, str debin):
+        cdef Chart chart = self.chart
+        cdef uint32_t n = self.sampleedge(m)
+        cdef Edge * edge = self.edges[n]
+        cdef RankedEdge rankededge
+        cdef double prob
+        cdef str tree, tree2
+        item = self.items[m]
+        label = chart.grammar.tolabel[chart.label(item)]
+        if edge.rule is NULL:  # terminal
+            prob = chart.subtreeprob(item)
+            rankededge = new_RankedEdge(item, edge, -1, -1)
+            chart.rankededges.setdefault(item, []).append(
+                new_DoubleEntry(rankededge, prob, 0))
+            return '(%s %d)' % (label, chart.lexidx(edge)), prob
+        tree, prob = self._sample(self.left[n], debin)
+        prob += edge.rule.prob
+        if self.right[n] != -1:
+            tree2, p2 = self._sample(self.right[n], debin)
+            tree += ' ' + tree2
+            prob += p2
+        if debin is None or debin not in label:
+            tree = '(%s %s)' % (label, tree)
+        # create an edge that has as children the edges that were just
+        # created by our recursive calls
+        rankededge = new_RankedEdge(
+            item, edge,
+            len(chart.rankededges[self.items[self.left[n]]]) - 1,
+            (len(chart.rankededges[self.items[self.right[n]]]) - 1)
+            if self.right[n] != -1 else -1)
+        # NB: this is actually 'samplededges', not 'rankededges'
         chart.rankededges.setdefault(item, []).append(
-            new_DoubleEntry(rankededge, chart.subtreeprob(item), 0))
-        deriv = '(%s %d)' % (chart.grammar.tolabel[label], idx)
-        return deriv, chart.subtreeprob(item)
-    tree, p1 = samplechart(chart.copy(chart._left(item, edge)),
-                           chart, chartidx, tables, debin)
-    prob = edge.rule.prob + p1
-    if edge.rule.rhs2:
-        tree2, p2 = samplechart(chart.copy(chart._right(item, edge)),
-                                chart, chartidx, tables, debin)
-        tree += ' ' + tree2
-        prob += p2
-    if debin is None or debin not in chart.grammar.tolabel[label]:
-        tree = '(%s %s)' % (chart.grammar.tolabel[label], tree)
-    # create an edge that has as children the edges that were just created
-    # by our recursive calls
-    rankededge = new_RankedEdge(item, edge,
-                                len(chart.rankededges[chart._left(item, edge)]) - 1,
-                                (len(chart.rankededges[chart._right(item, edge)]) - 1)
-                                if edge.rule.rhs2 else -1)
-    # NB: this is actually 'samplededges', not 'rankededges'
-    chart.rankededges.setdefault(item, []).append(
-        new_DoubleEntry(rankededge, prob, 0))
-    return tree, prob
+            new_DoubleEntry(rankededge, prob, 0))
+        return tree, prob
 
 
 def doprerank(parsetrees, sent, k, Grammar coarse, Grammar fine):
     """Rerank *k*-best coarse trees w/parse probabilities of DOP reduction.
 
-    cf. ``dopparseprob()``."""
+    The candidates are scored in a single pass with a chart shared across
+    trees, such that subtrees occurring in several candidates are only
+    scored once; cf. ``dopparseprob()``."""
     cdef list results = []
+    cdef dict cells = {}, subtreeids = {}
+    if not fine.logprob:
+        raise ValueError('Grammar should have log probabilities.')
     for derivstr, _, _ in nlargest(k, parsetrees, key=itemgetter(1)):
         deriv = addbitsets(derivstr)
-        results.append((derivstr, exp(dopparseprob(deriv, sent, coarse, fine)),
-                        None))
+        results.append((derivstr, exp(dopparseprob_(
+            deriv, sent, coarse, fine, cells, subtreeids)), None))
     msg = 're-ranked %d parse trees; best tree at %d. ' % (
         len(results),
         max(range(len(results)), key=lambda x: results[x][1]) + 1)
@@ -933,40 +1472,57 @@ def dopparseprob(tree, sent, Grammar coarse, Grammar fine):
     NB: this algorithm could also be used to determine the probability of
     derivations, but then the input would have to distinguish whether nodes are
     internal nodes of fragments, or whether they join two fragments."""
-    cdef dict chart = {}  # chart[bitset][label] = prob
-    cdef dict cell  # chart[bitset] = cell; cell[label] = prob
+    if not fine.logprob:
+        raise ValueError('Grammar should have log probabilities.')
+    return dopparseprob_(tree, sent, coarse, fine, {}, {})
+
+
+cdef double dopparseprob_(tree, list sent, Grammar coarse, Grammar fine,
+                          dict cells, dict subtreeids):
+    """Compute DOP parse probability of a Tree, reusing cells of subtrees.
+
+    :param cells: ``cells[subtreeid][label] = prob``; may be shared by calls
+            for trees of the same sentence.
+    :param subtreeids: maps a subtree to an ID, identifying subtrees by
+            their production and the IDs of their children."""
+    cdef dict ids = {}  # ids[id(node)] = subtreeid
+    cdef dict cell  # cell[label] = prob
     cdef ProbRule * rule
     cdef LexicalRule lexrule
-    cdef object n  # pyint
+    cdef int n
     cdef str pos
-    if not fine.logprob:
-        raise ValueError('Grammar should have log probabilities.')
     # Log probabilities are not ideal here because we do lots of additions,
     # but the probabilities are very small.
     # A possible alternative is to scale them somehow.
 
-    # add all matching POS tags
-    for n, pos in tree.pos():
-        word = sent[n]
-        chart[1 << n] = cell = {}
-        if word not in fine.lexicalbyword:
-            cell[fine.toid[pos]] = -0.0
-            continue
-        for lexrule in fine.lexicalbyword[word]:
-            if (fine.tolabel[lexrule.lhs] == pos
-                    or fine.tolabel[lexrule.lhs].startswith(pos + '@')):
-                cell[lexrule.lhs] = -lexrule.prob
-
     # do post-order traversal (bottom-up)
     for node, (r, yf) in list(zip(tree.subtrees(),
                                   lcfrsproductions(tree, sent)))[::-1]:
-        if not isinstance(node[0], Tree):
+        if isinstance(node[0], Tree):
+            key = (coarse.rulenos[prodrepr(r, yf)], ) + tuple([
+                ids[id(child)] for child in node])
+        else:  # a POS tag and the index of its terminal
+            key = (node.label, node[0])
+        if key in subtreeids:  # already scored as part of another tree
+            ids[id(node)] = subtreeids[key]
+            continue
+        ids[id(node)] = subtreeids[key] = len(subtreeids)
+        if not isinstance(node[0], Tree):  # add all matching POS tags
+            pos, n = key
+            word = sent[n]
+            cells[ids[id(node)]] = cell = {}
+            if word not in fine.lexicalbyword:
+                cell[fine.toid[pos]] = -0.0
+                continue
+            for lexrule in fine.lexicalbyword[word]:
+                if (fine.tolabel[lexrule.lhs] == pos
+                        or fine.tolabel[lexrule.lhs].startswith(pos + '@')):
+                    cell[lexrule.lhs] = -lexrule.prob
             continue
-        if node.bitset not in chart:
-            chart[node.bitset] = {}
-        cell = chart[node.bitset]
-        prod = coarse.rulenos[prodrepr(r, yf)]
+        prod = key[0]
         if len(node) == 1:  # unary node
+            # the cell of a unary node extends that of its child.
+            cells[ids[id(node)]] = cell = dict(cells[ids[id(node[0])]])
             for ruleno in fine.rulemapping[prod]:
                 rule = &(fine.bylhs[0][fine.revmap[ruleno]])
                 if rule.rhs1 in cell:
@@ -976,8 +1532,9 @@ def dopparseprob(tree, sent, Grammar coarse, Grammar fine):
                     else:
                         cell[rule.lhs] = (-rule.prob + cell[rule.rhs1])
         elif len(node) == 2:  # binary node
-            leftcell = chart[node[0].bitset]
-            rightcell = chart[node[1].bitset]
+            cells[ids[id(node)]] = cell = {}
+            leftcell = cells[ids[id(node[0])]]
+            rightcell = cells[ids[id(node[1])]]
             for ruleno in fine.rulemapping[prod]:
                 rule = &(fine.bylhs[0][fine.revmap[ruleno]])
                 if (rule.rhs1 in leftcell and rule.rhs2 in rightcell):
@@ -989,36 +1546,47 @@ def dopparseprob(tree, sent, Grammar coarse, Grammar fine):
                         cell[rule.lhs] = newprob
         else:
             raise ValueError('expected binary tree without empty nodes.')
-    return chart[tree.bitset].get(fine.toid[tree.label], float('-inf'))
+    return cells[ids[id(tree)]].get(fine.toid[tree.label], float('-inf'))
 
 
 def mcrerank(parsetrees, sent, k, trees, vocab):
     """Rerank *k*-best trees using tree fragments from training treebank.
 
-    Searches for trees that share multiple fragments (multi component)."""
-    cdef list results = []
-    for derivstr, prob, _ in nlargest(k, parsetrees, key=itemgetter(1)):
-        tmp = _fragments.getctrees(
-            [(addbitsets(derivstr), sent)], vocab=vocab)
+    Searches for trees that share multiple fragments (multi component).
+    The candidates are compared to the treebank as a batch: fragment
+    extraction only visits treebank trees sharing productions with a
+    candidate, and fragments shared by candidates are counted once."""
+    cdef list results = [], candidates, fragsbytree = []
+    cdef dict allfrags = {}, occurrences
+    candidates = nlargest(k, parsetrees, key=itemgetter(1))
+    tmp = _fragments.getctrees(
+        [(addbitsets(derivstr), sent) for derivstr, _, _ in candidates],
+        vocab=vocab)
+    for n in range(len(candidates)):
         frags = _fragments.extractfragments(
-            tmp['trees1'], 0, 0, vocab, trees,
+            tmp['trees1'], n, n + 1, vocab, trees,
             disc=True, approx=False)
         frags = {frag: bitset for frag, bitset in frags.items()
-                 if frag[0].count('(') > 3}
-        indices = _fragments.exactcounts(
-            tmp['trees1'], trees, list(frags.values()), indices=True)
+                 if frag.count('(') > 3}
+        for frag, bitset in frags.items():
+            if frag not in allfrags:
+                allfrags[frag] = bitset
+        fragsbytree.append(list(frags))
+    # from: frag => (tree idx, freq)...
+    occurrences = dict(zip(allfrags, _fragments.exactcounts(
+        tmp['trees1'], trees, list(allfrags.values()), indices=True)))
+    for (derivstr, prob, _), frags in zip(candidates, fragsbytree):
         score = 0
         rev = defaultdict(set)
-        for n, (frag, idx) in enumerate(zip(frags, indices)):
-            # from: frag => (tree idx, freq)...
+        for frag in frags:
             # to: tree idx => frags...
-            for i in idx:
+            for i in occurrences[frag]:
                 rev[i].add(frag)
         for i in rev:
             if len(rev[i]) > 1:
                 # score is the total number of nodes
                 # of the common fragments consisting of at least 2 parts
-                score += sum(frag[0].count('(') for frag in rev[i])
+                score += sum([frag.count('(') for frag in rev[i]])
         # divide by number of nodes in derivation to avoid preferring
         # larger derivations
         score = float(score) / (derivstr.count('(') + len(sent))
@@ -1096,5 +1664,7 @@ def test():
 
 
 __all__ = ['getderivations', 'marginalize', 'gettree', 'recoverfragments',
-           'fragmentsinderiv', 'treeparsing', 'viterbiderivation', 'getsamples',
-           'doprerank', 'dopparseprob', 'frontiernt', 'splitfrag']
+           'compilebacktransform', 'TreeNodes', 'fragmentsinderiv',
+           'treeparsing', 'viterbiderivation', 'getsamples',
+           'DerivationSampler', 'doprerank', 'dopparseprob', 'frontiernt',
+           'splitfrag']
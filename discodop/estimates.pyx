@@ -9,8 +9,11 @@ The latter ported almost directly from rparse
 (except for sign reversal of log probs)."""
 
 from __future__ import print_function
+import mmap
+import multiprocessing
 from math import exp
 import numpy as np
+from .util import workerfunc
 
 from libc.math cimport isnan, isfinite
 from libc.stdint cimport uint8_t, uint32_t, uint64_t
@@ -20,6 +23,8 @@ from .containers cimport Chart, Grammar, ProbRule, LexicalRule, \
     new_SmallChartItem, SmallChartItem
 
 INFINITY = float('infinity')
+# parameters for worker processes computing estimates
+PARAMS = {}
 
 cdef class Item:
     """Item class used in agenda for computing the  outside LR estimate."""
@@ -228,8 +233,13 @@ cdef inline uint64_t insideconcat(uint64_t a, uint64_t b, ProbRule rule,
 
 
 def outsidelr(Grammar grammar, double[:, :] insidescores,
-              uint32_t maxlen, uint32_t goal, double[:, :, :, :] outside):
-    """Compute the outside SX simple LR estimate in top down fashion."""
+              uint32_t maxlen, uint32_t goal, double[:, :, :, :] outside,
+              uint32_t minlen=1):
+    """Compute the outside SX simple LR estimate in top down fashion.
+
+    The total length (length + lr + gaps) of an item is preserved by each
+    rule, so the estimates for each total length are computed independently;
+    only the estimates for total lengths ``minlen...maxlen`` are computed."""
     cdef DoubleAgenda agenda = DoubleAgenda()
     cdef DoubleEntry entry
     cdef Item I
@@ -240,7 +250,7 @@ def outsidelr(Grammar grammar, double[:, :] insidescores,
     cdef size_t i
     cdef bint stopaddleft, stopaddright
 
-    for n in range(1, maxlen + 1):
+    for n in range(minlen, maxlen + 1):
         agenda[new_Item(goal, n, 0, 0)] = 0.0
         outside[goal, n, 0, 0] = 0.0
     print("initialized")
@@ -337,22 +347,100 @@ def outsidelr(Grammar grammar, double[:, :] insidescores,
     # end while agenda.length:
 
 
-def getestimates(Grammar grammar, uint32_t maxlen, uint32_t goal):
-    """Compute table of outside SX simple LR estimates for a PLCFRS."""
+def getestimates(Grammar grammar, uint32_t maxlen, uint32_t goal,
+                 filename=None, previous=None, numproc=1):
+    """Compute table of outside SX simple LR estimates for a PLCFRS.
+
+    :param filename: if given, the table is stored in a memory-mapped
+        ``.npy`` file with this name, instead of being kept in memory.
+    :param previous: a table of estimates computed earlier for the same
+        grammar and goal, with a smaller ``maxlen``; its estimates are
+        copied, and only those for longer sentences are computed.
+    :param numproc: the number of processes to use; ``None``: use all CPUs.
+        The estimates for each sentence length are computed in parallel."""
+    cdef uint32_t minlen = 1
     print("allocating outside matrix:",
           (8 * grammar.nonterminals * (maxlen + 1) * (maxlen + 1)
              * (maxlen + 1) / 1024 ** 2), 'MB')
     insidescores = np.empty((grammar.nonterminals, (maxlen + 1)), dtype='d')
-    outside = np.empty((grammar.nonterminals, ) + 3 * (maxlen + 1, ), dtype='d')
+    shape = (grammar.nonterminals, ) + 3 * (maxlen + 1, )
+    if filename is not None:
+        outside = np.lib.format.open_memmap(
+            filename, mode='w+', dtype='d', shape=shape)
+    elif numproc != 1:  # anonymous memory map, shared with worker processes
+        outside = np.frombuffer(
+            mmap.mmap(-1, 8 * int(np.prod(shape))), dtype='d').reshape(shape)
+    else:
+        outside = np.empty(shape, dtype='d')
     insidescores[...] = np.NAN
     outside[...] = np.inf
+    if previous is not None:
+        if (previous.shape[0] != grammar.nonterminals
+                or previous.shape[1] > maxlen + 1):
+            raise ValueError('previous estimates have %d labels and maxlen '
+                             '%d; expected %d labels and maxlen <= %d.' % (
+                                 previous.shape[0], previous.shape[1] - 1,
+                                 grammar.nonterminals, maxlen))
+        minlen = previous.shape[1]
+        outside[:, :minlen, :minlen, :minlen] = previous
     print("getting inside estimates")
     simpleinside(grammar, maxlen, insidescores)
     print("getting outside estimates")
-    outsidelr(grammar, insidescores, maxlen, goal, outside)
+    if numproc == 1:
+        outsidelr(grammar, insidescores, maxlen, goal, outside, minlen)
+    elif minlen <= maxlen:
+        # the workers write to the memory map of the parent process, so they
+        # must be forked; with the spawn method their results would be lost.
+        context = (multiprocessing.get_context('fork')
+                   if hasattr(multiprocessing, 'get_context')  # Python 3.4+
+                   else multiprocessing)
+        pool = context.Pool(
+            processes=numproc, initializer=initworker,
+            initargs=(grammar, insidescores, goal, outside))
+        # longest sentences first, because they take the most time
+        for _ in pool.imap_unordered(
+                mpworker, range(maxlen, minlen - 1, -1)):
+            pass
+        pool.close()
+        pool.join()
+    if filename is not None:
+        outside.flush()
     return outside
 
 
+def initworker(grammar, insidescores, goal, outside):
+    """Set parameters for a worker process computing estimates.
+
+    NB: relies on the worker being forked, such that it inherits the grammar
+    and writes to the same memory-mapped table of estimates."""
+    PARAMS.update(grammar=grammar, insidescores=insidescores, goal=goal,
+                  outside=outside)
+
+
+@workerfunc
+def mpworker(totlen):
+    """Compute the outside estimates for items with given total length."""
+    outsidelr(PARAMS['grammar'], PARAMS['insidescores'], totlen,
+              PARAMS['goal'], PARAMS['outside'], totlen)
+
+
+def writeestimates(outside, filename, bint float32=False):
+    """Write a table of outside estimates to an uncompressed ``.npy`` file.
+
+    The result can be loaded with ``np.load(filename, mmap_mode='r')``, such
+    that it is paged in on demand and shared between processes.
+
+    :param float32: store estimates with single precision; halves the size
+        of the table."""
+    result = np.lib.format.open_memmap(
+        filename, mode='w+', dtype=np.float32 if float32 else np.float64,
+        shape=outside.shape)
+    for n in range(outside.shape[0]):  # copy one label at a time
+        result[n] = outside[n]
+    result.flush()
+    del result
+
+
 cdef inline double getpcfgoutside(dict outsidescores,
                                   uint32_t maxlen, uint32_t slen, uint32_t label, uint64_t vec):
     """Query for a PCFG A* estimate. For documentation purposes."""
@@ -365,10 +453,20 @@ cdef inline double getpcfgoutside(dict outsidescores,
 
 
 cpdef getpcfgestimates(Grammar grammar, uint32_t maxlen, uint32_t goal,
-                       bint debug=False):
-    """Compute table of outside SX estimates for a PCFG."""
+                       bint debug=False, previous=None):
+    """Compute table of outside SX estimates for a PCFG.
+
+    :param previous: a table of estimates computed earlier for the same
+        grammar and goal, with a smaller ``maxlen``; its estimates are
+        copied, and only those for longer sentences are computed."""
+    if previous is not None and (previous.shape[0] != grammar.nonterminals
+                                 or previous.shape[1] > maxlen + 1):
+        raise ValueError('previous estimates have %d labels and maxlen '
+                         '%d; expected %d labels and maxlen <= %d.' % (
+                             previous.shape[0], previous.shape[1] - 1,
+                             grammar.nonterminals, maxlen))
     insidescores = pcfginsidesx(grammar, maxlen)
-    outside = pcfgoutsidesx(grammar, insidescores, goal, maxlen)
+    outside = pcfgoutsidesx(grammar, insidescores, goal, maxlen, previous)
     if debug:
         print('inside:')
         for span in range(1, maxlen + 1):
@@ -451,20 +549,33 @@ cdef pcfginsidesx(Grammar grammar, uint32_t maxlen):
 
 
 cdef pcfgoutsidesx(Grammar grammar, list insidescores, uint32_t goal,
-                   uint32_t maxlen):
-    """outsideSX estimate for a PCFG, agenda-based version."""
+                   uint32_t maxlen, previous=None):
+    """outsideSX estimate for a PCFG, agenda-based version.
+
+    An estimate for a context of ``left + right`` words is derived from
+    estimates for smaller contexts. With ``previous`` estimates for contexts
+    up to ``minctx - 1`` words, the agenda is initialized with those, and
+    only estimates for contexts of ``minctx`` words or more are derived."""
     cdef DoubleAgenda agenda = DoubleAgenda()
     cdef DoubleEntry entry
     cdef tuple I
     cdef ProbRule rule
     cdef double x, insidescore, current, score
-    cdef int state, left, right
+    cdef int state, left, right, minctx = 0
     cdef size_t i, sibsize
     cdef double[:, :, :, :] outside = np.empty(
         (grammar.nonterminals, maxlen + 1, maxlen + 1, 1), dtype='d')
     outside[...] = np.inf
 
-    agenda[goal, 0, 0] = outside[goal, 0, 0, 0] = 0.0
+    if previous is None:
+        agenda[goal, 0, 0] = outside[goal, 0, 0, 0] = 0.0
+    else:
+        minctx = previous.shape[1] - 1
+        for state, left, right in zip(*np.nonzero(
+                np.isfinite(previous[:, :, :, 0]))):
+            if left + right < minctx:
+                agenda[state, left, right] = outside[
+                    state, left, right, 0] = previous[state, left, right, 0]
     while agenda.length:
         entry = agenda.popentry()
         I = entry.key
@@ -480,7 +591,8 @@ cdef pcfgoutsidesx(Grammar grammar, list insidescores, uint32_t goal,
             # X -> A
             if rule.rhs2 == 0:
                 score = rule.prob + x
-                if score < outside[rule.rhs1, left, right, 0]:
+                if (left + right >= minctx
+                        and score < outside[rule.rhs1, left, right, 0]):
                     agenda.setitem((rule.rhs1, left, right), score)
                     outside[rule.rhs1, left, right, 0] = score
                 i += 1
@@ -488,7 +600,8 @@ cdef pcfgoutsidesx(Grammar grammar, list insidescores, uint32_t goal,
                 continue
 
             # item is on the left: X -> A B.
-            for sibsize in range(1, maxlen - left - right):
+            for sibsize in range(max(1, minctx - left - right),
+                                 maxlen - left - right):
                 insidescore = insidescores[sibsize].get(rule.rhs2, INFINITY)
                 score = rule.prob + x + insidescore
                 current = outside[rule.rhs1, left, right + sibsize, 0]
@@ -497,7 +610,8 @@ cdef pcfgoutsidesx(Grammar grammar, list insidescores, uint32_t goal,
                     outside[rule.rhs1, left, right + sibsize, 0] = score
 
             # item is on the right: X -> B A
-            for sibsize in range(1, maxlen - left - right):
+            for sibsize in range(max(1, minctx - left - right),
+                                 maxlen - left - right):
                 insidescore = insidescores[sibsize].get(rule.rhs1, INFINITY)
                 score = rule.prob + insidescore + x
                 current = outside[rule.rhs2, left + sibsize, right, 0]
@@ -813,4 +927,4 @@ def test():
 
 
 __all__ = ['Item', 'getestimates', 'getpcfgestimates', 'inside', 'outsidelr',
-           'simpleinside']
+           'simpleinside', 'writeestimates']
@@ -35,7 +35,7 @@ Usage: discodop fragments <treebank1> [treebank2] [options]
 FLAGS = ('approx', 'indices', 'nofreq', 'complete', 'complement', 'alt',
          'relfreq', 'adjacent', 'debin', 'debug', 'quiet', 'help')
 OPTIONS = ('fmt=', 'numproc=', 'numtrees=', 'encoding=', 'batch=', 'cover=',
-           'twoterms=')
+           'twoterms=', 'minprods=')
 PARAMS = {}
 FRONTIERRE = re.compile(r'\(([^ ()]+) \)')  # for altrepr()
 TERMRE = re.compile(r'\(([^ ()]+) ([^ ()]+)\)')  # for altrepr()
@@ -70,6 +70,10 @@ def main(argv=None):
     elif '--cover' in opts:
         PARAMS['cover'] = int(opts.get('--cover', 0)), 999
     PARAMS['twoterms'] = opts.get('--twoterms')
+    PARAMS['minprods'] = int(opts.get('--minprods', 1))
+    if PARAMS['minprods'] < 1:
+        raise ValueError('minprods should be an integer > 0. got: %r'
+                         % PARAMS['minprods'])
     encoding = opts.get('--encoding', 'utf8')
     batchdir = opts.get('--batch')
 
@@ -246,7 +250,8 @@ def batch(outputdir, filenames, limit, encoding, debin):
             fragments = _fragments.extractfragments(trees1, 0, 0,
                                                     PARAMS['vocab'], trees2, disc=PARAMS['disc'],
                                                     debug=PARAMS['debug'], approx=PARAMS['approx'],
-                                                    twoterms=PARAMS['twoterms'], adjacent=PARAMS['adjacent'])
+                                                    twoterms=PARAMS['twoterms'], adjacent=PARAMS['adjacent'],
+                                                    minprods=PARAMS['minprods'])
             fragmentkeys = list(fragments)
             bitsets = [fragments[a] for a in fragmentkeys]
             maxnodes = max(trees1.maxnodes, trees2.maxnodes)
@@ -354,7 +359,7 @@ def worker(interval):
                                          PARAMS['vocab'], trees2, approx=PARAMS['approx'],
                                          disc=PARAMS['disc'], complement=PARAMS['complement'],
                                          debug=PARAMS['debug'], twoterms=PARAMS['twoterms'],
-                                         adjacent=PARAMS['adjacent'])
+                                         adjacent=PARAMS['adjacent'], minprods=PARAMS['minprods'])
     logging.debug('finished %d--%d', offset, end)
     return result
 
@@ -447,7 +452,8 @@ def recurringfragments(trees, sents, numproc=1, disc=True,
     trees = trees[:]
     work = workload(numtrees, mult, numproc)
     PARAMS.update(disc=disc, indices=indices, approx=False, complete=False,
-                  complement=complement, debug=False, adjacent=False, twoterms=None)
+                  complement=complement, debug=False, adjacent=False, twoterms=None,
+                  minprods=1)
     initworkersimple(trees, list(sents))
     if numproc == 1:
         mymap, myworker = map, worker
@@ -523,7 +529,8 @@ def recurringfragments(trees, sents, numproc=1, disc=True,
 def allfragments(trees, sents, maxdepth, maxfrontier=999):
     """Return all fragments up to a certain depth, # frontiers."""
     PARAMS.update(disc=True, indices=True, approx=False, complete=False,
-                  complement=False, debug=False, adjacent=False, twoterms=None)
+                  complement=False, debug=False, adjacent=False, twoterms=None,
+                  minprods=1)
     initworkersimple(trees, list(sents))
     return _fragments.allfragments(PARAMS['trees1'],
                                    PARAMS['vocab'], maxdepth, maxfrontier,
@@ -4,183 +4,618 @@ Implementation of Huang & Chiang (2005): Better k-best parsing.
 http://www.cis.upenn.edu/~lhuang3/huang-iwpt-correct.pdf"""
 from __future__ import print_function
 from operator import itemgetter
-from .plcfrs import DoubleAgenda
 from .containers import ChartItem, RankedEdge, Grammar
 
 cimport cython
-from libc.stdint cimport uint32_t
+from libc.stdlib cimport malloc, calloc, realloc, free
+from libc.string cimport memset, memcpy
+from libc.stdint cimport uint32_t, int32_t, uint64_t, UINT32_MAX
 from .containers cimport ChartItem, SmallChartItem, FatChartItem, \
     Grammar, ProbRule, Chart, Edge, Edges, MoreEdges, RankedEdge, \
     new_RankedEdge, CFGtoSmallChartItem, CFGtoFatChartItem
 from .pcfg cimport CFGChart, DenseCFGChart, SparseCFGChart
-from .plcfrs cimport DoubleEntry, DoubleAgenda, nsmallest, \
-    LCFRSChart, SmallLCFRSChart, FatLCFRSChart, new_DoubleEntry
+from .plcfrs cimport DoubleEntry, LCFRSChart, SmallLCFRSChart, \
+    FatLCFRSChart, new_DoubleEntry
 include "constants.pxi"
 
-cdef DoubleAgenda getcandidates(Chart chart, v, int k):
-    """:returns: a heap with up to k candidate arcs starting from vertex v."""
-    # NB: the priority queue should either do a stable sort, or should
-    # sort on rank vector as well to have ties resolved in FIFO order;
-    # otherwise the sequence (0, 0) -> (1, 0) -> (1, 1) -> (0, 1) -> (1, 1)
-    # can occur (given that the first two have probability x and the latter
-    # three probability y), in which case insertion order should count.
-    # Otherwise (1, 1) ends up in chart.rankededges[v] after which (0, 1)
-    # generates it as a neighbor and puts it in cand[v] for a second time.
-    cdef Edge * e
-    cdef Edges edges
-    cdef MoreEdges * edgelist
-    cdef double prob
-    cdef DoubleAgenda agenda = DoubleAgenda()
-    cdef size_t n
-    entries = []
-    # loop over blocks of edges
-    # compute viterbi prob from rule.prob + viterbi probs of children
-    edges = chart.getedges(v)
-    edgelist = edges.head if edges is not None else NULL
-    while edgelist is not NULL:
-        for n in range(edges.len if edgelist is edges.head
-                       else EDGES_SIZE):
-            e = &(edgelist.data[n])
-            if e.rule is NULL:
+
+cdef struct Derivation:
+    double prob  # -log p of derivation
+    uint64_t count  # insertion order in candidate heap; breaks ties
+    uint32_t edge  # index of edge in edges of item
+    int32_t left, right  # ranks of derivations of children, or -1
+
+
+cdef struct KBestItem:
+    Edge ** edges  # edges of item; NULL until item is expanded
+    int32_t * children  # edge n => item numbers of children at 2n, 2n + 1
+    Derivation * ranked  # derivations found so far, best first
+    Derivation * cand  # heap of candidate derivations
+    double prob  # viterbi probability of item
+    uint32_t numedges, numranked, maxranked, numcand, maxcand
+    uint64_t counter  # next insertion order for candidate heap
+    bint initialized  # whether candidate heap has been initialized
+
+
+cdef struct RankKey:  # a derivation of an item, to test for duplicates
+    uint32_t item, edge
+    int32_t left, right
+
+
+cdef inline bint derivcmp(Derivation * a, Derivation * b):
+    """Compare on probability, resolve ties in FIFO order."""
+    return a.prob < b.prob or (a.prob == b.prob and a.count < b.count)
+
+
+cdef void heappush(Derivation * heap, uint32_t size, Derivation * deriv):
+    """Add deriv to heap with ``size`` elements; array should have room."""
+    cdef uint32_t pos = size, parent
+    while pos > 0:
+        parent = (pos - 1) >> 1
+        if not derivcmp(deriv, &(heap[parent])):
+            break
+        heap[pos] = heap[parent]
+        pos = parent
+    heap[pos] = deriv[0]
+
+
+cdef void siftdown(Derivation * heap, uint32_t size, uint32_t pos):
+    """Move element at pos down until heap invariant is restored."""
+    cdef Derivation deriv = heap[pos]
+    cdef uint32_t child = 2 * pos + 1
+    while child < size:
+        if child + 1 < size and derivcmp(&(heap[child + 1]), &(heap[child])):
+            child += 1
+        if not derivcmp(&(heap[child]), &deriv):
+            break
+        heap[pos] = heap[child]
+        pos = child
+        child = 2 * pos + 1
+    heap[pos] = deriv
+
+
+cdef void selectfirstk(Derivation * entries, int left, int right, int k):
+    """Quickselect to put the k smallest entries first (unsorted).
+
+    Performs the same permutation as ``plcfrs.nsmallest()``, such that ties
+    are resolved in the same way."""
+    cdef int pivot = left + (right - left) // 2
+    cdef int i, storeindex = left
+    cdef double pivotvalue = entries[pivot].prob
+    cdef Derivation tmp
+    # partition
+    tmp = entries[pivot]
+    entries[pivot] = entries[right]
+    entries[right] = tmp
+    for i in range(left, right):
+        if entries[i].prob < pivotvalue:
+            tmp = entries[i]
+            entries[i] = entries[storeindex]
+            entries[storeindex] = tmp
+            storeindex += 1
+    tmp = entries[storeindex]
+    entries[storeindex] = entries[right]
+    entries[right] = tmp
+    if storeindex > k:
+        if storeindex - 1 > left:
+            selectfirstk(entries, left, storeindex - 1, k)
+    elif storeindex < k:
+        if right > storeindex + 1:
+            selectfirstk(entries, storeindex + 1, right, k)
+
+
+cdef class KBest:
+    """Extract the *k*-best derivations of a chart.
+
+    Implements algorithm 3 of Huang & Chiang (2005) with the ranked
+    derivations and candidate heaps of each item stored in C arrays, indexed
+    by item numbers assigned through ``chart.itemid()``. Derivations are
+    represented by an edge and the ranks of its children. Python objects are
+    only created when the result is requested, either as strings with
+    ``derivations()``, or as ``RankedEdge`` objects in ``chart.rankededges``
+    with ``updatechart()``.
+
+    >>> kbest = KBest(chart, 10)  # doctest: +SKIP
+    >>> derivations = kbest.derivations()  # doctest: +SKIP
+    """
+    cdef Chart chart
+    cdef list items  # item number => item
+    cdef uint32_t * itemnums  # chart.itemid(item) => item number + 1, or 0
+    cdef KBestItem * states  # item number => ranked derivations & candidates
+    cdef uint32_t numitems, maxitems
+    cdef uint32_t * order  # item numbers in order of first derivation
+    cdef uint32_t numorder
+    cdef RankKey * explored  # open addressing table of derivations in heaps
+    cdef uint64_t exploredmask, numexplored
+    cdef readonly uint32_t root  # item number of root
+
+    def __cinit__(self):
+        self.itemnums = self.order = NULL
+        self.states = NULL
+        self.explored = NULL
+        self.numitems = self.maxitems = self.numorder = 0
+
+    def __init__(self, Chart chart, int k):
+        """Enumerate the *k*-best derivations of chart.
+
+        :param k: the number of derivations to enumerate."""
+        cdef Derivation * tmp
+        cdef KBestItem * state
+        cdef uint32_t n, m = 0
+        if not chart:
+            raise ValueError('chart has no root item.')
+        self.chart = chart
+        self.items = []
+        self.itemnums = <uint32_t *>calloc(chart.numitemids(), sizeof(uint32_t))
+        self.maxitems = 64
+        self.states = <KBestItem *>malloc(self.maxitems * sizeof(KBestItem))
+        self.order = <uint32_t *>malloc(self.maxitems * sizeof(uint32_t))
+        self.exploredmask = 255
+        self.explored = <RankKey *>malloc(
+                (self.exploredmask + 1) * sizeof(RankKey))
+        if (self.itemnums is NULL or self.states is NULL or self.order is NULL
+                or self.explored is NULL):
+            raise MemoryError('allocation error')
+        memset(self.explored, 255, (self.exploredmask + 1) * sizeof(RankKey))
+        self.numexplored = 0
+        self.root = self.getitemnum(chart.root())
+        self.lazykthbest(self.root, k, k, MAX_DEPTH)
+        # ensure that all 1-best derivations of children are present,
+        # and discard derivations with cycles.
+        state = &(self.states[self.root])
+        tmp = <Derivation *>malloc(max(state.numranked, 1) * sizeof(Derivation))
+        if tmp is NULL:
+            raise MemoryError('allocation error')
+        for n in range(min(<uint32_t>k, state.numranked)):
+            if self.explorederivation(
+                    self.root, self.states[self.root].ranked[n], MAX_DEPTH):
+                tmp[m] = self.states[self.root].ranked[n]
+                m += 1
+        state = &(self.states[self.root])
+        memcpy(state.ranked, tmp, m * sizeof(Derivation))
+        state.numranked = m
+        free(tmp)
+
+    def __dealloc__(self):
+        cdef uint32_t n
+        if self.states is not NULL:
+            for n in range(self.numitems):
+                free(self.states[n].edges)
+                free(self.states[n].children)
+                free(self.states[n].ranked)
+                free(self.states[n].cand)
+        free(self.states)
+        free(self.itemnums)
+        free(self.order)
+        free(self.explored)
+
+    def __len__(self):
+        return self.states[self.root].numranked
+
+    cdef int32_t getitemnum(self, item) except -1:
+        """Return item number of item, add it if it is not yet known."""
+        cdef size_t itemid = self.chart.itemid(item)
+        cdef KBestItem * state
+        cdef uint32_t * order
+        if self.itemnums[itemid]:
+            return self.itemnums[itemid] - 1
+        if self.numitems == self.maxitems:
+            state = <KBestItem *>realloc(
+                    self.states, 2 * self.maxitems * sizeof(KBestItem))
+            if state is NULL:
+                raise MemoryError('allocation error')
+            self.states = state
+            order = <uint32_t *>realloc(
+                    self.order, 2 * self.maxitems * sizeof(uint32_t))
+            if order is NULL:
+                raise MemoryError('allocation error')
+            self.order = order
+            self.maxitems *= 2
+        state = &(self.states[self.numitems])
+        memset(state, 0, sizeof(KBestItem))
+        state.prob = self.chart.subtreeprob(item)
+        state.counter = 1
+        self.items.append(item)
+        self.numitems += 1
+        self.itemnums[itemid] = self.numitems
+        return self.numitems - 1
+
+    cdef int expand(self, uint32_t v) except -1:
+        """Collect edges of item and look up item numbers of children."""
+        cdef Edges edges
+        cdef MoreEdges * edgelist
+        cdef Edge * edge
+        cdef Edge ** edgearray
+        cdef int32_t * children
+        cdef uint32_t n, numedges = 0
+        cdef size_t idx
+        item = self.items[v]
+        edges = self.chart.getedges(item)
+        edgelist = edges.head if edges is not None else NULL
+        while edgelist is not NULL:
+            numedges += edges.len if edgelist is edges.head else EDGES_SIZE
+            edgelist = edgelist.prev
+        edgearray = <Edge **>malloc(max(numedges, 1) * sizeof(Edge *))
+        children = <int32_t *>malloc(2 * max(numedges, 1) * sizeof(int32_t))
+        if edgearray is NULL or children is NULL:
+            free(edgearray)
+            free(children)
+            raise MemoryError('allocation error')
+        # NB: no references to self.states may be kept in this loop, because
+        # adding new items may move it.
+        n = 0
+        edgelist = edges.head if edges is not None else NULL
+        while edgelist is not NULL:
+            for idx in range(edges.len if edgelist is edges.head
+                             else EDGES_SIZE):
+                edge = &(edgelist.data[idx])
+                edgearray[n] = edge
+                children[2 * n] = children[2 * n + 1] = -1
+                if edge.rule is not NULL:
+                    children[2 * n] = self.getitemnum(
+                            self.chart._left(item, edge))
+                    if edge.rule.rhs2:
+                        children[2 * n + 1] = self.getitemnum(
+                                self.chart._right(item, edge))
+                n += 1
+            edgelist = edgelist.prev
+        self.states[v].edges = edgearray
+        self.states[v].children = children
+        self.states[v].numedges = numedges
+        return 0
+
+    cdef Derivation * getcandidates(self, uint32_t v, int k) except NULL:
+        """Return array with a derivation for each edge of item ``v``.
+
+        The derivations use the 1-best derivations of the children; the first
+        ``k`` elements are the best derivations, unsorted. Caller should free
+        array."""
+        cdef KBestItem * state
+        cdef Derivation * result
+        cdef Edge * edge
+        cdef uint32_t n
+        if self.states[v].edges is NULL:
+            self.expand(v)
+        state = &(self.states[v])
+        result = <Derivation *>malloc(
+                max(state.numedges, 1) * sizeof(Derivation))
+        if result is NULL:
+            raise MemoryError('allocation error')
+        for n in range(state.numedges):
+            edge = state.edges[n]
+            result[n].edge = n
+            result[n].count = 0
+            if edge.rule is NULL:
                 # there can only be one lexical edge for this combination of
                 # POS tag and terminal, use viterbi probability directly
-                prob = chart.subtreeprob(v)
-                left = right = -1
+                result[n].prob = state.prob
+                result[n].left = result[n].right = -1
             else:
-                left = right = 0
-                prob = e.rule.prob
-                prob += chart.subtreeprob(chart._left(v, e))
-                if e.rule.rhs2:  # unary rule?
-                    prob += chart.subtreeprob(chart._right(v, e))
-                else:
-                    right = -1
-            re = new_RankedEdge(v, e, left, right)
-            entries.append(new_DoubleEntry(re, prob, n))
-        edgelist = edgelist.prev
-    agenda.update_entries(nsmallest(k, entries))
-    return agenda
-
-
-cdef lazykthbest(v, int k, int k1, dict cand, Chart chart, set explored,
-                 int depthlimit):
-    """"Explore up to *k*-best derivations headed by vertex *v*.
-
-    :param k1: the global k, with ``k <= k1``
-    :param cand: contains a queue of edges to consider for each vertex
-    :param explored: a set of all edges already visited."""
-    cdef DoubleEntry entry
-    cdef RankedEdge ej, ej1
-    cdef int ji
-    cdef bint inrankededges = v in chart.rankededges
-    # first visit of vertex v?
-    if v not in cand:
-        # initialize the heap
-        cand[v] = getcandidates(chart, v, k1)
-    while not inrankededges or len(chart.rankededges[v]) < k:
-        inrankededges = inrankededges or v in chart.rankededges
-        if inrankededges:
-            with cython.wraparound(True):
-                # last derivation
-                entry = chart.rankededges[v][-1]
-            ej = entry.key
-            # update the heap, adding the successors of last derivation
-            # start of inlined lazynext(v, ej, k1, cand, chart, explored)
-            for i in range(2):  # add the |e| neighbors
-                if i == 0 and ej.left >= 0:
-                    ei = chart.left(ej)
-                    ej1 = new_RankedEdge(v, ej.edge, ej.left + 1, ej.right)
-                elif i == 1 and ej.right >= 0:
-                    ei = chart.right(ej)
-                    ej1 = new_RankedEdge(v, ej.edge, ej.left, ej.right + 1)
-                else:
-                    break
-                ji = ej1.left if i == 0 else ej1.right
-                if depthlimit > 0:
-                    # recursively solve a subproblem
-                    # NB: increment j[i] again, j is zero-based and k is not
-                    lazykthbest(ei, ji + 1, k1, cand, chart, explored,
-                                depthlimit - 1)
-                    # if it exists and is not in heap yet
-                    if (ei in chart.rankededges
-                        and ji < len(chart.rankededges[ei])
-                            and ej1 not in explored):
-                        # 	and cand[ej1.head]): gives duplicates
-                        # add it to the heap
-                        cand[v][ej1] = getprob(chart, v, ej1)
-                        explored.add(ej1)
-            # end of lazynext
-        if not cand[v]:
-            break
-        # get the next best derivation and delete it from the heap
-        entry = ( < DoubleAgenda > cand[v]).popentry()
-        if inrankededges:
-            chart.rankededges[v].append(entry)
-        else:
-            chart.rankededges[v] = [entry]
+                result[n].prob = edge.rule.prob
+                result[n].prob += self.states[state.children[2 * n]].prob
+                result[n].left = 0
+                result[n].right = -1
+                if edge.rule.rhs2:
+                    result[n].prob += self.states[
+                            state.children[2 * n + 1]].prob
+                    result[n].right = 0
+        if state.numedges > 1:
+            selectfirstk(result, 0, state.numedges - 1, k)
+        return result
 
+    cdef int initcandidates(self, uint32_t v, int k) except -1:
+        """Initialize heap with up to k candidate derivations of item v."""
+        # NB: the priority queue should either do a stable sort, or should
+        # sort on rank vector as well to have ties resolved in FIFO order;
+        # otherwise the sequence (0, 0) -> (1, 0) -> (1, 1) -> (0, 1) -> (1, 1)
+        # can occur (given that the first two have probability x and the
+        # latter three probability y), in which case insertion order should
+        # count. Otherwise (1, 1) ends up in the ranked derivations of v after
+        # which (0, 1) generates it as a neighbor and puts it in the heap for
+        # a second time.
+        cdef Derivation * entries = self.getcandidates(v, k)
+        cdef KBestItem * state = &(self.states[v])
+        cdef uint32_t n, m = min(<uint32_t>k, state.numedges)
+        state.maxcand = max(m, 1)
+        state.cand = <Derivation *>malloc(state.maxcand * sizeof(Derivation))
+        if state.cand is NULL:
+            free(entries)
+            raise MemoryError('allocation error')
+        for n in range(m):
+            entries[n].count = state.counter
+            state.counter += 1
+            heappush(state.cand, n, &(entries[n]))
+        state.numcand = m
+        state.initialized = True
+        free(entries)
+        return 0
 
-cdef inline double getprob(Chart chart, v, RankedEdge ej) except -1.0:
-    """Get subtree probability of ``ej``.
-
-    Try looking in ``chart.rankededges``, or else use viterbi probability."""
-    cdef double prob = ej.edge.rule.prob
-    ei = chart.left(ej)
-    if ej.left == 0:
-        prob += chart.subtreeprob(ei)
-    elif ei in chart.rankededges:
-        prob += ( < DoubleEntry > ( < list > chart.rankededges[ei])[ej.left]).value
-    else:
-        raise ValueError('non-zero rank vector %d not in explored '
-                         'derivations for %s' % (ej.right, chart.itemstr(v)))
-    if ej.right == -1:
-        return prob
-    ei = chart.right(ej)
-    if ej.right == 0:
-        prob += chart.subtreeprob(ei)
-    elif ei in chart.rankededges:
-        prob += ( < DoubleEntry > ( < list > chart.rankededges[ei])[ej.right]).value
-    else:
-        raise ValueError('non-zero rank vector %d not in explored '
-                         'derivations for %s' % (ej.right, chart.itemstr(v)))
-    return prob
+    cdef int pushcandidate(self, uint32_t v, Derivation * deriv) except -1:
+        cdef KBestItem * state = &(self.states[v])
+        cdef Derivation * tmp
+        if state.numcand == state.maxcand:
+            state.maxcand *= 2
+            tmp = <Derivation *>realloc(
+                    state.cand, state.maxcand * sizeof(Derivation))
+            if tmp is NULL:
+                raise MemoryError('allocation error')
+            state.cand = tmp
+        deriv.count = state.counter
+        state.counter += 1
+        heappush(state.cand, state.numcand, deriv)
+        state.numcand += 1
+        return 0
 
+    cdef int addranked(self, uint32_t v, Derivation * deriv) except -1:
+        """Append deriv to the ranked derivations of item v."""
+        cdef KBestItem * state = &(self.states[v])
+        cdef Derivation * tmp
+        if state.numranked == state.maxranked:
+            state.maxranked = max(2 * state.maxranked, 4)
+            tmp = <Derivation *>realloc(
+                    state.ranked, state.maxranked * sizeof(Derivation))
+            if tmp is NULL:
+                raise MemoryError('allocation error')
+            state.ranked = tmp
+        if state.numranked == 0:
+            self.order[self.numorder] = v
+            self.numorder += 1
+        state.ranked[state.numranked] = deriv[0]
+        state.numranked += 1
+        return 0
 
-cdef int explorederivation(v, RankedEdge ej, Chart chart, set explored,
-                           int depthlimit):
-    """Traverse derivation to ensure all 1-best RankedEdges are present.
+    cdef bint addexplored(self, uint32_t v, uint32_t edge, int32_t left,
+                          int32_t right) except -1:
+        """Add derivation to set of explored derivations.
 
-    :returns: True when ``ej`` is a valid, complete derivation."""
-    cdef DoubleEntry entry
-    if depthlimit <= 0:  # to prevent cycles
-        return False
-    if ej.edge.rule is NULL:
+        :returns: False if derivation was already explored."""
+        cdef RankKey * key
+        cdef RankKey * tmp
+        cdef uint64_t n, oldsize, h
+        h = ((<uint64_t>v << 32 | edge) * 0x9E3779B97F4A7C15ULL
+             ^ (<uint64_t><uint32_t>left << 32 | <uint32_t>right)
+             * 0xC2B2AE3D27D4EB4FULL)
+        h ^= h >> 29
+        n = h & self.exploredmask
+        while self.explored[n].item != UINT32_MAX:
+            key = &(self.explored[n])
+            if (key.item == v and key.edge == edge
+                    and key.left == left and key.right == right):
+                return False
+            n = (n + 1) & self.exploredmask
+        key = &(self.explored[n])
+        key.item = v
+        key.edge = edge
+        key.left = left
+        key.right = right
+        self.numexplored += 1
+        if 2 * self.numexplored > self.exploredmask:  # grow table
+            tmp = self.explored
+            oldsize = self.exploredmask + 1
+            self.explored = <RankKey *>malloc(2 * oldsize * sizeof(RankKey))
+            if self.explored is NULL:
+                self.explored = tmp
+                raise MemoryError('allocation error')
+            memset(self.explored, 255, 2 * oldsize * sizeof(RankKey))
+            self.exploredmask = 2 * oldsize - 1
+            self.numexplored = 0
+            for n in range(oldsize):
+                if tmp[n].item != UINT32_MAX:
+                    self.addexplored(tmp[n].item, tmp[n].edge, tmp[n].left,
+                                     tmp[n].right)
+            free(tmp)
         return True
-    if ej.left != -1:
-        leftitem = chart.left(ej)
-        if leftitem not in chart.rankededges:
-            assert ej.left == 0, '%d-best edge for %s of left item missing' % (
-                ej.left, chart.itemstr(v))
-            entry = getcandidates(chart, leftitem, 1).popentry()
-            chart.rankededges[leftitem] = [entry]
-            explored.add(entry.key)
-        if not explorederivation(leftitem,
-                            < RankedEdge > (< DoubleEntry > chart.rankededges[
-                                leftitem][ej.left]).key,
-                chart, explored, depthlimit - 1):
+
+    cdef int lazykthbest(self, uint32_t v, int k, int k1,
+                         int depthlimit) except -1:
+        """Explore up to *k*-best derivations headed by item *v*.
+
+        :param k1: the global k, with ``k <= k1``"""
+        cdef Derivation ej, ej1
+        cdef uint32_t i, ei
+        cdef int32_t ji
+        # first visit of item v?
+        if not self.states[v].initialized:
+            self.initcandidates(v, k1)
+        while self.states[v].numranked < <uint32_t>k:
+            if self.states[v].numranked:
+                # update the heap, adding the successors of last derivation
+                ej = self.states[v].ranked[self.states[v].numranked - 1]
+                for i in range(2):  # add the |e| neighbors
+                    ej1 = ej
+                    if i == 0 and ej.left >= 0:
+                        ej1.left += 1
+                        ji = ej1.left
+                    elif i == 1 and ej.right >= 0:
+                        ej1.right += 1
+                        ji = ej1.right
+                    else:
+                        break
+                    ei = self.states[v].children[2 * ej.edge + i]
+                    if depthlimit > 0:
+                        # recursively solve a subproblem
+                        # NB: increment j[i] again, j is zero-based and k is
+                        # not
+                        self.lazykthbest(ei, ji + 1, k1, depthlimit - 1)
+                        # if it exists and is not in heap yet
+                        if (<uint32_t>ji < self.states[ei].numranked
+                                and self.addexplored(
+                                    v, ej1.edge, ej1.left, ej1.right)):
+                            ej1.prob = self.getprob(v, &ej1)
+                            self.pushcandidate(v, &ej1)
+            if self.states[v].numcand == 0:
+                break
+            # get the next best derivation and delete it from the heap
+            ej = self.states[v].cand[0]
+            self.states[v].numcand -= 1
+            if self.states[v].numcand:
+                self.states[v].cand[0] = self.states[v].cand[
+                        self.states[v].numcand]
+                siftdown(self.states[v].cand, self.states[v].numcand, 0)
+            self.addranked(v, &ej)
+        return 0
+
+    cdef double getprob(self, uint32_t v, Derivation * ej):
+        """Get subtree probability of derivation ``ej`` of item ``v``.
+
+        Rank 0 uses the viterbi probability of a child, otherwise the
+        probability of its ranked derivations."""
+        cdef KBestItem * state = &(self.states[v])
+        cdef double prob = state.edges[ej.edge].rule.prob
+        cdef uint32_t ei = state.children[2 * ej.edge]
+        if ej.left == 0:
+            prob += self.states[ei].prob
+        else:
+            prob += self.states[ei].ranked[ej.left].prob
+        if ej.right == -1:
+            return prob
+        ei = state.children[2 * ej.edge + 1]
+        if ej.right == 0:
+            prob += self.states[ei].prob
+        else:
+            prob += self.states[ei].ranked[ej.right].prob
+        return prob
+
+    cdef int explorederivation(self, uint32_t v, Derivation ej,
+                               int depthlimit) except -1:
+        """Traverse derivation to ensure all 1-best derivations are present.
+
+        :returns: True when ``ej`` is a valid, complete derivation."""
+        cdef Derivation * entries
+        cdef uint32_t i, ei
+        cdef int32_t ji
+        if depthlimit <= 0:  # to prevent cycles
             return False
-    if ej.right != -1:
-        rightitem = chart.right(ej)
-        if rightitem not in chart.rankededges:
-            assert ej.right == 0, (('%d-best edge for right child '
-                                    'of %s missing') % (ej.right, chart.itemstr(v)))
-            entry = getcandidates(chart, rightitem, 1).popentry()
-            chart.rankededges[rightitem] = [entry]
-            explored.add(entry.key)
-        return explorederivation(rightitem,
-                        < RankedEdge > (< DoubleEntry > chart.rankededges[
-                            rightitem][ej.right]).key,
-            chart, explored, depthlimit - 1)
-    return True
+        if self.states[v].edges[ej.edge].rule is NULL:
+            return True
+        for i in range(2):
+            ji = ej.left if i == 0 else ej.right
+            if ji == -1:
+                break
+            ei = self.states[v].children[2 * ej.edge + i]
+            if self.states[ei].numranked == 0:
+                assert ji == 0, '%d-best derivation of child %d of %s missing' % (
+                    ji, i, self.chart.itemstr(self.items[v]))
+                entries = self.getcandidates(ei, 1)
+                entries[0].count = 1
+                self.addranked(ei, entries)
+                free(entries)
+            if not self.explorederivation(
+                    ei, self.states[ei].ranked[ji], depthlimit - 1):
+                return False
+        return True
+
+    def derivations(self, str debin=None):
+        """Return the *k*-best derivations as strings.
+
+        :param debin: perform on-the-fly debinarization, identify
+                intermediate nodes using the substring ``debin``.
+        :returns: a list of tuples ``(deriv, prob)`` where ``deriv`` is a
+                string with a tree in bracket notation and ``prob`` a log
+                probability."""
+        cdef dict memo = {}
+        return [(self._getderiv(memo, self.root, n, debin),
+                 self.states[self.root].ranked[n].prob)
+                for n in range(self.states[self.root].numranked)]
+
+    cdef str _getderiv(self, dict memo, uint32_t v, uint32_t rank,
+                       str debin):
+        """Produce string for derivation.
+
+        Derivations of subtrees are shared by many derivations, so they are
+        memoized."""
+        cdef Derivation * ej = &(self.states[v].ranked[rank])
+        cdef Edge * edge = self.states[v].edges[ej.edge]
+        cdef uint64_t key = <uint64_t>v << 32 | rank
+        cdef str label, result
+        if key in memo:
+            return memo[key]
+        if edge.rule is NULL:  # lexical rule, left child is terminal
+            result = str(self.chart.lexidx(edge))
+        else:
+            result = self._getderiv(
+                    memo, self.states[v].children[2 * ej.edge], ej.left, debin)
+            if ej.right != -1:
+                result += ' ' + self._getderiv(
+                        memo, self.states[v].children[2 * ej.edge + 1],
+                        ej.right, debin)
+        label = self.chart.grammar.tolabel[self.chart.label(self.items[v])]
+        if debin is None or debin not in label:
+            result = '(%s %s)' % (label, result)
+        memo[key] = result
+        return result
+
+    def getitems(self):
+        """Return the items with ranked derivations, in order of discovery.
+
+        These are the items occurring in the *k*-best derivations, as well as
+        the items of derivations that were explored to find them."""
+        return [self.items[self.order[n]] for n in range(self.numorder)]
+
+    def updatechart(self):
+        """Store ranked derivations in ``chart.rankededges``.
+
+        For each item, a list of ``DoubleEntry`` objects with a
+        ``RankedEdge`` and its probability, as used by
+        ``getderiv()`` and the functions in ``disambiguation``.
+        Only the items occurring in the *k*-best derivations of the root are
+        stored, with their derivations up to the highest rank used; the other
+        explored derivations are not converted to Python objects."""
+        cdef KBestItem * state
+        cdef Derivation * deriv
+        cdef uint32_t * needed  # item number => number of ranks to store
+        cdef uint32_t * done  # item number => number of ranks visited
+        cdef uint32_t * stack  # items with needed[v] > done[v]
+        cdef uint32_t n, m, v, ei, numstack = 0
+        cdef int32_t ji
+        cdef dict rankededges = {}
+        needed = <uint32_t *>calloc(3 * max(self.numitems, 1),
+                                    sizeof(uint32_t))
+        if needed is NULL:
+            raise MemoryError('allocation error')
+        done = needed + self.numitems
+        stack = done + self.numitems
+        # collect the items and ranks used by the derivations of the root
+        needed[self.root] = self.states[self.root].numranked
+        if needed[self.root]:
+            stack[numstack] = self.root
+            numstack += 1
+        while numstack:
+            numstack -= 1
+            v = stack[numstack]
+            state = &(self.states[v])
+            while done[v] < needed[v]:
+                deriv = &(state.ranked[done[v]])
+                done[v] += 1
+                if state.edges[deriv.edge].rule is NULL:
+                    continue
+                for n in range(2):
+                    ji = deriv.left if n == 0 else deriv.right
+                    if ji == -1:
+                        break
+                    ei = state.children[2 * deriv.edge + n]
+                    m = min(<uint32_t>ji + 1, self.states[ei].numranked)
+                    if m > needed[ei]:
+                        # push if not yet on stack or being visited
+                        if needed[ei] == done[ei] and ei != v:
+                            stack[numstack] = ei
+                            numstack += 1
+                        needed[ei] = m
+        for n in range(self.numorder):
+            v = self.order[n]
+            if not needed[v]:
+                continue
+            state = &(self.states[v])
+            item = self.items[v]
+            rankededges[item] = entries = []
+            for m in range(needed[v]):
+                deriv = &(state.ranked[m])
+                entries.append(new_DoubleEntry(
+                        new_RankedEdge(item, state.edges[deriv.edge],
+                                       deriv.left, deriv.right),
+                        deriv.prob, deriv.count))
+        free(needed)
+        self.chart.rankededges = rankededges
 
 
 cdef inline _getderiv(list result, v, RankedEdge ej, Chart chart, str debin):
@@ -224,7 +659,7 @@ def getderiv(v, RankedEdge ej, Chart chart, str debin):
 
 
 def lazykbest(Chart chart, int k, str debin=None, bint derivs=True):
-    """Wrapper function to run ``lazykthbest``.
+    """Wrapper function to run ``KBest``.
 
     Produces the ranked chart, as well as derivations as strings (when
     ``derivs`` is True). chart is a monotone hypergraph; should be acyclic
@@ -232,23 +667,13 @@ def lazykbest(Chart chart, int k, str debin=None, bint derivs=True):
     productions are sufficient?).
 
     :param k: the number of derivations to enumerate.
-    :param debin: debinarize derivations."""
-    cdef DoubleEntry entry
-    cdef set explored = set()
-    # assert not chart.rankededges, 'kbest derivations already extracted?'
-    chart.rankededges = {}
-    derivations = []
-    cand = {}
-    root = chart.root()
-    lazykthbest(root, k, k, cand, chart, explored, MAX_DEPTH)
-    chart.rankededges[root] = [entry for entry
-                               in chart.rankededges[root][:k]
-                               if explorederivation(root, entry.key, chart, explored, MAX_DEPTH)]
-    if derivs:
-        root = chart.root()
-        derivations = [(getderiv(root, entry.key, chart, debin), entry.value)
-                       for entry in chart.rankededges[root]]
-    return derivations, explored
+    :param debin: debinarize derivations.
+    :returns: a tuple ``(derivations, kbest)`` with a list of derivations
+        (empty if ``derivs`` is False) and the ``KBest`` object."""
+    cdef KBest kbest = KBest(chart, k)
+    kbest.updatechart()
+    derivations = kbest.derivations(debin) if derivs else []
+    return derivations, kbest
 
 
 def test():
@@ -422,4 +847,4 @@ def test():
     assert len(derivations) == len(set(derivations))
 
 
-__all__ = ['getderiv', 'lazykbest']
+__all__ = ['KBest', 'getderiv', 'lazykbest']
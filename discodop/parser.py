@@ -7,6 +7,7 @@ import io
 import os
 import re
 import sys
+import gc
 import gzip
 import json
 import time
@@ -15,16 +16,24 @@ import logging
 import tempfile
 import traceback
 import string  # pylint: disable=W0402
+import threading
 import multiprocessing
+import multiprocessing.pool
 from math import exp, log
 from heapq import nlargest
+from itertools import count
 from getopt import gnu_getopt, GetoptError
 from operator import itemgetter
+from collections import defaultdict
 if sys.version_info[0] == 2:
     from itertools import imap as map  # pylint: disable=E0611,W0622
     import cPickle as pickle  # pylint: disable=import-error
+    import Queue as queue  # pylint: disable=import-error
+    import SocketServer as socketserver  # pylint: disable=import-error
 else:
     import pickle
+    import queue
+    import socketserver
 import numpy as np
 from . import plcfrs, pcfg, disambiguation
 from . import grammar, treetransforms, treebanktransforms
@@ -42,7 +51,8 @@ from .treetransforms import binarizetree
 
 SHORTUSAGE = '''
 usage: discodop parser [options] <grammar/> [input [output]]
-or:    discodop parser --simple [options] <rules> <lexicon> [input [output]]'''
+or:    discodop parser --simple [options] <rules> <lexicon> [input [output]]
+or:    discodop parser --serve=<address> [options] <grammar/>'''
 
 DEFAULTS = dict(
     # two-level keys:
@@ -85,6 +95,7 @@ DEFAULTS = dict(
     predictfunctions=False,  # use discriminative classifier to add
     # grammatical functions in postprocessing step
     evalparam='proper.prm',  # EVALB-style parameter file
+    calibration=None,  # held-out corpus to tune k for stages with a target
     verbosity=2,
     numproc=1)  # increase to use multiple CPUs; None: use all CPUs.
 
@@ -97,6 +108,8 @@ DEFAULTSTAGE = dict(
     markorigin=False,  # mark origin of split nodes: VP_2 => {VP*1, VP*2}
     collapselabels=None,  # options: None, 'head', 'all'.
     k=50,  # no. of coarse pcfg derivations to prune with; k=0: filter only
+    ktarget_time=0,  # per sentence target on time; tune k; 0 to disable.
+    ktarget_items=0,  # per sentence target on chart items; tune k; 0 to disable.
     dop=None,  # DOP mode: dopreduction, doubledop, dop1
     binarized=True,  # for doubledop, whether to binarize extracted grammar
     # (False requires use of bitpar)
@@ -107,7 +120,8 @@ DEFAULTSTAGE = dict(
     sample=False, kbest=True,
     m=10,  # number of derivations to sample/enumerate
     estimator='rfe',  # choices: rfe, ewe
-    objective='mpp',  # choices: mpp, mpd, shortest, sl-dop[-simple]
+    objective='mpp',  # choices: mpp, mpd, shortest, sl-dop[-simple],
+    # mcc, max-rule-product, variational
     # NB: w/shortest derivation, estimator only affects tie breaking.
     sldop_n=7,  # number of trees to consider when using sl-dop[-simple]
     mcc_labda=1.0,  # weight to assign to recall vs. mistake rate with mcc
@@ -118,11 +132,23 @@ DEFAULTSTAGE = dict(
     # form the complement of the maximal recurring fragments extracted
     neverblockre=None,  # do not prune nodes with label that match regex
     estimates=None,  # compute, store & use outside estimates
+    estimates_float32=False,  # store outside estimates with single precision
     beam_beta=1.0,  # beam pruning factor, between 0 and 1; 1 to disable.
     beam_delta=40,  # maximum span length to which beam_beta is applied
+    twopass=False,  # pcfg: only build items that are part of a derivation
+    numthreads=1,  # pcfg: number of threads to apply binary rules with
+    packedchart=False,  # plcfrs: store chart items in an array of structs
+    radixagenda=False,  # plcfrs: with packedchart, use a radix heap as agenda
+    usebitpar=False,  # with pcfg-bitpar modes, use external bitpar program
+    budget_time=0,  # per sentence limit on wall clock time; 0 to disable.
+    budget_items=0,  # per sentence limit on chart items; 0 to disable.
     collapse=None,  # optionally, collapse phrase labels for multilevel CTF
 )
 
+# objectives computed from posteriors in the parse forest; these do not
+# require k-best derivations.
+FORESTOBJECTIVES = ('max-rule-product', 'variational')
+
 
 class DictObj(object):
     """Trivial class to wrap a dictionary for reasons of syntactic sugar."""
@@ -175,6 +201,10 @@ class Parser(object):
                     model = stage.estimator
             if stage.mode != 'mc-rerank':
                 stage.grammar.switch(model, logprob=True)
+            if stage.mode == 'pcfg-bitpar-nbest' and not stage.usebitpar:
+                # a binarized grammar is parsed with directly
+                stage.auxgrammar = (None if stage.grammar.binarized
+                                    else pcfg.binarizegrammar(stage.grammar))
             if prm.verbosity >= 3:
                 logging.debug(stage.name)
                 logging.debug(stage.grammar)
@@ -225,7 +255,10 @@ class Parser(object):
         # parse with each coarse-to-fine stage
         for n, stage in enumerate(self.stages):
             begin = time.clock()
-            noparse = False
+            noparse = budgetexceeded = False
+            k = stage.k
+            if stage.ktarget_time or stage.ktarget_items:
+                k = tunedk(stage.ktable, len(sent))
             parsetrees = fragments = None
             golditems = 0
             msg = '%s:\t' % stage.name.upper()
@@ -238,14 +271,18 @@ class Parser(object):
             if stage.mode != 'mc-rerank':
                 x = stage.grammar.currentmodel
                 stage.grammar.switch(model, logprob=True)
-            if stage.mode.startswith('pcfg-bitpar'):
+            if stage.mode.startswith('pcfg-bitpar') and stage.usebitpar:
                 if (not hasattr(stage, 'rulesfile')
                         or x != stage.grammar.currentmodel):
                     exportbitpargrammar(stage)
             elif hasattr(stage, 'rulesfile'):
                 del stage.rulesfile, stage.lexiconfile
-            if not stage.binarized and not stage.mode.startswith('pcfg-bitpar'):
-                raise ValueError('non-binarized grammar requires use of bitpar')
+                if getattr(stage, 'bitpar', None) is not None:
+                    stage.bitpar.close()
+                    del stage.bitpar
+            if not stage.binarized and stage.mode != 'pcfg-bitpar-nbest':
+                raise ValueError('non-binarized grammar requires mode '
+                                 '"pcfg-bitpar-nbest"')
 
             # do parsing; if CTF pruning enabled, require parent stage to
             # be successful.
@@ -261,8 +298,8 @@ class Parser(object):
                         'dop-rerank', 'mc-rerank'):
                     beginprune = time.clock()
                     whitelist, items, msg1 = prunechart(
-                        charts[stage.prune], stage.grammar, stage.k,
-                        stage.splitprune,
+                        charts[stage.prune], stage.grammar, k,
+                        stage.splitprune and self.stages[prevn].split,
                         self.stages[prevn].markorigin,
                         stage.mode.startswith('pcfg'),
                         self.stages[prevn].mode == 'pcfg-bitpar-nbest')
@@ -290,7 +327,12 @@ class Parser(object):
                         whitelist=whitelist if stage.prune else None,
                         symbolic=False,
                         beam_beta=-log(stage.beam_beta),
-                        beam_delta=stage.beam_delta)
+                        beam_delta=stage.beam_delta,
+                        maxtime=stage.budget_time,
+                        maxitems=stage.budget_items,
+                        twopass=stage.twopass,
+                        numthreads=stage.numthreads)
+                    budgetexceeded = chart is None
                 elif stage.mode.startswith('pcfg-bitpar'):
                     if stage.mode == 'pcfg-bitpar-forest':
                         numderivs = 0
@@ -299,11 +341,28 @@ class Parser(object):
                         numderivs = stage.m
                     else:  # request 1000 nbest parses for CTF pruning
                         numderivs = 1000
-                    chart, cputime, msg1 = pcfg.parse_bitpar(stage.grammar,
-                                                             stage.rulesfile.name, stage.lexiconfile.name,
-                                                             sent, numderivs, stage.grammar.start,
-                                                             stage.grammar.toid[stage.grammar.start], tags=tags)
-                    begin -= cputime
+                    if stage.usebitpar:
+                        chart, cputime, msg1 = pcfg.parse_bitpar(stage.grammar,
+                                                                 stage.rulesfile.name, stage.lexiconfile.name,
+                                                                 sent, numderivs, stage.grammar.start,
+                                                                 stage.grammar.toid[stage.grammar.start], tags=tags,
+                                                                 coprocess=None if tags else bitparcoprocess(stage, numderivs))
+                        begin -= cputime
+                    elif numderivs == 0:
+                        chart, msg1 = pcfg.parse(
+                            sent, stage.grammar, tags=tags,
+                            whitelist=whitelist if stage.prune else None,
+                            maxtime=stage.budget_time,
+                            maxitems=stage.budget_items)
+                        budgetexceeded = chart is None
+                    else:
+                        chart, msg1 = pcfg.parse_nary(
+                            sent, stage.grammar, numderivs, tags=tags,
+                            auxgrammar=stage.auxgrammar,
+                            whitelist=whitelist if stage.prune else None,
+                            maxtime=stage.budget_time,
+                            maxitems=stage.budget_items)
+                        budgetexceeded = chart is None
                 elif stage.mode == 'plcfrs':
                     chart, msg1 = plcfrs.parse(
                         sent, stage.grammar, tags=tags,
@@ -319,21 +378,27 @@ class Parser(object):
                         else None,
                         symbolic=False,
                         beam_beta=-log(stage.beam_beta),
-                        beam_delta=stage.beam_delta)
+                        beam_delta=stage.beam_delta,
+                        maxtime=stage.budget_time,
+                        maxitems=stage.budget_items,
+                        packed=stage.packedchart,
+                        radix=stage.radixagenda)
+                    budgetexceeded = chart is None
                 elif stage.mode == 'dop-rerank':
                     if prevparsetrees[stage.prune]:
                         parsetrees, msg1 = disambiguation.doprerank(
-                            prevparsetrees[stage.prune], sent, stage.k,
+                            prevparsetrees[stage.prune], sent, k,
                             self.stages[prevn].grammar, stage.grammar)
                 elif stage.mode == 'mc-rerank':
                     if prevparsetrees[stage.prune]:
                         parsetrees, msg1 = disambiguation.mcrerank(
-                            prevparsetrees[stage.prune], sent, stage.k,
+                            prevparsetrees[stage.prune], sent, k,
                             stage.grammar.trees1, stage.grammar.vocab)
                 else:
                     raise ValueError('unknown mode specified.')
                 msg += '%s\n\t' % msg1
                 if (n > 0 and stage.prune and not chart and not noparse
+                        and not budgetexceeded
                         and stage.split == self.stages[prevn].split):
                     logging.error('ERROR: expected successful parse. '
                                   'sent: %s\nstage %d: %s.',
@@ -353,6 +418,9 @@ class Parser(object):
                                          'in nbest mode.')
                     derivations = chart.rankededges[chart.root()]
                     entries = [None] * len(derivations)
+                elif stage.objective in FORESTOBJECTIVES and stage.dop:
+                    # decoding uses the parse forest; no derivations needed
+                    derivations, entries = [], []
                 else:
                     derivations, entries = disambiguation.getderivations(
                         chart, stage.m, kbest=stage.kbest,
@@ -393,7 +461,7 @@ class Parser(object):
                           sum((prob[1] if isinstance(prob, tuple) else prob)
                               for _, prob, _ in besttrees))
                 if not stage.prune and tree is not None:
-                    item = next(iter(chart.rankededges))
+                    item = chart.root()
                     totalgolditems = sum(1 for node in tree.subtrees())
                     golditems = sum(
                         1 for node in tree.subtrees()
@@ -433,11 +501,43 @@ class Parser(object):
             msg += '%.2fs cpu time elapsed\n' % (elapsedtime)
             yield DictObj(name=stage.name, parsetree=parsetree, prob=prob,
                           parsetrees=parsetrees, fragments=fragments,
-                          noparse=noparse, elapsedtime=elapsedtime,
+                          noparse=noparse, budgetexceeded=budgetexceeded,
+                          elapsedtime=elapsedtime,
                           numitems=numitems, golditems=golditems,
                           totalgolditems=totalgolditems, msg=msg)
         del charts, prevparsetrees
 
+    def parse_many(self, sents, numproc=1):
+        """Parse a batch of sentences, scheduling the longest ones first.
+
+        :param sents: an iterable of ``(sent, tags)`` tuples; ``tags`` may
+                be None.
+        :param numproc: number of worker processes to use; ``None``: use all
+                CPUs.
+        :returns: an iterator with, for each sentence in the order of
+                ``sents``, a list with the result of each stage, as given by
+                ``list(self.parse(sent, tags))``.
+
+        Sentences are distributed over the workers in chunks with roughly
+        the same estimated parsing cost, cf. :py:func:`schedule`; long
+        sentences are parsed first, while short sentences are grouped."""
+        sents = list(sents)
+        if numproc == 1:
+            for sent, tags in sents:
+                yield list(self.parse(sent, tags))
+            return
+        pool = forkcontext().Pool(processes=numproc,
+                                  initializer=initparser, initargs=(self, ))
+        try:
+            for result in mapbycost(
+                    pool, parseworker, sents,
+                    [parsecost(len(sent)) for sent, _ in sents],
+                    numproc or multiprocessing.cpu_count()):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
     def postprocess(self, treestr, sent, stage):
         """Take parse tree and apply postprocessing."""
         parsetree = ParentedTree(treestr)
@@ -488,9 +588,23 @@ def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
             stage.mapping = None
     for n, stage in enumerate(stages):
         logging.info('reading: %s', stage.name)
-        if stage.mode != 'mc-rerank':
-            rules = openread('%s/%s.rules.gz' % (resultdir, stage.name)).read()
-            lexicon = openread('%s/%s.lex.gz' % (resultdir, stage.name))
+        grammarfile = '%s/%s.grammar' % (resultdir, stage.name)
+        rulesfile = '%s/%s.rules.gz' % (resultdir, stage.name)
+        lexiconfile = '%s/%s.lex.gz' % (resultdir, stage.name)
+        # a compiled grammar is stale when the text files are newer
+        compiled = os.path.exists(grammarfile) and not any(
+            os.path.exists(a)
+            and os.path.getmtime(a) > os.path.getmtime(grammarfile)
+            for a in (rulesfile, lexiconfile))
+        if stage.mode != 'mc-rerank' and compiled:
+            # compiled grammar; avoids parsing & indexing rules again
+            xgrammar = Grammar.fromfile(grammarfile)
+        elif stage.mode != 'mc-rerank':
+            if os.path.exists(grammarfile):
+                logging.warning('ignoring %s; %s is newer.',
+                                grammarfile, rulesfile)
+            rules = openread(rulesfile).read()
+            lexicon = openread(lexiconfile)
             xgrammar = Grammar(rules, lexicon.read(),
                                start=top, binarized=stage.binarized)
         backtransform = outside = None
@@ -504,8 +618,9 @@ def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
             if stage.estimates is not None:
                 raise ValueError('not supported')
             if stage.dop in ('doubledop', 'dop1'):
-                backtransform = openread('%s/%s.backtransform.gz' % (
-                    resultdir, stage.name)).read().splitlines()
+                backtransform = disambiguation.compilebacktransform(
+                    openread('%s/%s.backtransform.gz' % (
+                        resultdir, stage.name)).read().splitlines())
                 if n and stage.prune:
                     _ = xgrammar.getmapping(stages[prevn].grammar,
                                             striplabelre=re.compile('@.+$'),
@@ -533,7 +648,7 @@ def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
             if os.path.exists(probsfile):
                 probmodels = np.load(probsfile)
                 for name in probmodels.files:
-                    if name != 'default':
+                    if name not in xgrammar.modelnames:
                         xgrammar.register(name, probmodels[name])
         else:  # not stage.dop
             if n and stage.prune:
@@ -548,8 +663,13 @@ def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
                     raise ValueError('SX estimate requires PCFG.')
                 if stage.mode != 'plcfrs':
                     raise ValueError('estimates require parser w/agenda.')
-                outside = np.load('%s/%s.outside.npz' % (
-                    resultdir, stage.name))['outside']
+                outsidefile = '%s/%s.outside.npy' % (resultdir, stage.name)
+                if os.path.exists(outsidefile):
+                    # pages are loaded on demand and shared between processes
+                    outside = np.load(outsidefile, mmap_mode='r')
+                else:  # compressed estimates written by older versions
+                    outside = np.load('%s/%s.outside.npz' % (
+                        resultdir, stage.name))['outside']
                 logging.info('loaded %s estimates', stage.estimates)
             elif stage.estimates:
                 raise ValueError('unrecognized value; specify SX or SXlrgaps.')
@@ -558,11 +678,18 @@ def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
             if xgrammar.maxfanout != 1:
                 raise ValueError('bitpar requires a PCFG.')
 
+        ktable = None
+        if stage.ktarget_time or stage.ktarget_items:
+            ktablefile = '%s/%s.ktable.json' % (resultdir, stage.name)
+            if os.path.exists(ktablefile):
+                with io.open(ktablefile, encoding='utf8') as inp:
+                    ktable = json.load(inp)
+
         if stage.mode != 'mc-rerank':
             _sumsto1, msg = xgrammar.testgrammar()
         logging.info('%s: %s', stage.name, msg)
         stage.update(grammar=xgrammar, backtransform=backtransform,
-                     outside=outside)
+                     outside=outside, ktable=ktable)
     if postagging and postagging.method == 'unknownword':
         postagging.unknownwordfun = UNKNOWNWORDFUNC[postagging.model]
         postagging.lexicon = {w for w in stages[0].grammar.lexicalbyword
@@ -573,6 +700,9 @@ def readgrammars(resultdir, stages, postagging=None, top='ROOT'):
 
 def exportbitpargrammar(stage):
     """(re-)export bitpar grammar with current weights."""
+    if getattr(stage, 'bitpar', None) is not None:  # load new weights
+        stage.bitpar.close()
+        del stage.bitpar
     if not hasattr(stage, 'rulesfile'):
         stage.rulesfile = tempfile.NamedTemporaryFile()
         stage.lexiconfile = tempfile.NamedTemporaryFile()
@@ -612,6 +742,29 @@ def exportbitpargrammar(stage):
     stage.lexiconfile.flush()
 
 
+def bitparcoprocess(stage, numderivs):
+    """Return bitpar process for stage; start it if necessary.
+
+    The process stays loaded with the grammar exported by
+    :py:func:`exportbitpargrammar` across sentences. A new process is started
+    when the number of derivations changes, or in a forked worker process.
+    Returns None if bitpar cannot be kept loaded because ``stdbuf`` is not
+    available; bitpar is then started for each sentence."""
+    if getattr(stage, 'bitpar', None) is not None and (
+            stage.bitpar.n != numderivs or stage.bitpar.pid != os.getpid()):
+        stage.bitpar.close()
+        del stage.bitpar
+    if not hasattr(stage, 'bitpar'):
+        try:
+            stage.bitpar = pcfg.BitparCoprocess(
+                stage.rulesfile.name, stage.lexiconfile.name, numderivs,
+                stage.grammar.start)
+        except ValueError as err:
+            logging.warning('%s; starting bitpar for each sentence.', err)
+            stage.bitpar = None
+    return stage.bitpar
+
+
 def probstr(prob):
     """Render probability / number of subtrees as string."""
     if isinstance(prob, tuple):
@@ -619,6 +772,113 @@ def probstr(prob):
     return 'p=%.4g' % prob
 
 
+def kcandidates(k):
+    """Return values of the pruning parameter ``k`` to try in calibration.
+
+    The values range from the given value to the most aggressive pruning.
+
+    >>> kcandidates(50)
+    [50, 25, 12, 6, 3, 1]
+    >>> kcandidates(1e-5)
+    [1e-05, 0.0001, 0.001, 0.01, 0.1]"""
+    result = [k]
+    if 0 < k < 1:  # posterior threshold
+        while k * 10 < 1:
+            k *= 10
+            result.append(float('%g' % k))
+    elif k >= 1:  # number of derivations
+        while k > 1:
+            k = max(k // 2, 1)
+            result.append(k)
+    return result
+
+
+def tunedk(ktable, length):
+    """Look up the value of ``k`` for a sentence length.
+
+    :param ktable: a list of ``[maxlength, k]`` pairs sorted by length, as
+            produced by :py:func:`calibratek`; lengths beyond the last entry
+            use its value of ``k``."""
+    if not ktable:
+        raise ValueError('k has not been calibrated; cf. calibratek().')
+    for maxlength, k in ktable:
+        if length <= maxlength:
+            return k
+    return ktable[-1][1]
+
+
+def calibratek(parser, sents, resultdir=None, binsize=5):
+    """Tune the pruning parameter ``k`` per sentence length.
+
+    For each stage with ``ktarget_time`` or ``ktarget_items``, the held-out
+    sentences are parsed with the values of :py:func:`kcandidates`; for each
+    bin of sentence lengths, the least aggressive value of ``k`` for which the
+    mean time or number of chart items of the stage is within the target is
+    selected, since pruning less loses less accuracy; if no value is within
+    the target, the most aggressive value is used. Longer sentences never get
+    a less aggressive value than shorter ones. Stages are calibrated in order,
+    such that later stages are calibrated with the tuned earlier stages.
+
+    :param sents: a sequence of ``(sent, tags)`` tuples; ``tags`` may be None.
+    :param resultdir: if given, each table is written to
+            ``<resultdir>/<stage>.ktable.json``.
+    :returns: a dictionary with a list of ``[maxlength, k]`` pairs for each
+            calibrated stage; the tables are also stored as ``stage.ktable``.
+    """
+    sents = list(sents)
+    result = {}
+    for stage in parser.stages:
+        if not (stage.ktarget_time or stage.ktarget_items):
+            continue
+        bins = sorted({(len(sent) - 1) // binsize for sent, _ in sents})
+        candidates = kcandidates(stage.k)
+        # for each bin, whether each candidate is within the target
+        withintarget = {a: [] for a in bins}
+        for k in candidates:
+            stage.ktable = [[0, k]]  # use this value for all lengths
+            times, items = defaultdict(list), defaultdict(list)
+            for sent, tags in sents:
+                for res in parser.parse(sent, tags):
+                    if res.name == stage.name:
+                        break
+                else:  # an earlier stage failed; stage was not reached
+                    continue
+                times[(len(sent) - 1) // binsize].append(res.elapsedtime)
+                items[(len(sent) - 1) // binsize].append(res.numitems)
+            for a in bins:
+                withintarget[a].append(not times[a] or (
+                    (not stage.ktarget_time or sum(times[a]) / len(times[a])
+                        <= stage.ktarget_time)
+                    and (not stage.ktarget_items
+                        or sum(items[a]) / len(items[a])
+                        <= stage.ktarget_items)))
+        ktable, idx = [], 0
+        for a in bins:
+            while idx < len(candidates) - 1 and not withintarget[a][idx]:
+                idx += 1
+            ktable.append([(a + 1) * binsize, candidates[idx]])
+        stage.ktable = result[stage.name] = ktable
+        logging.info('%s: tuned k per sentence length: %s', stage.name,
+                     ', '.join('<= %d: %g' % tuple(a) for a in ktable))
+        if resultdir is not None:
+            with io.open('%s/%s.ktable.json' % (resultdir, stage.name),
+                         'w', encoding='utf8') as out:
+                out.write(u'%s\n' % json.dumps(ktable))
+    return result
+
+
+def checkobjective(stage):
+    """Raise ValueError if the objective of a DOP stage is not supported."""
+    if stage.objective not in ('mpp', 'mpd', 'mcc', 'shortest', 'sl-dop',
+                               'sl-dop-simple') + FORESTOBJECTIVES:
+        raise ValueError('unrecognized objective: %r.' % stage.objective)
+    if (stage.objective in FORESTOBJECTIVES
+            and (stage.dop != 'reduction'
+                 or stage.mode == 'pcfg-bitpar-nbest')):
+        raise ValueError('objective %r requires a parse forest '
+                         'of a DOP reduction.' % stage.objective)
+
+
 def readparam(filename):
     """Parse a parameter file.
 
@@ -661,10 +921,14 @@ def readparam(filename):
                     and stage.objective == 'mpp')
         if stage.dop:
             assert stage.estimator in ('rfe', 'ewe', 'bon')
-            assert stage.objective in ('mpp', 'mpd', 'mcc', 'shortest',
-                                       'sl-dop', 'sl-dop-simple')
+            checkobjective(stage)
         assert stage.binarized or stage.mode == 'pcfg-bitpar-nbest', (
             'non-binarized grammar requires mode "pcfg-bitpar-nbest"')
+        if stage.ktarget_time or stage.ktarget_items:
+            if not stage.prune or stage.k == 0:
+                raise ValueError('ktarget requires pruning with k > 0.')
+            if params['calibration'] is None:
+                raise ValueError('ktarget requires a calibration corpus.')
     assert params['binarization'].method in (
         None, 'default', 'optimal', 'optimalhead')
     postagging = params['postagging']
@@ -679,6 +943,12 @@ def readparam(filename):
             assert postagging.openclassthreshold >= 0
         else:
             assert postagging.method in ('treetagger', 'stanford', 'frog')
+    if params['calibration'] is not None:
+        assert set(params['calibration']).issubset(
+            {'path', 'encoding', 'maxwords', 'numsents', 'skip'})
+        params['calibration'] = DictObj(dict(
+            encoding='utf8', maxwords=40, numsents=100, skip=0),
+            **params['calibration'])
     if params['transformations']:
         params['transformations'] = treebanktransforms.expandpresets(
             params['transformations'])
@@ -700,6 +970,88 @@ def readinputbitparstyle(infile):
         yield ' '.join(sent)
 
 
+def parsecost(length):
+    """Estimate the relative cost of parsing a sentence of given length.
+
+    Chart parsing is (at least) cubic in the length of the sentence."""
+    return length ** 3
+
+
+def schedule(costs, numproc):
+    """Group items in chunks of roughly equal cost; most expensive first.
+
+    :param costs: a sequence with the estimated cost of each item.
+    :param numproc: number of processes; determines the cost per chunk,
+            such that there are at least four chunks per process.
+    :returns: a list of chunks, each a list of indices to ``costs``.
+
+    >>> schedule([1, 27, 8, 1, 1, 1], 1)
+    [[1], [2, 0, 3], [4, 5]]"""
+    target = sum(costs) / (4 * numproc)
+    chunks, chunk, chunkcost = [], [], 0
+    for n in sorted(range(len(costs)), key=costs.__getitem__, reverse=True):
+        chunk.append(n)
+        chunkcost += costs[n]
+        if chunkcost >= target:
+            chunks.append(chunk)
+            chunk, chunkcost = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def forkcontext():
+    """Return a multiprocessing context that forks workers, if available.
+
+    Forked workers inherit the grammars of this process, including their
+    lexicon, and the backtransform tables, instead of rebuilding them from a
+    pickle; memory mapped rule arrays remain shared in either case."""
+    if (hasattr(multiprocessing, 'get_context')  # Python 3.4+
+            and 'fork' in multiprocessing.get_all_start_methods()):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def mapbycost(pool, func, items, costs, numproc, ordered=True):
+    """Like ``pool.imap(func, items)``, but most expensive items first.
+
+    :param costs: a sequence with the estimated cost of each item.
+    :param ordered: if True, results are yielded in the order of ``items``;
+            otherwise, as they become available.
+
+    Items are sent to the pool in chunks formed by :py:func:`schedule`."""
+    chunks = [(func, [(n, items[n]) for n in chunk])
+              for chunk in schedule(costs, numproc)]
+    results, nextidx = {}, 0
+    for chunk in pool.imap_unordered(chunkworker, chunks):
+        if not ordered:
+            for _, result in chunk:
+                yield result
+            continue
+        results.update(chunk)
+        while nextidx in results:
+            yield results.pop(nextidx)
+            nextidx += 1
+
+
+@workerfunc
+def chunkworker(args):
+    """Apply a worker function to a chunk of ``(index, item)`` pairs."""
+    func, chunk = args
+    return [(n, func(item)) for n, item in chunk]
+
+
+def initparser(parser):
+    """Load parser for a worker process of ``Parser.parse_many()``."""
+    PARAMS.update(parser=parser)
+
+
+def parseworker(args):
+    """Parse a single sentence for ``Parser.parse_many()``."""
+    sent, tags = args
+    return list(PARAMS.parser.parse(sent, tags=tags))
+
+
 def initworker(parser, printprob, usetags, numparses,
                fmt, morphology):
     """Load parser for a worker process."""
@@ -775,20 +1127,39 @@ def doparsing(parser, infile, out, printprob, oneline, usetags, numparses,
         initworker(parser, printprob, usetags, numparses, fmt, morphology)
         mymap, myworker = map, worker
     else:
-        pool = multiprocessing.Pool(
+        if hasattr(gc, 'freeze'):  # Python 3.7+
+            # Grammars are inherited by the forked workers; memory mapped
+            # grammars are shared, but other objects are copied as soon as
+            # the garbage collector touches them. Exempt them from collection.
+            gc.freeze()
+        pool = forkcontext().Pool(
             processes=numproc, initializer=initworker,
             initargs=(parser, printprob, usetags, numparses, fmt,
                       morphology))
-        mymap, myworker = pool.map, mpworker
-    for output, noparse, sec, msg in mymap(myworker, infile):
-        if output:
-            print(msg, file=sys.stderr)
-            out.write(output)
-            if noparse:
-                unparsed += 1
-            times.append(sec)
-            sys.stderr.flush()
-            out.flush()
+        infile = list(infile)
+        costs = [parsecost(line.count(' ') + 1) for _, line in infile]
+
+        def mymap(func, items):
+            """Parse longest sentences first; write results in order."""
+            return mapbycost(pool, func, items, costs,
+                             numproc or multiprocessing.cpu_count())
+        myworker = worker
+    try:
+        for output, noparse, sec, msg in mymap(myworker, infile):
+            if output:
+                print(msg, file=sys.stderr)
+                out.write(output)
+                if noparse:
+                    unparsed += 1
+                times.append(sec)
+                sys.stderr.flush()
+                out.flush()
+    finally:
+        if numproc != 1:
+            pool.terminate()
+            pool.join()
+            if hasattr(gc, 'unfreeze'):
+                gc.unfreeze()
     print('average time per sentence', sum(times) / len(times),
           '\nunparsed sentences:', unparsed,
           '\nfinished',
@@ -796,10 +1167,146 @@ def doparsing(parser, infile, out, printprob, oneline, usetags, numparses,
     out.close()
 
 
+class ParseRequestHandler(socketserver.StreamRequestHandler):
+    """Parse newline-delimited JSON requests from a connection.
+
+    Requests are submitted to the worker pool as soon as they are read, while
+    a separate thread writes the responses in the order of the requests."""
+
+    def handle(self):
+        pending = queue.Queue()
+        writer = threading.Thread(target=self.writeresponses, args=(pending, ))
+        writer.start()
+        try:
+            for line in self.rfile:
+                if line.strip():
+                    pending.put(self.submit(line))
+        finally:
+            pending.put(None)
+            writer.join()
+
+    def submit(self, line):
+        """Decode a request and start parsing its sentences."""
+        try:
+            request = json.loads(line.decode('utf8'))
+            batch = 'sents' in request
+            sents = request['sents'] if batch else [request['sent']]
+            sents = [' '.join(sent) if isinstance(sent, list) else sent
+                     for sent in sents]
+        except (ValueError, KeyError, TypeError) as err:
+            return None, False, 'malformed request: %s' % err
+        return request.get('id'), batch, self.server.pool.map_async(
+            mpworker, [(next(self.server.sentno), sent) for sent in sents])
+
+    def writeresponses(self, pending):
+        """Write a JSON response for each submitted request, in order."""
+        for reqid, batch, result in iter(pending.get, None):
+            response = {'id': reqid}
+            try:
+                if not isinstance(result, multiprocessing.pool.AsyncResult):
+                    raise ValueError(result)
+                results = [dict(tree=output, noparse=noparse, time=sec)
+                           for output, noparse, sec, _ in result.get()]
+            except Exception as err:  # pylint: disable=broad-except
+                response['error'] = str(err)
+            else:
+                if batch:
+                    response['results'] = results
+                else:
+                    response.update(results[0])
+            try:
+                self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+                self.wfile.flush()
+            except (IOError, OSError):  # client went away
+                pass
+
+
+class ParseServerMixin(socketserver.ThreadingMixIn):
+    """Serve parse requests with a pool of workers that stays loaded."""
+
+    daemon_threads = True
+
+    def initpool(self, parser, printprob, usetags, numparses, numproc, fmt,
+                 morphology):
+        """Start the workers; with ``numproc=1``, parse in a single thread."""
+        self.sentno = count(1)
+        initargs = (parser, printprob, usetags, numparses, fmt, morphology)
+        if numproc == 1:
+            self.pool = multiprocessing.pool.ThreadPool(
+                1, initializer=initworker, initargs=initargs)
+        else:
+            if hasattr(gc, 'freeze'):  # Python 3.7+; cf. doparsing()
+                gc.freeze()
+            self.pool = forkcontext().Pool(
+                processes=numproc, initializer=initworker, initargs=initargs)
+
+    def server_close(self):
+        socketserver.ThreadingMixIn.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+        if not isinstance(self.pool, multiprocessing.pool.ThreadPool) \
+                and hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+
+class TCPParseServer(ParseServerMixin, socketserver.TCPServer):
+    """Parse server listening on a TCP port."""
+
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class UnixParseServer(ParseServerMixin, socketserver.UnixStreamServer):
+        """Parse server listening on a Unix domain socket."""
+
+        def server_close(self):
+            ParseServerMixin.server_close(self)
+            os.remove(self.server_address)
+
+
+def parseserver(parser, address, printprob=False, usetags=False, numparses=1,
+                numproc=1, fmt='discbracket', morphology=None):
+    """Create a server that keeps ``parser`` loaded to parse requests.
+
+    :param address: a filename for a Unix domain socket, or a TCP address of
+        the form ``port`` or ``host:port``; the host defaults to localhost.
+    :returns: a ``socketserver`` object; call its ``serve_forever()`` method
+        to handle requests and ``server_close()`` to stop the workers.
+
+    A request is a JSON object on a single line, with a sentence given as
+    a string of space separated tokens or as a list of tokens::
+
+        {"id": 1, "sent": "Why did the chicken cross the road ?"}
+        {"id": 2, "sents": [["Hello", "world"], ["Goodbye", "world"]]}
+
+    For each request, a single line with a JSON object is written back with
+    the same id and the keys ``tree`` (output in format ``fmt``),
+    ``noparse``, and ``time``; for a batch, ``results`` contains a list of
+    such objects. Invalid requests or failed parses give a response with an
+    ``error`` key. Requests on a connection are processed concurrently, but
+    responses are written in the order of the requests."""
+    if ':' in address or address.isdigit():
+        host, _, port = address.rpartition(':')
+        server = TCPParseServer((host or 'localhost', int(port)),
+                                ParseRequestHandler, bind_and_activate=False)
+    else:
+        server = UnixParseServer(address, ParseRequestHandler,
+                                 bind_and_activate=False)
+    try:
+        server.server_bind()
+        server.server_activate()
+    except Exception:
+        server.socket.close()
+        raise
+    server.initpool(parser, printprob, usetags, numparses, numproc, fmt,
+                    morphology)
+    return server
+
+
 def main():
     """Handle command line arguments."""
     flags = 'help prob tags bitpar sentid simple'.split()
-    options = flags + 'obj= bt= numproc= fmt= verbosity='.split()
+    options = flags + 'obj= bt= numproc= fmt= verbosity= serve='.split()
     try:
         opts, args = gnu_getopt(sys.argv[2:], 'hb:s:m:x', options)
     except GetoptError as err:
@@ -840,12 +1347,14 @@ def main():
         stage = DEFAULTSTAGE.copy()
         backtransform = None
         if opts.get('--bt'):
-            backtransform = openread(opts.get('--bt')).read().splitlines()
+            backtransform = disambiguation.compilebacktransform(
+                openread(opts.get('--bt')).read().splitlines())
         stage.update(
             name='grammar',
             mode=mode,
             grammar=xgrammar,
             binarized='--bitpar' not in opts,
+            usebitpar='--bitpar' in opts,
             backtransform=backtransform if len(args) < 4 else None,
             m=numparses,
             objective='mpd')
@@ -854,6 +1363,7 @@ def main():
                 dop='reduction' if backtransform is None else 'doubledop',
                 objective=opts['--obj'],
                 m=int(opts.get('-m', 1)))
+            checkobjective(stage)
         stages.append(DictObj(stage))
         if backtransform:
             _ = stages[-1].grammar.getmapping(None,
@@ -870,10 +1380,31 @@ def main():
         params.update(resultdir=directory)
         readgrammars(directory, params.stages, params.postagging,
                      top=getattr(params, 'top', top))
+        for stage in params.stages:
+            if ((stage.ktarget_time or stage.ktarget_items)
+                    and stage.ktable is None):
+                raise ValueError(
+                    'stage %r has a ktarget but %s/%s.ktable.json was not '
+                    'found; run calibratek() to create it, e.g., by running '
+                    '"discodop runexp" again with a calibration corpus.' % (
+                        stage.name, directory, stage.name))
         params.update(verbosity=int(opts.get('--verbosity', params.verbosity)))
         parser = Parser(params)
         morph = params.morphology
         del args[:1]
+    if '--serve' in opts:
+        server = parseserver(
+            parser, opts['--serve'], prob, tags, numparses,
+            int(opts.get('--numproc', 1)), opts.get('--fmt', 'discbracket'),
+            morph)
+        print('listening on', opts['--serve'], file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
     infile = openread(args[0] if len(args) >= 1 else '-')
     out = (io.open(args[1], 'w', encoding='utf8')
            if len(args) == 2 else sys.stdout)
@@ -882,6 +1413,7 @@ def main():
               morph, sentid)
 
 
-__all__ = ['DictObj', 'Parser', 'doparsing', 'exportbitpargrammar',
-           'initworker', 'probstr', 'readgrammars', 'readinputbitparstyle',
-           'readparam']
+__all__ = ['DictObj', 'Parser', 'checkobjective', 'doparsing',
+           'exportbitpargrammar', 'forkcontext', 'initworker', 'mapbycost',
+           'parsecost', 'parseserver', 'probstr', 'readgrammars',
+           'readinputbitparstyle', 'readparam', 'schedule']
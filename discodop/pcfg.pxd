@@ -9,8 +9,12 @@ from .containers cimport Chart, Grammar, ProbRule, LexicalRule, \
     Edge, Edges, EdgesStruct, MoreEdges, RankedEdge, Idx, \
     cellidx, compactcellidx, PY2
 
+from .bit cimport anextset
+
 cdef extern from "macros.h":
-    uint64_t TESTBIT(uint64_t a[], int b)
+    int BITNSLOTS(int nb) nogil
+    void SETBIT(uint64_t a[], int b) nogil
+    uint64_t TESTBIT(uint64_t a[], int b) nogil
 
 ctypedef fused CFGChart_fused:
     DenseCFGChart
@@ -21,10 +25,19 @@ cdef class CFGChart(Chart):
     pass
 
 
+cdef struct EdgesChunk:  # a pool of blocks of edges, allocated at once
+    EdgesChunk * prev
+    MoreEdges * data
+    size_t len, size
+
+
 @cython.final
 cdef class DenseCFGChart(CFGChart):
-    cdef EdgesStruct * parseforest  # chartitem => EdgesStruct(...)
+    cdef EdgesStruct * parseforest  # compact chartitem => EdgesStruct(...)
     cdef double * probs
+    cdef EdgesChunk * chunks  # head of linked list of chunks
+    cdef size_t _compactitem(self, size_t item)
+    cdef MoreEdges * newedges(self)
     cdef void addedge(self, uint32_t lhs, Idx start, Idx end, Idx mid,
                       ProbRule * rule)
     cdef bint updateprob(self, uint32_t lhs, Idx start, Idx end, double prob,
@@ -1,12 +1,16 @@
 """CKY parser for Probabilistic Context-Free Grammar (PCFG)."""
 from __future__ import print_function
+import os
 from os import unlink
 import re
 import sys
 import subprocess
+import tempfile
+from time import time
 from math import exp, log as pylog
 from array import array
 from itertools import count
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from .tree import Tree
 from .util import which
@@ -76,7 +80,11 @@ cdef class DenseCFGChart(CFGChart):
     array; i.e., array is contiguous and all valid combinations of indices
     ``0 <= start <= mid <= end`` and ``label`` can be addressed. Whether it is
     feasible to use this chart depends on the grammar constant, specifically
-    the number of non-terminal labels."""
+    the number of non-terminal labels.
+
+    Both arrays are triangular (cf. ``compactcellidx``); items are still
+    identified by ``cellidx`` indices. Blocks of edges are taken from a pool
+    owned by the chart, which is released at once when the chart is freed."""
 
     def __init__(self, Grammar grammar, list sent,
                  start=None, logprob=True, viterbi=True):
@@ -94,51 +102,64 @@ cdef class DenseCFGChart(CFGChart):
         for n in range(entries):
             self.probs[n] = INFINITY
         # store parse forest in array instead of dict
-        # FIXME: use compactcellidx?
-        entries = cellidx(self.lensent - 1, self.lensent, self.lensent,
-                          grammar.nonterminals) + grammar.nonterminals
         self.parseforest = <EdgesStruct * >calloc(entries, sizeof(EdgesStruct))
         if self.parseforest is NULL:
             raise MemoryError('allocation error')
         self.itemsinorder = array(b'L' if PY2 else 'L')
 
     def __dealloc__(self):
-        cdef size_t n, entries = cellidx(
-            self.lensent - 1, self.lensent, self.lensent,
-            self.grammar.nonterminals) + self.grammar.nonterminals
-        cdef MoreEdges * cur
-        cdef MoreEdges * tmp
+        cdef EdgesChunk * tmp
         if self.probs is not NULL:
             free(self.probs)
-        for n in range(entries):
-            cur = self.parseforest[n].head
-            while cur is not NULL:
-                tmp = cur
-                cur = cur.prev
-                free(tmp)
+        while self.chunks is not NULL:
+            tmp = self.chunks
+            self.chunks = tmp.prev
+            free(tmp.data)
+            free(tmp)
         free(self.parseforest)
 
+    cdef size_t _compactitem(self, size_t item):
+        """Translate an item to an index in the triangular arrays."""
+        cdef short start, end
+        cdef uint32_t lhs
+        lhs = item % self.grammar.nonterminals
+        item /= self.grammar.nonterminals
+        start = item / self.lensent
+        end = item % self.lensent + 1
+        return compactcellidx(
+            start, end, self.lensent, self.grammar.nonterminals) + lhs
+
+    cdef size_t itemid(self, item) except? -1:
+        return self._compactitem(item)
+
+    cdef size_t numitemids(self):
+        return compactcellidx(self.lensent - 1, self.lensent, self.lensent,
+                              self.grammar.nonterminals) + self.grammar.nonterminals
+
+    cdef MoreEdges * newedges(self):
+        """Get a block of edges from the pool; grows the pool if necessary.
+
+        The size of each new chunk of blocks is doubled, up to a maximum."""
+        return poolalloc(&(self.chunks))
+
     cdef void addedge(self, uint32_t lhs, Idx start, Idx end, Idx mid,
                       ProbRule * rule):
         """Add new edge to parse forest."""
         cdef size_t item = cellidx(
             start, end, self.lensent, self.grammar.nonterminals) + lhs
         cdef Edge * edge
-        cdef EdgesStruct * edges = &(self.parseforest[item])
+        cdef EdgesStruct * edges = &(self.parseforest[compactcellidx(
+            start, end, self.lensent, self.grammar.nonterminals) + lhs])
         cdef MoreEdges * edgelist
         if edges.head is NULL:
-            edgelist = <MoreEdges * >calloc(1, sizeof(MoreEdges))
-            if edgelist is NULL:
-                abort()
+            edgelist = self.newedges()
             edgelist.prev = NULL
             edges.head = edgelist
             self.itemsinorder.append(item)
         else:
             edgelist = edges.head
             if edges.len == EDGES_SIZE:
-                edgelist = <MoreEdges * >calloc(1, sizeof(MoreEdges))
-                if edgelist is NULL:
-                    abort()
+                edgelist = self.newedges()
                 edgelist.prev = edges.head
                 edges.head = edgelist
                 edges.len = 0
@@ -169,16 +190,7 @@ cdef class DenseCFGChart(CFGChart):
 
     cdef double _subtreeprob(self, size_t item):
         """Get viterbi / inside probability of a subtree headed by `item`."""
-        cdef short start, end
-        cdef uint32_t lhs
-        cdef size_t idx
-        lhs = item % self.grammar.nonterminals
-        item /= self.grammar.nonterminals
-        start = item / self.lensent
-        end = item % self.lensent + 1
-        idx = compactcellidx(
-            start, end, self.lensent, self.grammar.nonterminals) + lhs
-        return self.probs[idx]
+        return self.probs[self._compactitem(item)]
 
     cdef double subtreeprob(self, item):
         return self._subtreeprob( < size_t > item)
@@ -191,34 +203,60 @@ cdef class DenseCFGChart(CFGChart):
         """Get edges for item."""
         if item is None:
             return None
+        cdef size_t idx = self._compactitem(item)
         result = Edges()
-        result.len = self.parseforest[item].len
-        result.head = self.parseforest[item].head
+        result.len = self.parseforest[idx].len
+        result.head = self.parseforest[idx].head
         return result
 
     cpdef bint hasitem(self, item):
         """Test if item is in chart."""
-        return (item is not None
-                        and self.parseforest[ < size_t > item].head is not NULL)
+        return (item is not None and self.parseforest[
+                self._compactitem(item)].head is not NULL)
 
     def setprob(self, item, double prob):
         """Set probability for item (unconditionally)."""
-        cdef short start, end
-        cdef uint32_t lhs
+        self.probs[self._compactitem(item)] = prob
+
+    def _dropitems(self, items):
+        """Remove the edges of the given items (used by ``filter()``).
+
+        The memory of the edges is only released with the chart."""
         cdef size_t idx
-        lhs = item % self.grammar.nonterminals
-        item /= self.grammar.nonterminals
-        start = item / self.lensent
-        end = item % self.lensent + 1
-        idx = compactcellidx(
-            start, end, self.lensent, self.grammar.nonterminals) + lhs
-        self.probs[idx] = prob
+        for item in items:
+            idx = self._compactitem(item)
+            self.parseforest[idx].len = 0
+            self.parseforest[idx].head = NULL
 
     def __bool__(self):
         """Return true when the root item is in the chart.
 
         i.e., test whether sentence has been parsed successfully."""
-        return self.parseforest[self.root()].head is not NULL
+        return self.hasitem(self.root())
+
+
+cdef MoreEdges * poolalloc(EdgesChunk ** chunks) nogil:
+    """Get a block of edges from a linked list of chunks.
+
+    A chunk is added if necessary; the size of each new chunk is doubled, up
+    to a maximum."""
+    cdef EdgesChunk * chunk
+    cdef size_t size
+    if chunks[0] is NULL or chunks[0].len == chunks[0].size:
+        size = (16 if chunks[0] is NULL
+                else min(2 * chunks[0].size, EDGES_CHUNKSIZE))
+        chunk = <EdgesChunk * >malloc(sizeof(EdgesChunk))
+        if chunk is NULL:
+            abort()
+        chunk.data = <MoreEdges * >malloc(size * sizeof(MoreEdges))
+        if chunk.data is NULL:
+            abort()
+        chunk.size = size
+        chunk.len = 0
+        chunk.prev = chunks[0]
+        chunks[0] = chunk
+    chunks[0].len += 1
+    return &(chunks[0].data[chunks[0].len - 1])
 
 
 @cython.final
@@ -317,8 +355,10 @@ cdef class SparseCFGChart(CFGChart):
         self.probs[item] = prob
 
 
-def parse(sent, Grammar grammar, tags=None, start=None, list whitelist=None,
-          bint symbolic=False, double beam_beta=0.0, int beam_delta=50):
+def parse(sent, Grammar grammar, tags=None, start=None, whitelist=None,
+          bint symbolic=False, double beam_beta=0.0, int beam_delta=50,
+          double maxtime=0.0, size_t maxitems=0, bint twopass=False,
+          int numthreads=1):
     """A CKY parser modeled after Bodenstab's 'fast grammar loop'.
 
     :param sent: A sequence of tokens that will be parsed.
@@ -334,46 +374,78 @@ def parse(sent, Grammar grammar, tags=None, start=None, list whitelist=None,
             ``whitelist = [{label1, label2, ...}, ...]``;
             The cells are indexed as compact spans; label is an integer for a
             non-terminal label. The presence of a label means the span with that
-            label will not be pruned.
+            label will not be pruned. Alternatively, an array of bitsets with
+            a row for each cell, as returned by :py:func:`whitelistbitsets`.
     :param symbolic: If ``True``, parse sentence without regard for
             probabilities. All Viterbi probabilities will be set to ``1.0``.
     :param beam_beta: keep track of the best score in each cell and only allow
             items which are within a multiple of ``beam_beta`` of the best score.
             Should be a negative log probability. Pass ``0.0`` to disable.
     :param beam_delta: the maximum span length to which beam search is applied.
+    :param maxtime: if nonzero, stop parsing after this many seconds of wall
+            clock time.
+    :param maxitems: if nonzero, stop parsing when the chart contains more
+            than this number of items.
+    :returns: a tuple ``(chart, msg)``; if parsing was stopped because
+            ``maxtime`` or ``maxitems`` was exceeded, ``chart`` is ``None``.
+            The budget is not applied with ``symbolic=True``.
+    :param twopass: If ``True``, first run :py:func:`recognize` to find the
+            items that are part of a complete derivation, and only add those
+            items to the chart.
+    :param numthreads: If > 1, binary rules are applied to the cells of each
+            span length in parallel, by this number of threads. Only used for
+            grammars with less than 20,000 labels.
     """
     if grammar.maxfanout != 1:
         raise ValueError('Not a PCFG! fanout: %d' % grammar.maxfanout)
+    if not grammar.binarized:
+        raise ValueError('expected binarized grammar; use parse_nary().')
     if not grammar.logprob:
         raise ValueError('Expected grammar with log probabilities.')
+    cdef uint64_t[:, ::1] cellbits = None
+    if isinstance(whitelist, list):
+        whitelist = whitelistbitsets(whitelist, grammar.nonterminals)
+    if twopass:
+        whitelist, msg = recognize(sent, grammar, tags, start, whitelist)
+        if whitelist is None:
+            if grammar.nonterminals < 20000:
+                return DenseCFGChart(grammar, sent, start), msg
+            return SparseCFGChart(grammar, sent, start), msg
+    if whitelist is not None:
+        cellbits = whitelist
+        checkwhitelistshape(cellbits, grammar, len(sent))
     if grammar.nonterminals < 20000:
         chart = DenseCFGChart(grammar, sent, start)
         if symbolic:
             return parse_symbolic(sent, < DenseCFGChart > chart, grammar,
-                                  tags=tags, whitelist=whitelist)
+                                  tags=tags, whitelist=cellbits)
         return parse_main(sent, < DenseCFGChart > chart, grammar, tags,
-                          whitelist, beam_beta, beam_delta)
+                          cellbits, beam_beta, beam_delta, maxtime, maxitems,
+                          numthreads)
     chart = SparseCFGChart(grammar, sent, start)
     if symbolic:
         return parse_symbolic(sent, < SparseCFGChart > chart, grammar,
-                              tags=tags, whitelist=whitelist)
+                              tags=tags, whitelist=cellbits)
     return parse_main(sent, < SparseCFGChart > chart, grammar, tags,
-                      whitelist, beam_beta, beam_delta)
+                      cellbits, beam_beta, beam_delta, maxtime, maxitems, 1)
 
 
 cdef parse_main(sent, CFGChart_fused chart, Grammar grammar, tags,
-                list whitelist, double beam_beta, int beam_delta):
+                uint64_t[:, ::1] whitelist, double beam_beta, int beam_delta,
+                double maxtime, size_t maxitems, int numthreads):
     cdef:
+        CKYWorker worker = None
         short[:, :] minleft, maxleft, minright, maxright
         DoubleAgenda unaryagenda = DoubleAgenda()
-        set cellwhitelist = None
+        uint64_t * cellwhitelist = NULL
         ProbRule * rule
         short left, right, mid, span, lensent = len(sent)
         short narrowl, narrowr, widel, wider, minmid, maxmid
         double oldscore, prob
         uint32_t n, lhs = 0, rhs1
+        int i, slots = BITNSLOTS(grammar.nonterminals)
         size_t cell, lastidx
-        object it = None
+        double deadline = time() + maxtime if maxtime else 0.0
     minleft, maxleft, minright, maxright = minmaxmatrices(
         grammar.nonterminals, lensent)
     # assign POS tags
@@ -381,33 +453,39 @@ cdef parse_main(sent, CFGChart_fused chart, Grammar grammar, tags,
                                minleft, maxleft, minright, maxright)
     if not covered:
         return chart, msg
+    if CFGChart_fused is DenseCFGChart:
+        if numthreads > 1:
+            worker = CKYWorker()
+            worker.setup(chart, grammar, whitelist, minleft, maxleft,
+                         minright, maxright, numthreads)
 
     for span in range(2, lensent + 1):
+        if worker is not None:
+            worker.run(span, beam_beta if span <= beam_delta else 0.0)
         # constituents from left to right
         for left in range(lensent - span + 1):
             right = left + span
             cell = cellidx(left, right, lensent, grammar.nonterminals)
             lastidx = len(chart.itemsinorder)
             if whitelist is not None:
-                cellwhitelist = <set > whitelist[
-                    compactcellidx(left, right, lensent, 1)]
+                cellwhitelist = &(whitelist[
+                    compactcellidx(left, right, lensent, 1), 0])
             # apply binary rules; if whitelist is given, loop only over
             # whitelisted labels for cell; equivalent to:
             # for lhs in cellwhitelist or range(1, grammar.phrasalnonterminals):
-            if whitelist is None:
-                lhs = 0
-            else:
-                it = iter(cellwhitelist)
-            while True:
-                if whitelist is None:
+            if worker is not None:  # already done by threads
+                worker.extenditems(chart, left)
+            lhs = 0
+            while worker is None:
+                if cellwhitelist is NULL:
                     lhs += 1
                     if lhs >= grammar.phrasalnonterminals:
                         break
                 else:
-                    try:
-                        lhs = next(it)
-                    except StopIteration:
+                    i = anextset(cellwhitelist, lhs + 1, slots)
+                    if i == -1:
                         break
+                    lhs = i
                 n = 0
                 rule = &(grammar.bylhs[lhs][n])
                 oldscore = chart._subtreeprob(cell + lhs)
@@ -462,8 +540,8 @@ cdef parse_main(sent, CFGChart_fused chart, Grammar grammar, tags,
                     if rule.rhs1 != rhs1:
                         break
                     elif TESTBIT(grammar.mask, rule.no) or (
-                            whitelist is not None
-                            and rule.lhs not in cellwhitelist):
+                            cellwhitelist is not NULL
+                            and not TESTBIT(cellwhitelist, rule.lhs)):
                         continue
                     lhs = rule.lhs
                     prob = rule.prob + chart._subtreeprob(cell + rhs1)
@@ -482,22 +560,241 @@ cdef parse_main(sent, CFGChart_fused chart, Grammar grammar, tags,
                     if right > maxright[lhs, left]:
                         maxright[lhs, left] = right
             unaryagenda.clear()
+            # check budget after each cell
+            if ((maxitems and len(chart.itemsinorder) > maxitems)
+                    or (deadline and time() > deadline)):
+                if worker is not None:
+                    worker.close()
+                return None, 'budget exceeded at span %d; %s' % (
+                    span, chart.stats())
+    if worker is not None:
+        worker.close()
     if not chart:
         return chart, 'no parse ' + chart.stats()
     return chart, chart.stats()
 
 
+cdef struct CKYTask:  # the state shared by the threads of a CKYWorker
+    ProbRule ** bylhs
+    uint64_t * mask
+    uint64_t * whitelist  # a bitset of labels for each cell, or NULL
+    double * probs
+    EdgesStruct * parseforest
+    short * minleft
+    short * maxleft
+    short * minright
+    short * maxright
+    uint32_t * newitems  # labels of new items for each cell of current span
+    uint32_t * numnew  # number of new items for each cell of current span
+    uint32_t nonterminals, phrasalnonterminals, slots
+    short lensent, span
+    double beam
+
+
+@cython.final
+cdef class CKYWorker:
+    """Apply binary rules to the cells of a span length in parallel.
+
+    Each thread processes every ``numthreads``-th cell, and allocates edges
+    from its own pool; after each span length, the pools are handed over to
+    the chart and the new items are added to ``chart.itemsinorder`` by
+    ``parse_main``, in the same order as without threads."""
+    cdef CKYTask task
+    cdef EdgesChunk ** chunks  # a pool of edges for each thread
+    cdef DenseCFGChart chart
+    cdef uint64_t[:, ::1] whitelist
+    cdef int numthreads
+    cdef object pool
+
+    def __dealloc__(self):
+        free(self.task.newitems)
+        free(self.task.numnew)
+        free(self.chunks)
+
+    cdef setup(self, DenseCFGChart chart, Grammar grammar,
+               uint64_t[:, ::1] whitelist,
+               short[:, :] minleft, short[:, :] maxleft,
+               short[:, :] minright, short[:, :] maxright, int numthreads):
+        self.chart = chart
+        self.numthreads = numthreads
+        self.task.bylhs = grammar.bylhs
+        self.task.mask = grammar.mask
+        self.task.probs = chart.probs
+        self.task.parseforest = chart.parseforest
+        self.task.minleft = &(minleft[0, 0])
+        self.task.maxleft = &(maxleft[0, 0])
+        self.task.minright = &(minright[0, 0])
+        self.task.maxright = &(maxright[0, 0])
+        self.task.nonterminals = grammar.nonterminals
+        self.task.phrasalnonterminals = grammar.phrasalnonterminals
+        self.task.slots = BITNSLOTS(grammar.nonterminals)
+        self.task.lensent = chart.lensent
+        self.task.newitems = <uint32_t *>malloc(chart.lensent
+                * grammar.phrasalnonterminals * sizeof(uint32_t))
+        self.task.numnew = <uint32_t *>calloc(chart.lensent, sizeof(uint32_t))
+        self.chunks = <EdgesChunk **>calloc(numthreads, sizeof(EdgesChunk *))
+        if (self.task.newitems is NULL or self.task.numnew is NULL
+                or self.chunks is NULL):
+            raise MemoryError('allocation error')
+        if whitelist is not None:
+            self.whitelist = whitelist
+            self.task.whitelist = &(whitelist[0, 0])
+        self.pool = getthreadpool(numthreads)
+
+    def __call__(self, int thread):
+        with nogil:
+            binarycells(&(self.task), thread, self.numthreads,
+                        &(self.chunks[thread]))
+
+    cdef run(self, short span, double beam):
+        """Process the cells of a span length; hand over edges to chart."""
+        cdef EdgesChunk * chunk
+        cdef int n
+        self.task.span = span
+        self.task.beam = beam
+        self.pool.map(self, range(self.numthreads))
+        for n in range(self.numthreads):
+            while self.chunks[n] is not NULL:
+                chunk = self.chunks[n]
+                self.chunks[n] = chunk.prev
+                chunk.prev = self.chart.chunks
+                self.chart.chunks = chunk
+
+    cdef extenditems(self, CFGChart chart, short left):
+        """Add the new items of a cell of the current span to the chart."""
+        cdef size_t cell = cellidx(left, left + self.task.span,
+                                   self.task.lensent, self.task.nonterminals)
+        cdef uint32_t n
+        for n in range(self.task.numnew[left]):
+            chart.itemsinorder.append(cell + self.task.newitems[
+                left * self.task.phrasalnonterminals + n])
+
+    cdef close(self):
+        self.pool = None
+
+
+cdef dict THREADPOOLS = {}  # numthreads => (pid, ThreadPool)
+
+
+cdef getthreadpool(int numthreads):
+    """Return a pool of threads; it is reused for each sentence.
+
+    A new pool is started in a forked worker process."""
+    pid, pool = THREADPOOLS.get(numthreads, (None, None))
+    if pid != os.getpid():  # not started yet, or started before a fork
+        pool = ThreadPool(numthreads)
+        THREADPOOLS[numthreads] = (os.getpid(), pool)
+    return pool
+
+
+cdef void binarycells(CKYTask * task, short first, short step,
+                      EdgesChunk ** chunks) nogil:
+    """Apply binary rules to the cells with the current span length.
+
+    Processes the cells with left index ``first``, ``first + step``, ... ."""
+    cdef:
+        ProbRule * rule
+        EdgesStruct * edges
+        MoreEdges * edgelist
+        Edge * edge
+        short left, right, mid, span = task.span, lensent = task.lensent
+        short narrowl, narrowr, widel, wider, minmid, maxmid
+        size_t cell, item, leftitem, rightitem, stride = lensent + 1
+        uint32_t n, lhs, numnew
+        uint32_t * newitems
+        double prob
+    left = first
+    while left < lensent - span + 1:
+        right = left + span
+        cell = compactcellidx(left, right, lensent, task.nonterminals)
+        newitems = &(task.newitems[left * task.phrasalnonterminals])
+        numnew = 0
+        for lhs in range(1, task.phrasalnonterminals):
+            if task.whitelist is not NULL and not TESTBIT(&(task.whitelist[
+                    compactcellidx(left, right, lensent, 1) * task.slots]),
+                    lhs):
+                continue
+            item = cell + lhs
+            n = 0
+            rule = &(task.bylhs[lhs][n])
+            while rule.lhs == lhs:
+                narrowr = task.minright[rule.rhs1 * stride + left]
+                narrowl = task.minleft[rule.rhs2 * stride + right]
+                if (rule.rhs2 == 0 or narrowr >= right or narrowl < narrowr
+                        or TESTBIT(task.mask, rule.no)):
+                    n += 1
+                    rule = &(task.bylhs[lhs][n])
+                    continue
+                widel = task.maxleft[rule.rhs2 * stride + right]
+                minmid = narrowr if narrowr > widel else widel
+                wider = task.maxright[rule.rhs1 * stride + left]
+                maxmid = wider if wider < narrowl else narrowl
+                for mid in range(minmid, maxmid + 1):
+                    leftitem = compactcellidx(left, mid, lensent,
+                                              task.nonterminals) + rule.rhs1
+                    rightitem = compactcellidx(mid, right, lensent,
+                                               task.nonterminals) + rule.rhs2
+                    if (task.parseforest[leftitem].head is NULL
+                            or task.parseforest[rightitem].head is NULL):
+                        continue
+                    prob = (rule.prob + task.probs[leftitem]
+                            + task.probs[rightitem])
+                    # cf. DenseCFGChart.updateprob()
+                    if task.beam:
+                        if prob > task.probs[cell] + task.beam:
+                            continue
+                        elif prob < task.probs[cell]:
+                            task.probs[cell] = task.probs[item] = prob
+                        elif prob < task.probs[item]:
+                            task.probs[item] = prob
+                    elif prob < task.probs[item]:
+                        task.probs[item] = prob
+                    # cf. DenseCFGChart.addedge()
+                    edges = &(task.parseforest[item])
+                    if edges.head is NULL:
+                        edgelist = poolalloc(chunks)
+                        edgelist.prev = NULL
+                        edges.head = edgelist
+                        newitems[numnew] = lhs
+                        numnew += 1
+                    else:
+                        edgelist = edges.head
+                        if edges.len == EDGES_SIZE:
+                            edgelist = poolalloc(chunks)
+                            edgelist.prev = edges.head
+                            edges.head = edgelist
+                            edges.len = 0
+                    edge = &(edgelist.data[edges.len])
+                    edge.rule = rule
+                    edge.pos.mid = mid
+                    edges.len += 1
+                n += 1
+                rule = &(task.bylhs[lhs][n])
+            # update filter
+            if task.parseforest[item].head is not NULL:
+                if left > task.minleft[lhs * stride + right]:
+                    task.minleft[lhs * stride + right] = left
+                if left < task.maxleft[lhs * stride + right]:
+                    task.maxleft[lhs * stride + right] = left
+                if right < task.minright[lhs * stride + left]:
+                    task.minright[lhs * stride + left] = right
+                if right > task.maxright[lhs * stride + left]:
+                    task.maxright[lhs * stride + left] = right
+        task.numnew[left] = numnew
+        left += step
+
+
 cdef parse_symbolic(sent, CFGChart_fused chart, Grammar grammar,
-                    tags=None, list whitelist=None):
+                    tags=None, uint64_t[:, ::1] whitelist=None):
     cdef:
         short[:, :] minleft, maxleft, minright, maxright
         list unaryagenda
-        set cellwhitelist = None
-        object it = None
+        uint64_t * cellwhitelist = NULL
         ProbRule * rule
         short left, right, mid, span, lensent = len(sent)
         short narrowl, narrowr, widel, wider, minmid, maxmid
         uint32_t n, lhs = 0, rhs1
+        int i, slots = BITNSLOTS(grammar.nonterminals)
         size_t cell, lastidx
         bint haditem
     minleft, maxleft, minright, maxright = minmaxmatrices(
@@ -515,26 +812,23 @@ cdef parse_symbolic(sent, CFGChart_fused chart, Grammar grammar,
             cell = cellidx(left, right, lensent, grammar.nonterminals)
             lastidx = len(chart.itemsinorder)
             if whitelist is not None:
-                cellwhitelist = <set > whitelist[
-                    compactcellidx(left, right, lensent, 1)]
+                cellwhitelist = &(whitelist[
+                    compactcellidx(left, right, lensent, 1), 0])
             # apply binary rules; if whitelist is given, loop only over
             # whitelisted labels for cell
             # for lhs in (range(1, grammar.phrasalnonterminals)
             # 		if whitelist is None else cellwhitelist):
-            if whitelist is None:
-                lhs = 0
-            else:
-                it = iter(cellwhitelist)
+            lhs = 0
             while True:
-                if whitelist is None:
+                if cellwhitelist is NULL:
                     lhs += 1
                     if lhs >= grammar.phrasalnonterminals:
                         break
                 else:
-                    try:
-                        lhs = next(it)
-                    except StopIteration:
+                    i = anextset(cellwhitelist, lhs + 1, slots)
+                    if i == -1:
                         break
+                    lhs = i
                 n = 0
                 rule = &(grammar.bylhs[lhs][n])
                 haditem = chart.hasitem(cell + lhs)
@@ -583,8 +877,8 @@ cdef parse_symbolic(sent, CFGChart_fused chart, Grammar grammar,
                     if rule.rhs1 != rhs1:
                         break
                     elif TESTBIT(grammar.mask, rule.no) or (
-                            whitelist is not None
-                            and rule.lhs not in cellwhitelist):
+                            cellwhitelist is not NULL
+                            and not TESTBIT(cellwhitelist, rule.lhs)):
                         continue
                     lhs = rule.lhs
                     chart.addedge(lhs, left, right, right, rule)
@@ -604,8 +898,212 @@ cdef parse_symbolic(sent, CFGChart_fused chart, Grammar grammar,
     return chart, chart.stats()
 
 
-cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags, whitelist,
-                 bint symbolic, short[:, :] minleft, short[:, :] maxleft,
+def recognize(sent, Grammar grammar, tags=None, start=None,
+              whitelist=None):
+    """Find the items that are part of a complete derivation of a sentence.
+
+    A symbolic CKY recognizer, in which the labels of each span are stored as
+    a bitset, followed by a top-down pass from the root to find the items
+    that can be reached from it. No edges or probabilities are stored.
+
+    :param tags, start, whitelist: cf. :py:func:`parse`.
+    :returns: a tuple ``(whitelist, msg)``; ``whitelist`` contains the
+            reachable items, as an array of bitsets in the format of the
+            ``whitelist`` parameter of :py:func:`parse`; it is ``None`` if the
+            sentence cannot be recognized."""
+    cdef:
+        short left, right, mid, span, lensent = len(sent)
+        size_t slots = BITNSLOTS(grammar.nonterminals)
+        size_t numcells = compactcellidx(lensent - 1, lensent, lensent, 1) + 1
+        uint64_t * chart = NULL  # chart[cell * slots] => bitset of labels
+        uint64_t * reach  # reachable items, same layout as chart
+        uint64_t[:, ::1] result, cellbits = None
+        uint64_t * cur
+        uint64_t * lcell
+        uint64_t * rcell
+        ProbRule * rule
+        LexicalRule lexrule
+        uint32_t n, lhs, rhs1, startlabel
+        int i
+        size_t numitems = 0
+        list agenda
+        uint64_t * cellwhitelist = NULL
+    startlabel = grammar.toid[grammar.start if start is None else start]
+    if isinstance(whitelist, list):
+        whitelist = whitelistbitsets(whitelist, grammar.nonterminals)
+    if whitelist is not None:
+        cellbits = whitelist
+        checkwhitelistshape(cellbits, grammar, lensent)
+    result = np.zeros((numcells, slots), dtype=np.uint64)
+    reach = &(result[0, 0])
+    chart = <uint64_t *>calloc(numcells * slots, sizeof(uint64_t))
+    if chart is NULL:
+        raise MemoryError('allocation error')
+    try:
+        # bottom-up: POS tags
+        for left, word in enumerate(sent):
+            right = left + 1
+            cur = &(chart[compactcellidx(left, right, lensent, 1) * slots])
+            if cellbits is not None:
+                cellwhitelist = &(cellbits[
+                    compactcellidx(left, right, lensent, 1), 0])
+            tag = tags[left] if tags else None
+            tagre = (re.compile('%s($|@|\\^|/)' % re.escape(tag))
+                     if tags else None)
+            agenda = []
+            for lexrule in grammar.lexicalbyword.get(word, ()):
+                if cellwhitelist is not NULL and not TESTBIT(
+                        cellwhitelist, lexrule.lhs):
+                    continue
+                if tag is None or tagre.match(grammar.tolabel[lexrule.lhs]):
+                    SETBIT(cur, lexrule.lhs)
+                    agenda.append(lexrule.lhs)
+            if not agenda and tag is not None:
+                for lhs in grammar.lexicalbylhs:
+                    if tagre.match(grammar.tolabel[lhs]):
+                        SETBIT(cur, lhs)
+                        agenda.append(lhs)
+            if not agenda:
+                if tag is None and word not in grammar.lexicalbyword:
+                    return None, 'no parse: %r not in lexicon' % word
+                elif tag is not None and tag not in grammar.toid:
+                    return None, 'no parse: unknown tag %r' % tag
+                return None, 'no parse: all tags for %r blocked' % word
+            unaryclosure(grammar, cur, agenda, cellwhitelist)
+        # bottom-up: binary and unary rules
+        for span in range(2, lensent + 1):
+            for left in range(lensent - span + 1):
+                right = left + span
+                cur = &(chart[compactcellidx(left, right, lensent, 1) * slots])
+                if cellbits is not None:
+                    cellwhitelist = &(cellbits[
+                        compactcellidx(left, right, lensent, 1), 0])
+                agenda = []
+                for mid in range(left + 1, right):
+                    lcell = &(chart[compactcellidx(
+                        left, mid, lensent, 1) * slots])
+                    rcell = &(chart[compactcellidx(
+                        mid, right, lensent, 1) * slots])
+                    i = anextset(lcell, 1, slots)
+                    while i != -1:
+                        rhs1 = i
+                        i = anextset(lcell, rhs1 + 1, slots)
+                        n = 0
+                        rule = &(grammar.lbinary[rhs1][n])
+                        while rule.rhs1 == rhs1:
+                            if (TESTBIT(rcell, rule.rhs2)
+                                    and not TESTBIT(cur, rule.lhs)
+                                    and not TESTBIT(grammar.mask, rule.no)
+                                    and (cellwhitelist is NULL
+                                        or TESTBIT(cellwhitelist, rule.lhs))):
+                                SETBIT(cur, rule.lhs)
+                                agenda.append(rule.lhs)
+                            n += 1
+                            rule = &(grammar.lbinary[rhs1][n])
+                unaryclosure(grammar, cur, agenda, cellwhitelist)
+        cur = &(chart[compactcellidx(0, lensent, lensent, 1) * slots])
+        if not TESTBIT(cur, startlabel):
+            return None, 'no parse: sentence not recognized'
+        # top-down: mark items reachable from the root
+        SETBIT(&(reach[compactcellidx(0, lensent, lensent, 1) * slots]),
+               startlabel)
+        for span in range(lensent, 0, -1):
+            for left in range(lensent - span + 1):
+                right = left + span
+                cur = &(chart[compactcellidx(left, right, lensent, 1) * slots])
+                rcell = &(reach[compactcellidx(left, right, lensent, 1)
+                                * slots])
+                agenda = []
+                i = anextset(rcell, 1, slots)
+                while i != -1:
+                    agenda.append(i)
+                    i = anextset(rcell, i + 1, slots)
+                while agenda:
+                    lhs = agenda.pop()
+                    numitems += 1
+                    n = 0
+                    rule = &(grammar.bylhs[lhs][n])
+                    while rule.lhs == lhs:
+                        if TESTBIT(grammar.mask, rule.no):
+                            pass
+                        elif rule.rhs2 == 0:
+                            if (TESTBIT(cur, rule.rhs1)
+                                    and not TESTBIT(rcell, rule.rhs1)):
+                                SETBIT(rcell, rule.rhs1)
+                                agenda.append(rule.rhs1)
+                        else:
+                            for mid in range(left + 1, right):
+                                lcell = &(chart[compactcellidx(
+                                    left, mid, lensent, 1) * slots])
+                                if not TESTBIT(lcell, rule.rhs1):
+                                    continue
+                                lcell = &(chart[compactcellidx(
+                                    mid, right, lensent, 1) * slots])
+                                if not TESTBIT(lcell, rule.rhs2):
+                                    continue
+                                SETBIT(&(reach[compactcellidx(
+                                    left, mid, lensent, 1) * slots]),
+                                    rule.rhs1)
+                                SETBIT(&(reach[compactcellidx(
+                                    mid, right, lensent, 1) * slots]),
+                                    rule.rhs2)
+                        n += 1
+                        rule = &(grammar.bylhs[lhs][n])
+    finally:
+        free(chart)
+    return result.base, 'recognized items: %d' % numitems
+
+
+cdef unaryclosure(Grammar grammar, uint64_t * cell, list agenda,
+                  uint64_t * cellwhitelist):
+    """Apply unary rules to the labels in ``agenda``.
+
+    The new labels are added to the bitset ``cell`` and to ``agenda``."""
+    cdef ProbRule * rule
+    cdef uint32_t n, rhs1
+    while agenda:
+        rhs1 = agenda.pop()
+        for n in range(grammar.numunary):
+            rule = &(grammar.unary[rhs1][n])
+            if rule.rhs1 != rhs1:
+                break
+            elif (TESTBIT(cell, rule.lhs) or TESTBIT(grammar.mask, rule.no)
+                    or (cellwhitelist is not NULL
+                        and not TESTBIT(cellwhitelist, rule.lhs))):
+                continue
+            SETBIT(cell, rule.lhs)
+            agenda.append(rule.lhs)
+
+
+def whitelistbitsets(list whitelist, uint32_t nonterminals):
+    """Convert a whitelist with a set of labels for each cell to an array.
+
+    The array has a row of ``BITNSLOTS(nonterminals)`` 64-bit words for each
+    cell."""
+    cdef uint64_t[:, ::1] result = np.zeros(
+        (len(whitelist), BITNSLOTS(nonterminals)), dtype=np.uint64)
+    cdef size_t cell
+    cdef uint32_t label
+    for cell, labels in enumerate(whitelist):
+        for label in labels:
+            SETBIT(&(result[cell, 0]), label)
+    return result.base
+
+
+cdef checkwhitelistshape(uint64_t[:, ::1] whitelist, Grammar grammar,
+                         short lensent):
+    """Raise ValueError unless whitelist has a bitset for each cell."""
+    cdef size_t numcells = (compactcellidx(lensent - 1, lensent, lensent, 1)
+                            + 1 if lensent else 0)
+    if (<size_t>whitelist.shape[0] != numcells or <size_t>whitelist.shape[1]
+            != <size_t>BITNSLOTS(grammar.nonterminals)):
+        raise ValueError('expected whitelist with shape %r; got %r' % (
+            (numcells, BITNSLOTS(grammar.nonterminals)),
+            (whitelist.shape[0], whitelist.shape[1])))
+
+
+cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags,
+                 uint64_t[:, ::1] whitelist, bint symbolic, short[:, :] minleft, short[:, :] maxleft,
                  short[:, :] minright, short[:, :] maxright):
     """Apply all possible lexical and unary rules on each lexical span.
 
@@ -626,9 +1124,8 @@ cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags, whitelist,
         right = left + 1
         recognized = False
         for lexrule in grammar.lexicalbyword.get(word, ()):
-            # assert whitelist is None or cell in whitelist, whitelist.keys()
-            if whitelist is not None and lexrule.lhs not in whitelist[
-                    compactcellidx(left, right, lensent, 1)]:
+            if whitelist is not None and not TESTBIT(&(whitelist[
+                    compactcellidx(left, right, lensent, 1), 0]), lexrule.lhs):
                 continue
             lhs = lexrule.lhs
             if tag is None or tagre.match(grammar.tolabel[lhs]):
@@ -680,8 +1177,9 @@ cdef populatepos(Grammar grammar, CFGChart_fused chart, sent, tags, whitelist,
                     break
                 elif TESTBIT(grammar.mask, rule.no) or (
                     whitelist is not None
-                    and rule.lhs not in whitelist[
-                        compactcellidx(left, right, lensent, 1)]):
+                    and not TESTBIT(&(whitelist[
+                        compactcellidx(left, right, lensent, 1), 0]),
+                        rule.lhs)):
                     continue
                 lhs = rule.lhs
                 item = cellidx(left, right, lensent, grammar.nonterminals) + lhs
@@ -716,6 +1214,141 @@ def minmaxmatrices(nonterminals, lensent):
     return minleft, maxleft, minright, maxright
 
 
+def binarizegrammar(Grammar grammar):
+    """Binarize a PCFG with n-ary rules for use with :py:func:`parse_nary`.
+
+    A rule with more than two non-terminals on its right-hand side is replaced
+    by a left-branching chain of binary rules, with intermediate labels of the
+    form ``@<A,B>`` for a prefix ``A B`` of the right-hand side. Intermediate
+    rules get probability 1 and are shared by rules with a common prefix, so
+    that this is a dotted-rule binarization. The last rule of each chain
+    carries the weight of the original rule, so that the result defines the
+    same distribution over derivations; it contains all probabilistic models
+    of ``grammar``, under the same names.
+
+    :returns: a new, binarized ``Grammar`` object."""
+    cdef list lines = [], ruleidx = []
+    cdef set intermediates = set()
+    cdef int n = 0, m
+    if grammar.maxfanout != 1:
+        raise ValueError('Not a PCFG! fanout: %d' % grammar.maxfanout)
+    for line in grammar.origrules.splitlines():
+        if not line.strip():
+            continue
+        fields = line.split()
+        if grammar.bitpar:
+            weight, lhs, rhs = fields[0], fields[1], fields[2:]
+        else:  # put right-hand side in surface order
+            lhs, yf, weight = fields[0], fields[len(fields) - 2], fields[
+                len(fields) - 1]
+            rhs = [fields[1 + int(a)] for a in yf]
+        prev = rhs[0]
+        for m in range(1, len(rhs) - 1):
+            label = '@<%s>' % ','.join(rhs[:m + 1])
+            if label not in intermediates:
+                intermediates.add(label)
+                lines.append('%s\t%s\t%s\t01\t1' % (label, prev, rhs[m]))
+                ruleidx.append(-1)
+            prev = label
+        # the original weights are kept as they are, so that frequencies are
+        # normalized in the same way as those of the original grammar; an
+        # intermediate label has a single rule, which gets probability 1.
+        if len(rhs) == 1:
+            lines.append('%s\t%s\t0\t%s' % (lhs, prev, weight))
+        else:
+            lines.append('%s\t%s\t%s\t01\t%s' % (
+                lhs, prev, rhs[len(rhs) - 1], weight))
+        ruleidx.append(n)
+        n += 1
+    result = Grammar('\n'.join(lines) + '\n', grammar.origlexicon,
+                     start=grammar.start)
+    idx = np.array(ruleidx, dtype=np.int64)
+    phrasal = idx >= 0
+    for m, name in enumerate(grammar.modelnames[1:], 1):
+        weights = np.ones(result.numrules + len(result.lexical))
+        weights[:result.numrules][phrasal] = grammar.models[m, idx[phrasal]]
+        weights[result.numrules:] = grammar.models[m, grammar.numrules:]
+        result.register(name, weights)
+    return result
+
+
+def parse_nary(sent, Grammar grammar, int n, tags=None, auxgrammar=None,
+               whitelist=None, double maxtime=0.0, size_t maxitems=0):
+    """Parse with a PCFG that may contain n-ary rules, produce n-best list.
+
+    A native alternative to :py:func:`parse_bitpar`. A binarized grammar is
+    parsed with directly; otherwise, the sentence is parsed with a binarized
+    version of the grammar, and intermediate nodes are removed from the
+    derivations.
+
+    :param n: the number of derivations to return.
+    :param auxgrammar: the result of ``binarizegrammar(grammar)``; if not
+            given, it is computed on the fly. Not used if ``grammar`` is
+            binarized.
+    :param whitelist: a whitelist with the labels of ``grammar``, cf.
+            :py:func:`parse`; the intermediate labels of ``auxgrammar`` are
+            not pruned.
+    :param maxtime, maxitems: cf. :py:func:`parse`.
+    :returns: a tuple ``(chart, msg)``; ``chart`` is a ``SparseCFGChart``
+            for ``grammar`` with the n-best derivations as strings in
+            ``chart.rankededges[chart.root()]``, in the same way as the chart
+            produced by :py:func:`parse_bitpar`; it is ``None`` if
+            ``maxtime`` or ``maxitems`` was exceeded. With a binarized
+            grammar, this is the chart of :py:func:`parse`; otherwise, it
+            contains no other items."""
+    cdef Chart result
+    from .kbest import lazykbest
+    if grammar.binarized:
+        result, msg = parse(sent, grammar, tags=tags, whitelist=whitelist,
+                            maxtime=maxtime, maxitems=maxitems)
+        if result:
+            derivations, _ = lazykbest(result, n)
+            result.rankededges = {result.root(): derivations}
+        return result, msg
+    if auxgrammar is None:
+        auxgrammar = binarizegrammar(grammar)
+    auxgrammar.switch(grammar.modelnames[grammar.currentmodel], logprob=True)
+    if isinstance(whitelist, list):
+        whitelist = whitelistbitsets(whitelist, grammar.nonterminals)
+    if whitelist is not None:
+        whitelist = auxwhitelist(whitelist, grammar, auxgrammar)
+    chart = SparseCFGChart(grammar, list(sent), logprob=True, viterbi=True)
+    chart.rankededges = {chart.root(): []}
+    auxchart, msg = parse(sent, auxgrammar, tags=tags, whitelist=whitelist,
+                          maxtime=maxtime, maxitems=maxitems)
+    if auxchart is None:
+        return None, msg
+    elif not auxchart:
+        return chart, msg
+    derivations, _ = lazykbest(auxchart, n, '@<')
+    chart.parseforest = {chart.root(): Edges()}  # dummy; bool(chart) == True
+    chart.rankededges[chart.root()] = derivations
+    return chart, msg
+
+
+def auxwhitelist(whitelist, Grammar grammar, Grammar auxgrammar):
+    """Translate a whitelist to the labels of a binarized grammar.
+
+    :param whitelist: an array of bitsets with labels of ``grammar``.
+    :param auxgrammar: the result of ``binarizegrammar(grammar)``; its
+            intermediate labels are not pruned."""
+    cdef uint64_t[:, ::1] orig = whitelist
+    cdef uint64_t[:, ::1] result = np.zeros(
+        (orig.shape[0], BITNSLOTS(auxgrammar.nonterminals)), dtype=np.uint64)
+    cdef size_t cell
+    cdef uint32_t label
+    cdef int mapped
+    cdef list labelmap = [grammar.toid.get(a, -1) for a in auxgrammar.tolabel]
+    if <size_t>orig.shape[1] != BITNSLOTS(grammar.nonterminals):
+        raise ValueError('whitelist does not match grammar.')
+    for label in range(auxgrammar.nonterminals):
+        mapped = labelmap[label]
+        for cell in range(<size_t>orig.shape[0]):
+            if mapped == -1 or TESTBIT(&(orig[cell, 0]), mapped):
+                SETBIT(&(result[cell, 0]), label)
+    return result.base
+
+
 BITPARUNESCAPE = re.compile(r"\\([\"\\ $\^'()\[\]{}=<>#])")
 BITPARPARSES = re.compile(r'^vitprob=(.*)\n(\(.*\))\n', re.MULTILINE)
 BITPARPARSESLOG = re.compile(r'^logvitprob=(.*)\n(\(.*\))\n', re.MULTILINE)
@@ -724,15 +1357,19 @@ LOG10 = pylog(10)
 
 
 def parse_bitpar(grammar, rulesfile, lexiconfile, sent, n,
-                 startlabel, startid, tags=None):
+                 startlabel, startid, tags=None, coprocess=None):
     """Parse a sentence with bitpar, given filenames of rules and lexicon.
 
     :param n: the number of derivations to return (max 1000); if n == 0, return
             parse forest instead of n-best list (requires binarized grammar).
+    :param coprocess: optionally, a :py:class:`BitparCoprocess` started with
+            the same grammar and value for ``n``; if given, the sentence is
+            parsed with this process, unless ``tags`` are given, which require
+            a lexicon specific to the sentence.
     :returns: a dictionary of derivations with their probabilities."""
-    if n < 1 or n > 1000:
+    if n < 0 or n > 1000:
         raise ValueError('with bitpar number of derivations n should be '
-                         '1 <= n <= 1000. got: n = %d' % n)
+                         '0 <= n <= 1000. got: n = %d' % n)
     chart = SparseCFGChart(grammar, sent, start=startlabel,
                            logprob=True, viterbi=True)
     if n == 0:
@@ -741,6 +1378,33 @@ def parse_bitpar(grammar, rulesfile, lexiconfile, sent, n,
                              'expected binarized grammar.')
     else:
         chart.rankededges = {chart.root(): []}
+    if coprocess is not None and not tags:
+        results, msg, cputime = coprocess.parse(sent)
+    else:
+        results, msg, cputime = bitpar_subprocess(
+            rulesfile, lexiconfile, sent, n, startlabel, tags)
+    if not results or results.startswith('No parse'):
+        return chart, cputime, '%s\n%s' % (results.strip(), msg)
+    elif n == 0:
+        bitpar_yap_forest(results, chart)
+    else:
+        bitpar_nbest(results, chart)
+    return chart, cputime, ''
+
+
+def bitparargs(rulesfile, lexiconfile, n, startlabel):
+    """Return command line for bitpar."""
+    # pass empty 'unkwown word file' to disable bitpar's smoothing
+    args = ['-y'] if n == 0 else ['-b', str(n)]
+    return [which('bitpar')] + args + [
+        '-s', startlabel, '-vp', '-u', '/dev/null', rulesfile, lexiconfile]
+
+
+def bitpar_subprocess(rulesfile, lexiconfile, sent, n, startlabel, tags):
+    """Run bitpar on a single sentence.
+
+    :returns: a tuple ``(results, msg, cputime)`` with bitpar's output and
+        messages."""
     tmp = None
     if tags:
         import tempfile
@@ -750,30 +1414,105 @@ def parse_bitpar(grammar, rulesfile, lexiconfile, sent, n,
                             for t, w in zip(tags, sent)]))
         tmp.close()
         lexiconfile = tmp.name
-    tokens = [token.encode('utf8') for token in sent]
+    tokens = list(sent)
     if tags:
         tokens = ['%s@%s' % (tag, token) for tag, token in zip(tags, tokens)]
-    # pass empty 'unkwown word file' to disable bitpar's smoothing
-    args = ['-y'] if n == 0 else ['-b', str(n)]
-    args += ['-s', startlabel, '-vp', '-u', '/dev/null', rulesfile, lexiconfile]
-    proc = subprocess.Popen([which('bitpar')] + args,
+    proc = subprocess.Popen(bitparargs(rulesfile, lexiconfile, n, startlabel),
                             shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
     results, msg = proc.communicate(('\n'.join(tokens) + '\n').encode('utf8'))
-    msg = msg.replace('Warning: Word class 0 did not occur!\n',
-                      '').decode('utf8').strip()
+    msg = msg.decode('utf8').replace(
+        'Warning: Word class 0 did not occur!\n', '').strip()
     match = CPUTIME.search(msg)
     cputime = float(match.group(1)) if match else 0.0
     if tags:
         unlink(tmp.name)
-    # decode results or not?
-    if not results or results.startswith('No parse'):
-        return chart, cputime, '%s\n%s' % (results.decode('utf8').strip(), msg)
-    elif n == 0:
-        bitpar_yap_forest(results, chart)
-    else:
-        bitpar_nbest(results, chart)
-    return chart, cputime, ''
+    return results.decode('utf8'), msg, cputime
+
+
+class BitparCoprocess(object):
+    """A bitpar process that keeps a grammar loaded to parse many sentences.
+
+    :param rulesfile, lexiconfile, n, startlabel: cf. :py:func:`parse_bitpar`.
+
+    Sentences are written to the standard input of bitpar one at a time. Each
+    sentence is followed by a dummy sentence with an unknown word, for which
+    bitpar reports a parse failure; this message marks the end of the output
+    for the actual sentence. The process exits when its input is closed.
+    Messages of bitpar are collected in a temporary file, since a pipe that
+    is not read would eventually block bitpar.
+
+    Requires ``stdbuf`` (GNU coreutils) to make bitpar flush its output after
+    each line; raises ValueError when it is not available."""
+    EOS = '__EOS__'
+
+    def __init__(self, rulesfile, lexiconfile, n, startlabel):
+        self.n = n
+        self.pid = os.getpid()
+        cmd = bitparargs(rulesfile, lexiconfile, n, startlabel)
+        # ask for line buffered output; by default, output to a pipe is only
+        # flushed when the buffer is full, and parse() would block forever.
+        cmd = [which('stdbuf'), '-oL'] + cmd
+        self.stderr, self.offset = tempfile.TemporaryFile(), 0
+        self.proc = subprocess.Popen(cmd, shell=False, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=self.stderr)
+
+    def parse(self, sent):
+        """Parse a sentence with bitpar.
+
+        :returns: a tuple ``(results, msg, cputime)`` as with
+            :py:func:`bitpar_subprocess`."""
+        begin = self.cputime()
+        self.proc.stdin.write(('%s\n\n%s\n\n' % (
+            '\n'.join(sent), self.EOS)).encode('utf8'))
+        self.proc.stdin.flush()
+        result = []
+        for line in iter(self.proc.stdout.readline, b''):
+            line = line.decode('utf8')
+            if line.startswith('No parse') and self.EOS in line:
+                return ''.join(result), self.messages(), self.cputime() - begin
+            result.append(line)
+        raise ValueError('bitpar exited unexpectedly; return code: %r\n%s' % (
+            self.proc.wait(), self.messages()))
+
+    def messages(self):
+        """Return the messages bitpar wrote since the previous call."""
+        # bitpar writes at the file offset it shares with us; reading leaves
+        # that offset at the end of the file.
+        self.stderr.seek(self.offset)
+        msg = self.stderr.read()
+        self.offset += len(msg)
+        msg = msg.decode('utf8').replace(
+            'Warning: Word class 0 did not occur!\n', '')
+        return '\n'.join([line for line in msg.splitlines()
+                          if self.EOS not in line]).strip()
+
+    def cputime(self):
+        """Return the CPU time used by the bitpar process, in seconds.
+
+        Read from ``/proc``; where it is not available, the wall-clock time
+        is returned instead, so that only differences are meaningful."""
+        try:
+            inp = open('/proc/%d/stat' % self.proc.pid)
+        except (IOError, OSError):
+            return time()
+        try:
+            fields = inp.read().rsplit(')', 1)[1].split()
+        finally:
+            inp.close()
+        # fields 14 and 15 of stat: user and system time in clock ticks
+        return ((int(fields[11]) + int(fields[12]))
+                / float(os.sysconf('SC_CLK_TCK')))
+
+    def close(self):
+        """Stop the bitpar process.
+
+        Does nothing if it was started by another process (i.e., before a
+        fork)."""
+        if self.pid == os.getpid() and self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.stderr.close()
 
 
 def bitpar_yap_forest(forest, SparseCFGChart chart):
@@ -826,7 +1565,7 @@ def bitpar_nbest(nbest, SparseCFGChart chart):
     if not derivs:
         derivs = [(renumber(deriv), -pylog(float(prob) or 5.e-130))
                   for prob, deriv in BITPARPARSES.findall(lines)]
-    chart.parseforest = {chart.root(): None}  # dummy so bool(chart) == True
+    chart.parseforest = {chart.root(): Edges()}  # dummy; bool(chart) == True
     chart.rankededges[chart.root()] = derivs
 
 
@@ -889,4 +1628,6 @@ def test():
 
 
 __all__ = ['CFGChart', 'DenseCFGChart', 'SparseCFGChart', 'parse', 'renumber',
-           'minmaxmatrices', 'parse_bitpar', 'bitpar_yap_forest', 'bitpar_nbest']
+           'minmaxmatrices', 'parse_bitpar', 'bitpar_yap_forest', 'bitpar_nbest',
+           'BitparCoprocess', 'binarizegrammar', 'parse_nary', 'recognize',
+           'whitelistbitsets']
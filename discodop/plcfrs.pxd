@@ -1,13 +1,14 @@
 cimport cython
 from libc.string cimport memcmp
-from libc.stdlib cimport malloc, calloc, free, abort
+from libc.stdlib cimport malloc, calloc, realloc, free, abort
 from libc.stdint cimport uint8_t, uint32_t, uint64_t
 from cpython.list cimport PyList_GET_ITEM, PyList_GET_SIZE
 from cpython.set cimport PySet_Contains
 from cpython.float cimport PyFloat_AS_DOUBLE
 from .containers cimport Chart, Grammar, ProbRule, LexicalRule, \
     ChartItem, SmallChartItem, FatChartItem, new_SmallChartItem, \
-    new_FatChartItem, Edge, Edges, MoreEdges, Chart, CFGtoFatChartItem
+    new_FatChartItem, Edge, Edges, MoreEdges, Chart, CFGtoFatChartItem, \
+    LCFRSWhitelist
 from .bit cimport nextset, nextunset, bitcount, bitlength, \
     testbit, anextset, anextunset, abitcount, abitlength, setunion
 from libc.string cimport memset, memcpy
@@ -30,6 +31,8 @@ ctypedef fused LCFRSItem_fused:
 cdef class LCFRSChart(Chart):
     cdef readonly dict parseforest  # chartitem => Edges(...)
     cdef list probs
+    cdef list bystart  # label => list with items for each start position
+    cdef list byend  # label => items for each end of their first component
     cdef void addlexedge(self, item, short wordidx)
     cdef void updateprob(self, ChartItem item, double prob)
     cdef void addprob(self, ChartItem item, double prob)
@@ -51,6 +54,40 @@ cdef class FatLCFRSChart(LCFRSChart):
                       ProbRule * rule)
 
 
+cdef struct EstimateTable:  # a view of a 4-dimensional array of estimates
+    char * data
+    Py_ssize_t strides[4]
+    bint single  # True for an array of floats, False for doubles
+
+
+cdef struct PackedItem:  # 40 bytes
+    uint64_t vec
+    double prob
+    MoreEdges * head  # linked list of edges; NULL if item has no edges
+    uint32_t label
+    uint32_t nextbystart  # next item with same label and start, plus one
+    uint32_t nextbyend  # next item with same label and end of 1st component
+    short len  # the number of edges in the head of the linked list
+    uint8_t popped  # whether item has been popped from the agenda
+
+
+@cython.final
+cdef class PackedLCFRSChart(LCFRSChart):
+    cdef PackedItem * items  # array of items; index is used as itemid
+    cdef uint32_t * table  # hash table with indices to items, plus one
+    cdef uint32_t * startheads  # [label, start] => index of item, plus one
+    cdef uint32_t * endheads  # [label, end of first component] => idem
+    cdef size_t numitems, allocated, tablesize, numedges
+    cdef SmallChartItem tmpitem
+    cdef long getslot(self, uint32_t label, uint64_t vec)
+    cdef long newslot(self, uint32_t label, uint64_t vec,
+                      double prob) except -1
+    cdef Edge * newedge(self, size_t slot)
+    cdef void indexslot(self, size_t slot)
+    cdef SmallChartItem asitem(self, size_t slot)
+    cdef _lookup(self, uint32_t label, uint64_t vec)
+
+
 # FIXME: Entry/Agenda are used in multiple modules; put in containers?
 @cython.final
 cdef class Entry:
@@ -103,4 +140,30 @@ cdef class DoubleAgenda(Agenda):
     cdef DoubleEntry peekentry(self)
     cdef update_entries(self, list entries)
 
+cdef struct RadixEntry:
+    uint64_t prio  # bit pattern of priority
+    uint32_t key
+
+
+@cython.final
+cdef class RadixAgenda:
+    cdef RadixEntry * buckets[65]
+    cdef size_t bucketlen[65]
+    cdef size_t bucketcap[65]
+    cdef uint64_t * prios  # key => bit pattern of priority plus one, or 0
+    cdef size_t numkeys
+    cdef uint64_t length
+    cdef uint64_t last  # minimum priority when buckets were last rearranged
+    cdef uint64_t popped  # priority of last popped item
+    cdef int _push(self, uint32_t key, uint64_t prio) except -1
+    cdef int setitem(self, uint32_t key, double value) except -1
+    cdef int setifbetter(self, uint32_t key, double value) except -1
+    cdef bint contains(self, uint32_t key)
+    cdef double getitem(self, uint32_t key)
+    cdef long popkey(self) except -1
+
+ctypedef fused PackedAgenda:
+    DoubleAgenda
+    RadixAgenda
+
 cdef list nsmallest(int n, list entries)
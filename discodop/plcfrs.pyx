@@ -4,6 +4,7 @@ Expects binarized, epsilon-free, monotone LCFRS grammars."""
 from __future__ import print_function
 import re
 import logging
+from time import time
 import numpy as np
 cimport cython
 include "constants.pxi"
@@ -34,6 +35,8 @@ cdef class LCFRSChart(Chart):
         self.logprob = logprob
         self.viterbi = viterbi
         self.probs = grammar.nonterminals * [None]
+        self.bystart = grammar.nonterminals * [None]
+        self.byend = grammar.nonterminals * [None]
         self.parseforest = {}
         self.itemsinorder = []
 
@@ -158,7 +161,6 @@ cdef class SmallLCFRSChart(LCFRSChart):
         return self.probs[self.tmpitem.label][self.tmpitem]
 
     def indices(self, SmallChartItem item):
-        cdef short n
         return [n for n in range(len(self.sent)) if testbit(item.vec, n)]
 
     cdef copy(self, item):
@@ -232,7 +234,6 @@ cdef class FatLCFRSChart(LCFRSChart):
         return self.probs[self.tmpitem.label][self.tmpitem]
 
     def indices(self, FatChartItem item):
-        cdef short n
         return [n for n in range(len(self.sent)) if TESTBIT(item.vec, n)]
 
     cdef copy(self, item):
@@ -246,10 +247,269 @@ cdef class FatLCFRSChart(LCFRSChart):
         return self.probs[item.label].get(item, item)
 
 
+@cython.final
+cdef class PackedLCFRSChart(LCFRSChart):
+    """An LCFRS chart with items stored as structs in an array.
+
+    For sentences that fit into a single machine word; items are not
+    ``SmallChartItem`` objects.
+
+    An item is found through a hash table from ``(label, vec)`` to its index
+    in the array; this index is also used as ``itemid``. ``SmallChartItem``
+    objects are only created when the chart is accessed from Python, e.g.,
+    by ``getitems()`` or during *k*-best extraction."""
+
+    def __init__(self, Grammar grammar, list sent,
+                 start=None, logprob=True, viterbi=True):
+        cdef size_t n
+        super(PackedLCFRSChart, self).__init__(
+            grammar, sent, start, logprob, viterbi)
+        if self.lensent >= sizeof(COMPONENT.vec) * 8:
+            raise ValueError('sentence too long for PackedLCFRSChart')
+        self.parseforest = None
+        self.probs = self.bystart = self.byend = None
+        self.tmpitem = new_SmallChartItem(0, 0)
+        self.allocated = 1024
+        self.tablesize = 2 * self.allocated
+        n = grammar.nonterminals * (self.lensent + 1)
+        self.items = <PackedItem * >malloc(self.allocated * sizeof(PackedItem))
+        self.table = <uint32_t * >calloc(self.tablesize, sizeof(uint32_t))
+        self.startheads = <uint32_t * >calloc(n, sizeof(uint32_t))
+        self.endheads = <uint32_t * >calloc(n, sizeof(uint32_t))
+        if (self.items is NULL or self.table is NULL
+                or self.startheads is NULL or self.endheads is NULL):
+            raise MemoryError('allocation error')
+        self.itemsinorder = range(0)
+
+    def __dealloc__(self):
+        cdef MoreEdges * edgelist
+        cdef MoreEdges * tmp
+        cdef size_t n
+        if self.items is not NULL:
+            for n in range(self.numitems):
+                edgelist = self.items[n].head
+                while edgelist is not NULL:
+                    tmp = edgelist
+                    edgelist = edgelist.prev
+                    free(tmp)
+        free(self.items)
+        free(self.table)
+        free(self.startheads)
+        free(self.endheads)
+
+    cdef long getslot(self, uint32_t label, uint64_t vec):
+        """Return index of item, or -1 if not in chart."""
+        cdef size_t mask = self.tablesize - 1
+        cdef size_t n = hashitem(label, vec) & mask
+        cdef uint32_t slot
+        while self.table[n]:
+            slot = self.table[n] - 1
+            if self.items[slot].vec == vec and self.items[slot].label == label:
+                return slot
+            n = (n + 1) & mask
+        return -1
+
+    cdef long newslot(self, uint32_t label, uint64_t vec,
+                      double prob) except -1:
+        """Add a new item without edges; return its index.
+
+        NB: may move the array of items."""
+        cdef PackedItem * item
+        cdef uint32_t * table
+        cdef size_t n, mask, slot = self.numitems
+        if self.numitems == self.allocated:
+            self.allocated *= 2
+            self.items = <PackedItem * >realloc(
+                self.items, self.allocated * sizeof(PackedItem))
+            if self.items is NULL:
+                raise MemoryError('allocation error')
+        if 2 * (self.numitems + 1) > self.tablesize:  # rehash
+            table = self.table
+            self.table = <uint32_t * >calloc(
+                2 * self.tablesize, sizeof(uint32_t))
+            if self.table is NULL:
+                raise MemoryError('allocation error')
+            free(table)
+            self.tablesize *= 2
+            mask = self.tablesize - 1
+            for slot in range(self.numitems):
+                n = hashitem(self.items[slot].label, self.items[slot].vec) & mask
+                while self.table[n]:
+                    n = (n + 1) & mask
+                self.table[n] = slot + 1
+            slot = self.numitems
+        mask = self.tablesize - 1
+        n = hashitem(label, vec) & mask
+        while self.table[n]:
+            n = (n + 1) & mask
+        self.table[n] = slot + 1
+        item = &(self.items[slot])
+        item.vec = vec
+        item.prob = prob
+        item.head = NULL
+        item.label = label
+        item.nextbystart = item.nextbyend = 0
+        item.len = 0
+        item.popped = False
+        self.numitems += 1
+        return slot
+
+    cdef Edge * newedge(self, size_t slot):
+        """Return a pointer to a new edge for item; caller fills in edge."""
+        cdef PackedItem * item = &(self.items[slot])
+        cdef MoreEdges * edgelist
+        if item.head is NULL or item.len == EDGES_SIZE:
+            edgelist = <MoreEdges * >calloc(1, sizeof(MoreEdges))
+            if edgelist is NULL:
+                abort()
+            edgelist.prev = item.head
+            item.head = edgelist
+            item.len = 0
+        item.len += 1
+        self.numedges += 1
+        return &(item.head.data[item.len - 1])
+
+    cdef void indexslot(self, size_t slot):
+        """Make item available as sibling; cf. ``indexitem``."""
+        cdef PackedItem * item = &(self.items[slot])
+        cdef int start = nextset(item.vec, 0)
+        cdef int end = nextunset(item.vec, start)
+        cdef size_t idx = item.label * (self.lensent + 1)
+        item.nextbystart = self.startheads[idx + start]
+        self.startheads[idx + start] = slot + 1
+        item.nextbyend = self.endheads[idx + end]
+        self.endheads[idx + end] = slot + 1
+
+    cdef SmallChartItem asitem(self, size_t slot):
+        cdef SmallChartItem item = new_SmallChartItem(
+            self.items[slot].label, self.items[slot].vec)
+        item.prob = self.items[slot].prob
+        return item
+
+    cdef _lookup(self, uint32_t label, uint64_t vec):
+        cdef long slot = self.getslot(label, vec)
+        if slot == -1:
+            return new_SmallChartItem(label, vec)
+        return self.asitem(slot)
+
+    cdef void addlexedge(self, item, short wordidx):
+        cdef SmallChartItem sitem = <SmallChartItem > item
+        cdef long slot = self.getslot(sitem.label, sitem.vec)
+        cdef Edge * edge
+        if slot == -1:
+            slot = self.newslot(sitem.label, sitem.vec, sitem.prob)
+        edge = self.newedge(slot)
+        edge.rule = NULL
+        edge.pos.mid = wordidx + 1
+
+    cdef void updateprob(self, ChartItem item, double prob):
+        cdef SmallChartItem sitem = <SmallChartItem > item
+        cdef long slot = self.getslot(sitem.label, sitem.vec)
+        if slot == -1:
+            self.newslot(sitem.label, sitem.vec, prob)
+        elif prob < self.items[slot].prob:
+            self.items[slot].prob = prob
+
+    cdef double subtreeprob(self, item):
+        cdef SmallChartItem sitem = <SmallChartItem > item
+        return self.items[self.getslot(sitem.label, sitem.vec)].prob
+
+    cpdef hasitem(self, ChartItem item):
+        cdef SmallChartItem sitem = <SmallChartItem > item
+        cdef long slot = self.getslot(sitem.label, sitem.vec)
+        return slot != -1 and self.items[slot].head is not NULL
+
+    cdef Edges getedges(self, item):
+        cdef SmallChartItem sitem = <SmallChartItem > item
+        cdef long slot
+        cdef Edges edges
+        if item is None:
+            return None
+        slot = self.getslot(sitem.label, sitem.vec)
+        if slot == -1 or self.items[slot].head is NULL:
+            return None
+        edges = Edges()
+        edges.len = self.items[slot].len
+        edges.head = self.items[slot].head
+        return edges
+
+    cdef size_t itemid(self, item) except? -1:
+        cdef SmallChartItem sitem = <SmallChartItem > item
+        cdef long slot = self.getslot(sitem.label, sitem.vec)
+        if slot == -1:
+            raise KeyError(item)
+        return slot
+
+    cdef size_t numitemids(self):
+        return self.numitems
+
+    def getitems(self):
+        return [self.asitem(n) for n in range(self.numitems)
+                if self.items[n].head is not NULL]
+
+    def _dropitems(self, items):
+        """Remove the edges of the given items (used by ``filter()``)."""
+        cdef MoreEdges * edgelist
+        cdef MoreEdges * tmp
+        cdef SmallChartItem item
+        cdef long slot
+        for item in items:
+            slot = self.getslot(item.label, item.vec)
+            edgelist = self.items[slot].head
+            while edgelist is not NULL:
+                tmp = edgelist
+                edgelist = edgelist.prev
+                free(tmp)
+            self.items[slot].head = NULL
+            self.items[slot].len = 0
+
+    def stats(self):
+        cdef size_t n, numitems = 0, numedges = 0
+        cdef MoreEdges * edgelist
+        for n in range(self.numitems):
+            edgelist = self.items[n].head
+            if edgelist is not NULL:
+                numitems += 1
+                numedges += self.items[n].len
+                edgelist = edgelist.prev
+                while edgelist is not NULL:
+                    numedges += EDGES_SIZE
+                    edgelist = edgelist.prev
+        return 'items %d, edges %d' % (numitems, numedges)
+
+    cdef _left(self, item, Edge * edge):
+        if edge.rule is NULL:
+            return None
+        return self._lookup(edge.rule.rhs1, edge.pos.lvec)
+
+    cdef _right(self, item, Edge * edge):
+        if edge.rule is NULL or edge.rule.rhs2 == 0:
+            return None
+        return self._lookup(edge.rule.rhs2,
+                            (<SmallChartItem > item).vec ^ edge.pos.lvec)
+
+    def indices(self, SmallChartItem item):
+        return [n for n in range(len(self.sent)) if testbit(item.vec, n)]
+
+    cdef copy(self, item):
+        return (<SmallChartItem > item).copy()
+
+    def root(self):
+        return self._lookup(self.start, (1UL << self.lensent) - 1)
+
+
+cdef inline uint64_t hashitem(uint32_t label, uint64_t vec):
+    """Hash function for items of a PackedLCFRSChart."""
+    cdef uint64_t result = (vec ^ (<uint64_t > label << 40) ^ label
+                            ) * 0x9E3779B97F4A7C15UL
+    return result ^ (result >> 29)
+
+
 def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
-          start=None, list whitelist=None, bint splitprune=False,
+          start=None, whitelist=None, bint splitprune=False,
           bint markorigin=False, estimates=None, bint symbolic=False,
-          double beam_beta=0.0, int beam_delta=50):
+          double beam_beta=0.0, int beam_delta=50, double maxtime=0.0,
+          size_t maxitems=0, bint packed=False, bint radix=False):
     """Parse sentence and produce a chart.
 
     :param sent: A sequence of tokens that will be parsed.
@@ -262,7 +522,11 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
             derivations should be headed by; e.g., ``grammar.toid['ROOT']``.
             If not given, the default specified by ``grammar`` is used.
     :param whitelist: a whitelist of allowed ChartItems. Anything else is not
-            added to the agenda.
+            added to the agenda. Either a list with a set of allowed items
+            for each label, or an ``LCFRSWhitelist``, as produced by
+            :py:func:`discodop.coarsetofine.prunechart`; the latter determines
+            the ``splitprune`` and ``markorigin`` options itself, and is only
+            for sentences of less than 64 words.
     :param splitprune: coarse stage used a split-PCFG where discontinuous node
             appear as multiple CFG nodes. Every discontinuous node will result
             in multiple lookups into whitelist to see whether it should be
@@ -273,7 +537,8 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
     :param estimates: use context-summary estimates (heuristics, figures of
             merit) to order agenda. should be a tuple with the kind of
             estimates ('SX' or 'SXlrgaps'), and the estimates themselves in a
-            4-dimensional numpy matrix. If estimates are not consistent, it is
+            4-dimensional numpy matrix of doubles or single precision floats,
+            e.g., memory-mapped with ``np.load(..., mmap_mode='r')``. If estimates are not consistent, it is
             no longer guaranteed that the optimal parse will be found.
             experimental.
     :param symbolic: If True, only compute parse forest, disregard
@@ -283,8 +548,43 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
             items which are within a multiple of ``beam_beta`` of the best score.
             Should be a negative log probability. Pass ``0.0`` to disable.
     :param beam_delta: the maximum span length to which beam search is applied.
+    :param maxtime: if nonzero, stop parsing after this many seconds of wall
+            clock time.
+    :param maxitems: if nonzero, stop parsing after this many items have been
+            popped from the agenda.
+    :param packed: store items in a ``PackedLCFRSChart`` (an array of structs
+            with a hash table) instead of a dictionary of ``SmallChartItem``
+            objects. Only applies to sentences that fit into a machine word,
+            and not with ``symbolic=True``.
+    :param radix: with ``packed=True``, use a ``RadixAgenda`` (a monotone
+            priority queue with C arrays of integer keys) instead of a
+            ``DoubleAgenda``.
+    :returns: a tuple ``(chart, msg)``; if parsing was stopped because
+            ``maxtime`` or ``maxitems`` was exceeded, ``chart`` is ``None``.
+            The budget is not applied with ``symbolic=True``.
     """
+    if isinstance(whitelist, LCFRSWhitelist):
+        if (<LCFRSWhitelist>whitelist).fine.nonterminals != grammar.nonterminals:
+            raise ValueError('LCFRSWhitelist is for a different grammar.')
+    elif isinstance(whitelist, list):
+        if len(whitelist) < grammar.nonterminals:
+            raise ValueError('expected whitelist with an entry for each '
+                             'label; got %d entries.' % len(whitelist))
+    elif whitelist is not None:
+        raise TypeError('expected list or LCFRSWhitelist; got %r.' % (
+            type(whitelist)))
     if len(sent) < sizeof(COMPONENT.vec) * 8:
+        if packed and not symbolic:
+            chart = PackedLCFRSChart(grammar, list(sent), start)
+            if radix:
+                return parse_packed(<PackedLCFRSChart > chart, RadixAgenda(),
+                                    sent, grammar, tags, exhaustive, whitelist,
+                                    splitprune, markorigin, estimates,
+                                    beam_beta, beam_delta, maxtime, maxitems)
+            return parse_packed(<PackedLCFRSChart > chart, DoubleAgenda(),
+                                sent, grammar, tags, exhaustive, whitelist,
+                                splitprune, markorigin, estimates, beam_beta,
+                                beam_delta, maxtime, maxitems)
         chart = SmallLCFRSChart(grammar, list(sent), start)
         if symbolic:
             return parse_symbolic( < SmallLCFRSChart > chart,
@@ -292,7 +592,10 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
                                   whitelist, splitprune, markorigin)
         return parse_main(< SmallLCFRSChart > chart, < SmallChartItem > chart.root(),
                            sent, grammar, tags, exhaustive, whitelist, splitprune,
-                           markorigin, estimates, beam_beta, beam_delta)
+                           markorigin, estimates, beam_beta, beam_delta,
+                           maxtime, maxitems)
+    if isinstance(whitelist, LCFRSWhitelist):
+        raise ValueError('LCFRSWhitelist requires sentence < 64 words.')
     chart = FatLCFRSChart(grammar, list(sent), start)
     if symbolic:
         return parse_symbolic( < FatLCFRSChart > chart,
@@ -300,27 +603,34 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
                               whitelist, splitprune, markorigin)
     return parse_main(< FatLCFRSChart > chart, < FatChartItem > chart.root(),
                        sent, grammar, tags, exhaustive, whitelist, splitprune,
-                       markorigin, estimates, beam_beta, beam_delta)
+                       markorigin, estimates, beam_beta, beam_delta,
+                       maxtime, maxitems)
 
 
 cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
-                Grammar grammar, tags, bint exhaustive, list whitelist,
+                Grammar grammar, tags, bint exhaustive, whitelist,
                 bint splitprune, bint markorigin, estimates,
-                double beam_beta, int beam_delta):
+                double beam_beta, int beam_delta, double maxtime,
+                size_t maxitems):
     cdef:
         DoubleAgenda agenda = DoubleAgenda()  # the agenda
         list probs = chart.probs  # viterbi probabilities for items
+        list siblings  # items indexed by position, for a given label
         ProbRule * rule
         LCFRSItem_fused item, newitem
         DoubleEntry entry
-        double[:, :, :, :] outside = None  # outside estimates, if provided
+        EstimateTable outside  # outside estimates, if provided
         double siblingprob, score
         short lensent = len(sent), estimatetype = 0
         int length = 1, left = 0, right = 0, gaps = 0
-        size_t blocked = 0, maxA = 0, n
+        int pos, lo = 0, hi = 0
+        bint isnew
+        size_t blocked = 0, maxA = 0, n, popped = 0, visited = 0
+        double deadline = time() + maxtime if maxtime else 0.0
     if estimates is not None:
-        estimatetypestr, outside = estimates
+        estimatetypestr, outsidearray = estimates
         estimatetype = {'SX': SX, 'SXlrgaps': SXlrgaps}[estimatetypestr]
+        getestimatetable(&outside, outsidearray)
     # newitem will be recycled until it is added to the chart
     if LCFRSItem_fused is SmallChartItem:
         newitem = new_SmallChartItem(0, 0)
@@ -335,11 +645,21 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
         return chart, msg
 
     while agenda.length:  # main parsing loop
+        # check budget; only look at the clock every 1024 items.
+        if ((maxitems and popped >= maxitems) or (
+                deadline and popped % 1024 == 0 and time() > deadline)):
+            return None, 'budget exceeded after %d items; %s' % (
+                popped, chart.stats())
+        popped += 1
         entry = agenda.popentry()
         item = <LCFRSItem_fused > entry.key
         # store viterbi probability; cannot do this when this item is added to
         # the agenda because that would give rise to duplicate edges.
+        isnew = (probs[item.label] is None
+                 or item not in <dict > probs[item.label])
         chart.updateprob(item, item.prob)
+        if isnew:  # make item available as a sibling
+            indexitem(chart, item)
         if equalitems(item, goal):
             if not exhaustive:
                 break
@@ -369,12 +689,12 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
                     continue
                 score = newitem.prob = item.prob + rule.prob
                 if estimatetype == SX:
-                    score += outside[rule.lhs, left, right, 0]
+                    score += getestimate(&outside, rule.lhs, left, right, 0)
                     if score > MAX_LOGPROB:
                         continue
                 elif estimatetype == SXlrgaps:
-                    score += outside[
-                        rule.lhs, length, left + right, gaps]
+                    score += getestimate(
+                        &outside, rule.lhs, length, left + right, gaps)
                     if score > MAX_LOGPROB:
                         continue
                 else:
@@ -406,53 +726,61 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
                     continue
                 elif TESTBIT(grammar.mask, rule.no):
                     continue
-                for sib in < dict > probs[rule.rhs1]:
-                    newitem.label = rule.lhs
-                    combine_item(newitem, < LCFRSItem_fused > sib, item)
-                    if concat(rule, < LCFRSItem_fused > sib, item):
-                        siblingprob = ( < LCFRSItem_fused > sib).prob
-                        score = newitem.prob = item.prob + siblingprob + rule.prob
-                        if LCFRSItem_fused is SmallChartItem:
-                            length = bitcount(newitem.vec)
-                        elif LCFRSItem_fused is FatChartItem:
-                            length = abitcount(newitem.vec, SLOTS)
-                        if estimatetype == SX or estimatetype == SXlrgaps:
-                            if LCFRSItem_fused is SmallChartItem:
-                                left = nextset(newitem.vec, 0)
-                            elif LCFRSItem_fused is FatChartItem:
-                                left = anextset(newitem.vec, 0, SLOTS)
-                        if estimatetype == SX:
-                            right = lensent - length - left
-                            score += outside[rule.lhs, left, right, 0]
-                            if score > MAX_LOGPROB:
-                                continue
-                        elif estimatetype == SXlrgaps:
-                            if LCFRSItem_fused is SmallChartItem:
-                                gaps = bitlength(newitem.vec) - length - left
-                            elif LCFRSItem_fused is FatChartItem:
-                                gaps = abitlength(newitem.vec, SLOTS
-                                                  ) - length - left
-                            right = lensent - length - left - gaps
-                            score += outside[
-                                rule.lhs, length, left + right, gaps]
-                            if score > MAX_LOGPROB:
-                                continue
-                        else:
-                            score += length * MAX_LOGPROB
-                        if process_edge(newitem, score,
-                                        rule, < LCFRSItem_fused > sib, agenda, chart,
-                                        estimatetype, whitelist,
-                                        splitprune and grammar.fanout[rule.lhs] != 1,
-                                        markorigin,
-                                        beam_beta if length <= beam_delta else 0.0):
+                if siblingrange(rule, item, True, lensent, &lo, &hi):
+                    siblings = <list > chart.bystart[rule.rhs1]
+                else:
+                    siblings = <list > chart.byend[rule.rhs1]
+                for pos in range(lo, hi):
+                    for sib in < list > siblings[pos]:
+                        visited += 1
+                        newitem.label = rule.lhs
+                        combine_item(newitem, < LCFRSItem_fused > sib, item)
+                        if concat(rule, < LCFRSItem_fused > sib, item):
+                            siblingprob = ( < LCFRSItem_fused > sib).prob
+                            score = newitem.prob = item.prob + siblingprob + rule.prob
                             if LCFRSItem_fused is SmallChartItem:
-                                newitem = <LCFRSItem_fused > SmallChartItem.__new__(
-                                    SmallChartItem)
+                                length = bitcount(newitem.vec)
                             elif LCFRSItem_fused is FatChartItem:
-                                newitem = <LCFRSItem_fused > FatChartItem.__new__(
-                                    FatChartItem)
-                        else:
-                            blocked += 1
+                                length = abitcount(newitem.vec, SLOTS)
+                            if estimatetype == SX or estimatetype == SXlrgaps:
+                                if LCFRSItem_fused is SmallChartItem:
+                                    left = nextset(newitem.vec, 0)
+                                elif LCFRSItem_fused is FatChartItem:
+                                    left = anextset(newitem.vec, 0, SLOTS)
+                            if estimatetype == SX:
+                                right = lensent - length - left
+                                score += getestimate(
+                                    &outside, rule.lhs, left, right, 0)
+                                if score > MAX_LOGPROB:
+                                    continue
+                            elif estimatetype == SXlrgaps:
+                                if LCFRSItem_fused is SmallChartItem:
+                                    gaps = bitlength(newitem.vec) - length - left
+                                elif LCFRSItem_fused is FatChartItem:
+                                    gaps = abitlength(newitem.vec, SLOTS
+                                                      ) - length - left
+                                right = lensent - length - left - gaps
+                                score += getestimate(
+                                    &outside, rule.lhs, length, left + right,
+                                    gaps)
+                                if score > MAX_LOGPROB:
+                                    continue
+                            else:
+                                score += length * MAX_LOGPROB
+                            if process_edge(newitem, score,
+                                            rule, < LCFRSItem_fused > sib, agenda, chart,
+                                            estimatetype, whitelist,
+                                            splitprune and grammar.fanout[rule.lhs] != 1,
+                                            markorigin,
+                                            beam_beta if length <= beam_delta else 0.0):
+                                if LCFRSItem_fused is SmallChartItem:
+                                    newitem = <LCFRSItem_fused > SmallChartItem.__new__(
+                                        SmallChartItem)
+                                elif LCFRSItem_fused is FatChartItem:
+                                    newitem = <LCFRSItem_fused > FatChartItem.__new__(
+                                        FatChartItem)
+                            else:
+                                blocked += 1
             # binary production, item from agenda is on the left
             for n in range(grammar.numbinary):
                 rule = &(grammar.lbinary[item.label][n])
@@ -462,62 +790,409 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
                     continue
                 elif TESTBIT(grammar.mask, rule.no):
                     continue
-                for sib in < dict > probs[rule.rhs2]:
-                    newitem.label = rule.lhs
-                    combine_item(newitem, item, < LCFRSItem_fused > sib)
-                    if concat(rule, item, < LCFRSItem_fused > sib):
-                        siblingprob = ( < LCFRSItem_fused > sib).prob
-                        score = newitem.prob = item.prob + siblingprob + rule.prob
-                        if LCFRSItem_fused is SmallChartItem:
-                            length = bitcount(newitem.vec)
-                        elif LCFRSItem_fused is FatChartItem:
-                            length = abitcount(newitem.vec, SLOTS)
-                        if estimatetype == SX or estimatetype == SXlrgaps:
-                            if LCFRSItem_fused is SmallChartItem:
-                                left = nextset(newitem.vec, 0)
-                            elif LCFRSItem_fused is FatChartItem:
-                                left = anextset(newitem.vec, 0, SLOTS)
-                        if estimatetype == SX:
-                            right = lensent - length - left
-                            score += outside[rule.lhs, left, right, 0]
-                            if score > MAX_LOGPROB:
-                                continue
-                        elif estimatetype == SXlrgaps:
-                            if LCFRSItem_fused is SmallChartItem:
-                                gaps = bitlength(newitem.vec) - length - left
-                            elif LCFRSItem_fused is FatChartItem:
-                                gaps = abitlength(newitem.vec, SLOTS
-                                                  ) - length - left
-                            right = lensent - length - left - gaps
-                            score += outside[rule.lhs, length,
-                                             left + right, gaps]
-                            if score > MAX_LOGPROB:
-                                continue
-                        else:
-                            score += length * MAX_LOGPROB
-                        if process_edge(newitem, score, rule, item,
-                                        agenda, chart, estimatetype, whitelist,
-                                        splitprune and grammar.fanout[rule.lhs] != 1,
-                                        markorigin,
-                                        beam_beta if length <= beam_delta else 0.0):
+                if siblingrange(rule, item, False, lensent, &lo, &hi):
+                    siblings = <list > chart.bystart[rule.rhs2]
+                else:
+                    siblings = <list > chart.byend[rule.rhs2]
+                for pos in range(lo, hi):
+                    for sib in < list > siblings[pos]:
+                        visited += 1
+                        newitem.label = rule.lhs
+                        combine_item(newitem, item, < LCFRSItem_fused > sib)
+                        if concat(rule, item, < LCFRSItem_fused > sib):
+                            siblingprob = ( < LCFRSItem_fused > sib).prob
+                            score = newitem.prob = item.prob + siblingprob + rule.prob
                             if LCFRSItem_fused is SmallChartItem:
-                                newitem = <LCFRSItem_fused > SmallChartItem.__new__(
-                                    SmallChartItem)
+                                length = bitcount(newitem.vec)
                             elif LCFRSItem_fused is FatChartItem:
-                                newitem = <LCFRSItem_fused > FatChartItem.__new__(
-                                    FatChartItem)
-                        else:
-                            blocked += 1
+                                length = abitcount(newitem.vec, SLOTS)
+                            if estimatetype == SX or estimatetype == SXlrgaps:
+                                if LCFRSItem_fused is SmallChartItem:
+                                    left = nextset(newitem.vec, 0)
+                                elif LCFRSItem_fused is FatChartItem:
+                                    left = anextset(newitem.vec, 0, SLOTS)
+                            if estimatetype == SX:
+                                right = lensent - length - left
+                                score += getestimate(
+                                    &outside, rule.lhs, left, right, 0)
+                                if score > MAX_LOGPROB:
+                                    continue
+                            elif estimatetype == SXlrgaps:
+                                if LCFRSItem_fused is SmallChartItem:
+                                    gaps = bitlength(newitem.vec) - length - left
+                                elif LCFRSItem_fused is FatChartItem:
+                                    gaps = abitlength(newitem.vec, SLOTS
+                                                      ) - length - left
+                                right = lensent - length - left - gaps
+                                score += getestimate(
+                                    &outside, rule.lhs, length, left + right,
+                                    gaps)
+                                if score > MAX_LOGPROB:
+                                    continue
+                            else:
+                                score += length * MAX_LOGPROB
+                            if process_edge(newitem, score, rule, item,
+                                            agenda, chart, estimatetype, whitelist,
+                                            splitprune and grammar.fanout[rule.lhs] != 1,
+                                            markorigin,
+                                            beam_beta if length <= beam_delta else 0.0):
+                                if LCFRSItem_fused is SmallChartItem:
+                                    newitem = <LCFRSItem_fused > SmallChartItem.__new__(
+                                        SmallChartItem)
+                                elif LCFRSItem_fused is FatChartItem:
+                                    newitem = <LCFRSItem_fused > FatChartItem.__new__(
+                                        FatChartItem)
+                            else:
+                                blocked += 1
 
         if agenda.length > maxA:
             maxA = agenda.length
-    msg = ('agenda max %d, now %d, %s, blocked %d' % (
-        maxA, len(agenda), chart.stats(), blocked))
+    msg = ('agenda max %d, now %d, %s, blocked %d, siblings visited %d' % (
+        maxA, len(agenda), chart.stats(), blocked, visited))
     if not chart:
         return chart, 'no parse ' + msg
     return chart, msg
 
 
+cdef parse_packed(PackedLCFRSChart chart, PackedAgenda agenda, sent,
+                  Grammar grammar, tags, bint exhaustive, whitelist,
+                  bint splitprune, bint markorigin, estimates,
+                  double beam_beta, int beam_delta, double maxtime,
+                  size_t maxitems):
+    """Like ``parse_main``, but items are indices to ``chart.items``.
+
+    These indices are also the keys of the agenda."""
+    cdef:
+        ProbRule * rule
+        SmallChartItem tmpleft = new_SmallChartItem(0, 0)
+        SmallChartItem tmpright = new_SmallChartItem(0, 0)
+        EstimateTable outside  # outside estimates, if provided
+        double prob, itemprob, score
+        uint64_t vec, newvec, sibvec
+        uint64_t goalvec = (1UL << len(sent)) - 1
+        uint32_t label, sib, next
+        uint32_t * heads
+        short lensent = len(sent), estimatetype = 0
+        int length = 1, left = 0, right = 0, gaps = 0
+        int pos, lo = 0, hi = 0
+        bint bystart
+        long slot
+        size_t blocked = 0, maxA = 0, n, popped = 0, visited = 0
+        double deadline = time() + maxtime if maxtime else 0.0
+    if estimates is not None:
+        estimatetypestr, outsidearray = estimates
+        estimatetype = {'SX': SX, 'SXlrgaps': SXlrgaps}[estimatetypestr]
+        getestimatetable(&outside, outsidearray)
+
+    # assign POS tags
+    covered, msg = populatepos_packed(grammar, agenda, chart, sent, tags,
+                                      whitelist, estimates)
+    if not covered:
+        return chart, msg
+
+    while agenda.length:  # main parsing loop
+        # check budget; only look at the clock every 1024 items.
+        if ((maxitems and popped >= maxitems) or (
+                deadline and popped % 1024 == 0 and time() > deadline)):
+            return None, 'budget exceeded after %d items; %s' % (
+                popped, chart.stats())
+        popped += 1
+        if PackedAgenda is RadixAgenda:
+            slot = agenda.popkey()
+        else:
+            slot = agenda.popentry().key
+        # NB: chart.items may be moved when new items are added; copy fields.
+        label = chart.items[slot].label
+        vec = chart.items[slot].vec
+        itemprob = chart.items[slot].prob
+        if not chart.items[slot].popped:  # make item available as a sibling
+            chart.items[slot].popped = True
+            chart.indexslot(slot)
+        if label == chart.start and vec == goalvec:
+            if not exhaustive:
+                break
+            continue
+        # unary
+        length = bitcount(vec)
+        if estimates is not None:
+            left = nextset(vec, 0)
+            gaps = bitlength(vec) - length - left
+            right = lensent - length - left - gaps
+        for n in range(grammar.numunary):
+            rule = &(grammar.unary[label][n])
+            if rule.rhs1 != label:
+                break
+            elif TESTBIT(grammar.mask, rule.no):
+                continue
+            score = prob = itemprob + rule.prob
+            if estimatetype == SX:
+                score += getestimate(&outside, rule.lhs, left, right, 0)
+                if score > MAX_LOGPROB:
+                    continue
+            elif estimatetype == SXlrgaps:
+                score += getestimate(
+                    &outside, rule.lhs, length, left + right, gaps)
+                if score > MAX_LOGPROB:
+                    continue
+            else:
+                score += length * MAX_LOGPROB
+            if not process_packededge(
+                    chart, agenda, rule.lhs, vec, prob, score, rule, vec,
+                    estimatetype, whitelist,
+                    splitprune and grammar.fanout[rule.lhs] != 1,
+                    markorigin, 0.0):
+                blocked += 1
+        # binary production, item from agenda is on the right
+        tmpright.vec = vec
+        for n in range(grammar.numbinary):
+            rule = &(grammar.rbinary[label][n])
+            if rule.rhs2 != label:
+                break
+            elif TESTBIT(grammar.mask, rule.no):
+                continue
+            bystart = siblingrange(rule, tmpright, True, lensent, &lo, &hi)
+            heads = chart.startheads if bystart else chart.endheads
+            for pos in range(lo, hi):
+                next = heads[rule.rhs1 * (lensent + 1) + pos]
+                while next:
+                    sib = next - 1
+                    next = (chart.items[sib].nextbystart if bystart
+                            else chart.items[sib].nextbyend)
+                    visited += 1
+                    sibvec = tmpleft.vec = chart.items[sib].vec
+                    if not concat(rule, tmpleft, tmpright):
+                        continue
+                    newvec = sibvec ^ vec
+                    score = prob = itemprob + chart.items[sib].prob + rule.prob
+                    length = bitcount(newvec)
+                    if estimatetype == SX or estimatetype == SXlrgaps:
+                        left = nextset(newvec, 0)
+                    if estimatetype == SX:
+                        right = lensent - length - left
+                        score += getestimate(
+                            &outside, rule.lhs, left, right, 0)
+                        if score > MAX_LOGPROB:
+                            continue
+                    elif estimatetype == SXlrgaps:
+                        gaps = bitlength(newvec) - length - left
+                        right = lensent - length - left - gaps
+                        score += getestimate(
+                            &outside, rule.lhs, length, left + right, gaps)
+                        if score > MAX_LOGPROB:
+                            continue
+                    else:
+                        score += length * MAX_LOGPROB
+                    if not process_packededge(
+                            chart, agenda, rule.lhs, newvec, prob, score,
+                            rule, sibvec, estimatetype, whitelist,
+                            splitprune and grammar.fanout[rule.lhs] != 1,
+                            markorigin,
+                            beam_beta if length <= beam_delta else 0.0):
+                        blocked += 1
+        # binary production, item from agenda is on the left
+        tmpleft.vec = vec
+        for n in range(grammar.numbinary):
+            rule = &(grammar.lbinary[label][n])
+            if rule.rhs1 != label:
+                break
+            elif TESTBIT(grammar.mask, rule.no):
+                continue
+            bystart = siblingrange(rule, tmpleft, False, lensent, &lo, &hi)
+            heads = chart.startheads if bystart else chart.endheads
+            for pos in range(lo, hi):
+                next = heads[rule.rhs2 * (lensent + 1) + pos]
+                while next:
+                    sib = next - 1
+                    next = (chart.items[sib].nextbystart if bystart
+                            else chart.items[sib].nextbyend)
+                    visited += 1
+                    sibvec = tmpright.vec = chart.items[sib].vec
+                    if not concat(rule, tmpleft, tmpright):
+                        continue
+                    newvec = vec ^ sibvec
+                    score = prob = itemprob + chart.items[sib].prob + rule.prob
+                    length = bitcount(newvec)
+                    if estimatetype == SX or estimatetype == SXlrgaps:
+                        left = nextset(newvec, 0)
+                    if estimatetype == SX:
+                        right = lensent - length - left
+                        score += getestimate(
+                            &outside, rule.lhs, left, right, 0)
+                        if score > MAX_LOGPROB:
+                            continue
+                    elif estimatetype == SXlrgaps:
+                        gaps = bitlength(newvec) - length - left
+                        right = lensent - length - left - gaps
+                        score += getestimate(
+                            &outside, rule.lhs, length, left + right, gaps)
+                        if score > MAX_LOGPROB:
+                            continue
+                    else:
+                        score += length * MAX_LOGPROB
+                    if not process_packededge(
+                            chart, agenda, rule.lhs, newvec, prob, score,
+                            rule, vec, estimatetype, whitelist,
+                            splitprune and grammar.fanout[rule.lhs] != 1,
+                            markorigin,
+                            beam_beta if length <= beam_delta else 0.0):
+                        blocked += 1
+
+        if agenda.length > maxA:
+            maxA = agenda.length
+    # indices of items, in the order they were added
+    chart.itemsinorder = range(chart.numitems)
+    msg = ('agenda max %d, now %d, %s, blocked %d, siblings visited %d' % (
+        maxA, len(agenda), chart.stats(), blocked, visited))
+    if not chart:
+        return chart, 'no parse ' + msg
+    return chart, msg
+
+
+cdef populatepos_packed(Grammar grammar, PackedAgenda agenda,
+                        PackedLCFRSChart chart, sent, tags, whitelist,
+                        estimates):
+    """Like ``populatepos``, for a ``PackedLCFRSChart``."""
+    cdef:
+        LexicalRule lexrule
+        Edge * edge
+        EstimateTable outside  # outside estimates, if provided
+        double score
+        short wordidx, lensent = len(sent), estimatetype = 0
+        int length = 1, left = 0, right = 0, gaps = 0
+        uint32_t lhs
+        long slot
+        bint recognized
+    if estimates is not None:
+        estimatetypestr, outsidearray = estimates
+        estimatetype = {'SX': SX, 'SXlrgaps': SXlrgaps}[estimatetypestr]
+        getestimatetable(&outside, outsidearray)
+    for wordidx, word in enumerate(sent):  # add preterminals to chart
+        recognized = False
+        tag = tags[wordidx] if tags else None
+        # if we are given gold tags, make sure we only allow matching
+        # tags - after removing addresses introduced by the DOP reduction
+        # and other state splits.
+        tagre = re.compile('%s($|@|\\^|/)' % re.escape(tag)) if tags else None
+        if estimates is not None:
+            left = wordidx
+            gaps = 0
+            right = lensent - 1 - wordidx
+        for lexrule in grammar.lexicalbyword.get(word, ()):
+            if not tags or tagre.match(grammar.tolabel[lexrule.lhs]):
+                score = lexrule.prob
+                if estimatetype == SX:
+                    score += getestimate(&outside, lexrule.lhs, left, right, 0)
+                    if score > MAX_LOGPROB:
+                        continue
+                elif estimatetype == SXlrgaps:
+                    score += getestimate(
+                        &outside, lexrule.lhs, length, left + right, gaps)
+                    if score > MAX_LOGPROB:
+                        continue
+                chart.tmpitem.label = lexrule.lhs
+                chart.tmpitem.vec = 1UL << wordidx
+                if whitelist is not None and not checkwhitelist(
+                        chart.tmpitem, whitelist, False, False):
+                    continue
+                if chart.getslot(lexrule.lhs, 1UL << wordidx) != -1:
+                    raise ValueError('lexical edge already in chart: %s' %
+                                     chart.itemstr(chart.tmpitem))
+                slot = chart.newslot(lexrule.lhs, 1UL << wordidx, lexrule.prob)
+                agenda.setitem(slot, score)
+                edge = chart.newedge(slot)
+                edge.rule = NULL
+                edge.pos.mid = wordidx + 1
+                recognized = True
+        # NB: use gold tags if given, even if (word, tag) was not part of
+        # training data, modulo state splits etc.
+        if not recognized and tag is not None:
+            for lhs in grammar.lexicalbylhs:
+                if tagre.match(grammar.tolabel[lhs]) is not None:
+                    score = 0.0
+                    if estimatetype == SX:
+                        score += getestimate(&outside, lhs, left, right, 0)
+                        if score > MAX_LOGPROB:
+                            continue
+                    elif estimatetype == SXlrgaps:
+                        score += getestimate(
+                            &outside, lhs, length, left + right, gaps)
+                        if score > MAX_LOGPROB:
+                            continue
+                    slot = chart.newslot(lhs, 1UL << wordidx, 0.0)
+                    agenda.setitem(slot, score)
+                    edge = chart.newedge(slot)
+                    edge.rule = NULL
+                    edge.pos.mid = wordidx + 1
+                    recognized = True
+        if not recognized:
+            if tag is None and word not in grammar.lexicalbyword:
+                return False, 'no parse: %r not in lexicon' % word
+            elif tag is not None and tag not in grammar.toid:
+                return False, 'no parse: unknown tag %r' % tag
+            return False, 'no parse: all tags for %r blocked' % word
+    return True, ''
+
+
+cdef inline bint process_packededge(
+        PackedLCFRSChart chart, PackedAgenda agenda, uint32_t label,
+        uint64_t vec, double prob, double score, ProbRule * rule,
+        uint64_t lvec, int estimatetype, whitelist, bint splitprune,
+        bint markorigin, double beam_beta) except -1:
+    """Decide what to do with a newly derived edge; cf. ``process_edge``.
+
+    :returns: ``True`` when edge is accepted in the chart, ``False`` when
+            blocked."""
+    cdef long slot = chart.getslot(label, vec), cell
+    cdef Edge * edge
+    cdef bint inagenda = False
+    if slot != -1:
+        if PackedAgenda is RadixAgenda:
+            inagenda = agenda.contains(slot)
+        else:
+            inagenda = slot in agenda.mapping
+    if slot == -1:
+        # check if we need to prune this item
+        if whitelist is not None:
+            chart.tmpitem.label = label
+            chart.tmpitem.vec = vec
+            if not checkwhitelist(chart.tmpitem, whitelist, splitprune,
+                                  markorigin):
+                return False
+        if beam_beta:
+            # the item with label 0 for a span holds the best score for it
+            cell = chart.getslot(0, vec)
+            if cell == -1:
+                chart.newslot(0, vec, prob)
+            elif prob > chart.items[cell].prob + beam_beta:
+                return False
+            elif prob < chart.items[cell].prob:
+                chart.items[cell].prob = prob
+        # haven't seen this item before, won't prune, add to agenda
+        slot = chart.newslot(label, vec, prob)
+        agenda.setitem(slot, score)
+    # in agenda (maybe in chart)
+    elif inagenda:
+        # lower score? => decrease-key in agenda
+        if prob < chart.items[slot].prob:
+            chart.items[slot].prob = prob
+            agenda.setitem(slot, score)
+    # not in agenda => must be in chart
+    elif prob < chart.items[slot].prob:
+        # re-add to agenda because we found a better score.
+        chart.items[slot].prob = prob
+        agenda.setitem(slot, score)
+        if estimatetype != SXlrgaps:
+            # This should only happen because of an inconsistent or
+            # non-monotonic estimate.
+            logging.warning('WARN: re-adding item to agenda already in chart:'
+                            ' %s', chart.itemstr(chart.asitem(slot)))
+    # store this edge, regardless of whether the item was new (unary chains)
+    edge = chart.newedge(slot)
+    edge.rule = rule
+    edge.pos.lvec = lvec
+    return True
+
+
 cdef populatepos(Grammar grammar, DoubleAgenda agenda,
                  LCFRSChart_fused chart, LCFRSItem_fused item, sent, tags, whitelist,
                  estimates, bint symbolic):
@@ -528,7 +1203,7 @@ cdef populatepos(Grammar grammar, DoubleAgenda agenda,
     cdef:
         LexicalRule lexrule
         LCFRSItem_fused newitem
-        double[:, :, :, :] outside = None  # outside estimates, if provided
+        EstimateTable outside  # outside estimates, if provided
         double score
         short wordidx, lensent = len(sent), estimatetype = 0
         int length = 1, left = 0, right = 0, gaps = 0
@@ -536,8 +1211,9 @@ cdef populatepos(Grammar grammar, DoubleAgenda agenda,
         size_t blocked = 0
         bint recognized
     if estimates is not None:
-        estimatetypestr, outside = estimates
+        estimatetypestr, outsidearray = estimates
         estimatetype = {'SX': SX, 'SXlrgaps': SXlrgaps}[estimatetypestr]
+        getestimatetable(&outside, outsidearray)
     # newitem will be recycled until it is added to the chart
     if LCFRSItem_fused is SmallChartItem:
         newitem = new_SmallChartItem(0, 0)
@@ -564,12 +1240,12 @@ cdef populatepos(Grammar grammar, DoubleAgenda agenda,
             if not tags or tagre.match(grammar.tolabel[lexrule.lhs]):
                 score = -1 if symbolic else lexrule.prob
                 if estimatetype == SX:
-                    score += outside[lexrule.lhs, left, right, 0]
+                    score += getestimate(&outside, lexrule.lhs, left, right, 0)
                     if score > MAX_LOGPROB:
                         continue
                 elif estimatetype == SXlrgaps:
-                    score += outside[
-                        lexrule.lhs, length, left + right, gaps]
+                    score += getestimate(
+                        &outside, lexrule.lhs, length, left + right, gaps)
                     if score > MAX_LOGPROB:
                         continue
                 # NB: do NOT add length of span to score, so that the scores of
@@ -599,11 +1275,12 @@ cdef populatepos(Grammar grammar, DoubleAgenda agenda,
                 if tagre.match(grammar.tolabel[lhs]) is not None:
                     score = -1 if symbolic else 0.0
                     if estimatetype == SX:
-                        score += outside[lhs, left, right, 0]
+                        score += getestimate(&outside, lhs, left, right, 0)
                         if score > MAX_LOGPROB:
                             continue
                     elif estimatetype == SXlrgaps:
-                        score += outside[lhs, length, left + right, gaps]
+                        score += getestimate(
+                            &outside, lhs, length, left + right, gaps)
                         if score > MAX_LOGPROB:
                             continue
                     newitem.label = lhs
@@ -637,12 +1314,14 @@ cdef populatepos(Grammar grammar, DoubleAgenda agenda,
 cdef inline bint process_edge(LCFRSItem_fused newitem,
                               double score, ProbRule * rule, LCFRSItem_fused left,
                               DoubleAgenda agenda, LCFRSChart_fused chart, int estimatetype,
-                              list whitelist, bint splitprune, bint markorigin, double beam_beta):
+                              whitelist, bint splitprune, bint markorigin, double beam_beta):
     """Decide what to do with a newly derived edge.
 
     :returns: ``True`` when edge is accepted in the chart, ``False`` when
             blocked. When ``False``, ``newitem`` may be reused."""
     cdef uint32_t label
+    cdef dict cell
+    cdef ChartItem best
     cdef bint inagenda = newitem in agenda.mapping
     cdef bint inchart = newitem in chart.parseforest
     if not inagenda and not inchart:
@@ -651,16 +1330,19 @@ cdef inline bint process_edge(LCFRSItem_fused newitem,
                 newitem, whitelist, splitprune, markorigin):
             return False
         elif beam_beta:
+            # the item with label 0 for a span holds the best score for it
             label = newitem.label
             newitem.label = 0
-            if newitem not in chart.probs:
-                itemcopy = newitem.copy()
-                chart.updateprob(itemcopy, newitem.prob)
-            elif newitem.prob > chart.probs[newitem].prob + beam_beta:
-                return False
-            elif newitem.prob < chart.probs[newitem].prob:
-                itemcopy = newitem.copy()
-                chart.updateprob(itemcopy, newitem.prob)
+            cell = chart.probs[0]
+            if cell is None or newitem not in cell:
+                chart.updateprob(newitem.copy(), newitem.prob)
+            else:
+                best = <ChartItem > cell[newitem]
+                if newitem.prob > best.prob + beam_beta:
+                    newitem.label = label
+                    return False
+                elif newitem.prob < best.prob:
+                    best.prob = newitem.prob
             newitem.label = label
         # haven't seen this item before, won't prune, add to agenda
         agenda.setitem(newitem, score)
@@ -684,7 +1366,7 @@ cdef inline bint process_edge(LCFRSItem_fused newitem,
 
 cdef inline int process_lexedge(LCFRSItem_fused newitem,
                                 double score, short wordidx, agenda,
-                                LCFRSChart_fused chart, list whitelist) except -1:
+                                LCFRSChart_fused chart, whitelist) except -1:
     """Decide whether to accept a lexical edge ``(POS, word)``.
 
     :param score: if -1, agenda is non-probabilistic
@@ -715,19 +1397,22 @@ cdef inline int process_lexedge(LCFRSItem_fused newitem,
     return True
 
 
-cdef inline bint checkwhitelist(LCFRSItem_fused newitem, list whitelist,
+cdef inline bint checkwhitelist(LCFRSItem_fused newitem, whitelist,
                                 bint splitprune, bint markorigin):
     """Return False if item is not on whitelist."""
-    cdef uint32_t n, cnt, label
+    cdef uint32_t cnt, label
     cdef int a, b
     cdef list componentlist = None
     cdef set componentset = None
-    if whitelist is not None and whitelist[newitem.label] is not None:
+    if LCFRSItem_fused is SmallChartItem:
+        if isinstance(whitelist, LCFRSWhitelist):
+            return (<LCFRSWhitelist>whitelist).check(newitem.label, newitem.vec)
+    if whitelist is not None and (<list>whitelist)[newitem.label] is not None:
         if splitprune:  # disc. item to be treated as several split items?
             if markorigin:
-                componentlist = <list > (whitelist[newitem.label])
+                componentlist = <list > ((<list>whitelist)[newitem.label])
             else:
-                componentset = <set > (whitelist[newitem.label])
+                componentset = <set > ((<list>whitelist)[newitem.label])
             b = cnt = 0
             if LCFRSItem_fused is SmallChartItem:
                 a = nextset(newitem.vec, b)
@@ -743,8 +1428,9 @@ cdef inline bint checkwhitelist(LCFRSItem_fused newitem, list whitelist,
                     # given a=3, b=6, make bitvector: 1000000 - 1000 = 111000
                     memset(< void * >FATCOMPONENT.vec, 0,
                             SLOTS * sizeof(uint64_t))
-                    for n in range(a, b):
-                        SETBIT(FATCOMPONENT.vec, n)
+                    while a < b:
+                        SETBIT(FATCOMPONENT.vec, a)
+                        a += 1
                 if markorigin:
                     componentset = <set > (componentlist[cnt])
                 if LCFRSItem_fused is SmallChartItem:
@@ -759,7 +1445,7 @@ cdef inline bint checkwhitelist(LCFRSItem_fused newitem, list whitelist,
         else:
             label = newitem.label
             newitem.label = 0
-            if PySet_Contains(whitelist[label], newitem) != 1:
+            if PySet_Contains((<list>whitelist)[label], newitem) != 1:
                 return False
             newitem.label = label
     return True
@@ -797,88 +1483,196 @@ cdef inline bint concat(ProbRule * rule,
     NB: note reversal due to the way binary numbers are represented
     the least significant bit (rightmost) corresponds to the lowest
     index in the sentence / constituent (leftmost)."""
-    cdef uint64_t lvec, rvec, mask
-    cdef uint64_t * alvec
-    cdef uint64_t * arvec
-    cdef int lpos, rpos, n
     if LCFRSItem_fused is SmallChartItem:
-        lvec = left.vec
-        rvec = right.vec
-        if lvec & rvec:
-            return False
-        mask = rvec if testbit(rule.args, 0) else lvec
-        for n in range(bitlength(rule.lengths)):
-            if testbit(rule.args, n):  # component from right vector
-                if rvec & mask == 0:
-                    return False  # check for expected component
-                rvec |= rvec - 1  # trailing 0 bits => 1 bits
-                mask = rvec & (~rvec - 1)  # mask of 1 bits up to first 0 bit
-            else:  # component from left vector
-                if lvec & mask == 0:
-                    return False  # check for expected component
-                lvec |= lvec - 1  # trailing 0 bits => 1 bits
-                mask = lvec & (~lvec - 1)  # mask of 1 bits up to first 0 bit
-            # zero out component
-            lvec &= ~mask
-            rvec &= ~mask
-            if testbit(rule.lengths, n):  # a gap
-                # check that there is a gap in both vectors
-                if (lvec ^ rvec) & (mask + 1):
-                    return False
-                # increase mask to cover gap
-                # get minimum of trailing zero bits of lvec & rvec
-                mask = (~lvec & (lvec - 1)) & (~rvec & (rvec - 1))
-            mask += 1  # e.g., 00111 => 01000
-        # success if we've reached the end of both left and right vector
-        return lvec == rvec == 0
+        return concatsmall(rule, left.vec, right.vec)
     elif LCFRSItem_fused is FatChartItem:
-        alvec = left.vec
-        arvec = right.vec
-        for n in range(SLOTS):
-            if alvec[n] & arvec[n]:
+        return concatfat(rule, left.vec, right.vec)
+
+
+cdef inline bint concatsmall(ProbRule * rule, uint64_t lvec, uint64_t rvec):
+    """``concat()`` for items that fit into a single machine word."""
+    cdef uint64_t mask
+    cdef int n
+    if lvec & rvec:
+        return False
+    mask = rvec if testbit(rule.args, 0) else lvec
+    for n in range(bitlength(rule.lengths)):
+        if testbit(rule.args, n):  # component from right vector
+            if rvec & mask == 0:
+                return False  # check for expected component
+            rvec |= rvec - 1  # trailing 0 bits => 1 bits
+            mask = rvec & (~rvec - 1)  # mask of 1 bits up to first 0 bit
+        else:  # component from left vector
+            if lvec & mask == 0:
+                return False  # check for expected component
+            lvec |= lvec - 1  # trailing 0 bits => 1 bits
+            mask = lvec & (~lvec - 1)  # mask of 1 bits up to first 0 bit
+        # zero out component
+        lvec &= ~mask
+        rvec &= ~mask
+        if testbit(rule.lengths, n):  # a gap
+            # check that there is a gap in both vectors
+            if (lvec ^ rvec) & (mask + 1):
                 return False
-        lpos = anextset(alvec, 0, SLOTS)
-        rpos = anextset(arvec, 0, SLOTS)
-        # this algorithm was adapted from rparse, FastYFComposer.
-        for n in range(bitlength(rule.lengths)):
-            if testbit(rule.args, n):
-                # check if there are any bits left, and
-                # if any bits on the right should have gone before
-                # ones on this side
-                if rpos == -1 or (lpos != -1 and lpos <= rpos):
-                    return False
-                # jump to next gap
-                rpos = anextunset(arvec, rpos, SLOTS)
-                if lpos != -1 and lpos < rpos:
-                    return False
-                # there should be a gap if and only if
-                # this is the last element of this argument
-                if testbit(rule.lengths, n):
-                    if TESTBIT(alvec, rpos):
-                        return False
-                elif not TESTBIT(alvec, rpos):
-                    return False
-                # jump to next argument
-                rpos = anextset(arvec, rpos, SLOTS)
-            else:  # if bit == 0:
-                # vice versa to the above
-                if lpos == -1 or (rpos != -1 and rpos <= lpos):
-                    return False
-                lpos = anextunset(alvec, lpos, SLOTS)
-                if rpos != -1 and rpos < lpos:
+            # increase mask to cover gap
+            # get minimum of trailing zero bits of lvec & rvec
+            mask = (~lvec & (lvec - 1)) & (~rvec & (rvec - 1))
+        mask += 1  # e.g., 00111 => 01000
+    # success if we've reached the end of both left and right vector
+    return lvec == rvec == 0
+
+
+cdef inline bint concatfat(ProbRule * rule, uint64_t * alvec,
+                           uint64_t * arvec):
+    """``concat()`` for items with an array of words."""
+    cdef int lpos, rpos, n
+    for n in range(SLOTS):
+        if alvec[n] & arvec[n]:
+            return False
+    lpos = anextset(alvec, 0, SLOTS)
+    rpos = anextset(arvec, 0, SLOTS)
+    # this algorithm was adapted from rparse, FastYFComposer.
+    for n in range(bitlength(rule.lengths)):
+        if testbit(rule.args, n):
+            # check if there are any bits left, and
+            # if any bits on the right should have gone before
+            # ones on this side
+            if rpos == -1 or (lpos != -1 and lpos <= rpos):
+                return False
+            # jump to next gap
+            rpos = anextunset(arvec, rpos, SLOTS)
+            if lpos != -1 and lpos < rpos:
+                return False
+            # there should be a gap if and only if
+            # this is the last element of this argument
+            if testbit(rule.lengths, n):
+                if TESTBIT(alvec, rpos):
                     return False
-                if testbit(rule.lengths, n):
-                    if TESTBIT(arvec, lpos):
-                        return False
-                elif not TESTBIT(arvec, lpos):
+            elif not TESTBIT(alvec, rpos):
+                return False
+            # jump to next argument
+            rpos = anextset(arvec, rpos, SLOTS)
+        else:  # if bit == 0:
+            # vice versa to the above
+            if lpos == -1 or (rpos != -1 and rpos <= lpos):
+                return False
+            lpos = anextunset(alvec, lpos, SLOTS)
+            if rpos != -1 and rpos < lpos:
+                return False
+            if testbit(rule.lengths, n):
+                if TESTBIT(arvec, lpos):
                     return False
-                lpos = anextset(alvec, lpos, SLOTS)
-        return lpos == rpos == -1
+            elif not TESTBIT(arvec, lpos):
+                return False
+            lpos = anextset(alvec, lpos, SLOTS)
+    return lpos == rpos == -1
+
+
+cdef inline void indexitem(LCFRSChart_fused chart, LCFRSItem_fused item):
+    """Add item to the lists of items used by ``siblingrange``.
+
+    Items are indexed by start position and by the end of their first
+    component, to look up siblings."""
+    cdef int start, end
+    if LCFRSItem_fused is SmallChartItem:
+        start = nextset(item.vec, 0)
+        end = nextunset(item.vec, start)
+    elif LCFRSItem_fused is FatChartItem:
+        start = anextset(item.vec, 0, SLOTS)
+        end = anextunset(item.vec, start, SLOTS)
+    if chart.bystart[item.label] is None:
+        chart.bystart[item.label] = [[] for _ in range(chart.lensent + 1)]
+        chart.byend[item.label] = [[] for _ in range(chart.lensent + 1)]
+    (<list > (<list > chart.bystart[item.label])[start]).append(item)
+    (<list > (<list > chart.byend[item.label])[end]).append(item)
+
+
+cdef inline bint siblingrange(ProbRule * rule, LCFRSItem_fused item,
+                              bint itemisright, short lensent,
+                              int * lo, int * hi):
+    """Find the positions of siblings that may combine with item.
+
+    Follows the yield function of ``rule`` up to the first component of the
+    sibling; this component either starts where a component of ``item`` ends,
+    or in the gap after it, or before ``item`` starts.
+
+    :returns: ``True`` if ``lo`` and ``hi`` give a range of start positions
+        (``chart.bystart``); ``False`` if siblings must have their first
+        component end at position ``lo`` (``chart.byend``), with
+        ``hi == lo + 1``. Candidates still need to be checked with
+        ``concat``."""
+    cdef int n = 0, m, start, end = -1, pos
+    cdef int numelems = bitlength(rule.lengths)
+    if LCFRSItem_fused is SmallChartItem:
+        start = pos = nextset(item.vec, 0)
+    elif LCFRSItem_fused is FatChartItem:
+        start = pos = anextset(item.vec, 0, SLOTS)
+    # skip over the components of item before the first one of sibling
+    while n < numelems and (testbit(rule.args, n) != 0) == itemisright:
+        if pos == -1:
+            lo[0] = hi[0] = 0
+            return True
+        if LCFRSItem_fused is SmallChartItem:
+            end = nextunset(item.vec, pos)
+            pos = nextset(item.vec, end)
+        elif LCFRSItem_fused is FatChartItem:
+            end = anextunset(item.vec, pos, SLOTS)
+            pos = anextset(item.vec, end, SLOTS)
+        n += 1
+    if n == 0:  # sibling comes first
+        m = 1
+        while m < numelems and (testbit(rule.args, m) != 0) != itemisright:
+            m += 1
+        if m == 1 and not testbit(rule.lengths, 0):
+            lo[0], hi[0] = start, start + 1
+            return False
+        lo[0], hi[0] = 0, start
+    elif n == numelems:  # rule does not match item
+        lo[0] = hi[0] = 0
+    elif not testbit(rule.lengths, n - 1):  # sibling is contiguous with item
+        lo[0], hi[0] = end, end + 1
+    else:  # sibling starts in gap, before next component of item
+        lo[0], hi[0] = end + 1, lensent if pos == -1 else pos
+    return True
+
+
+cdef int getestimatetable(EstimateTable * table, outside) except -1:
+    """Get a view of a 4-dimensional array of outside estimates.
+
+    The array may consist of doubles or single precision floats, and may be
+    read-only, e.g., when memory-mapped with ``np.load(..., mmap_mode='r')``.
+    The array is not copied; the caller should keep a reference to it."""
+    cdef const double[:, :, :, :] doubles
+    cdef const float[:, :, :, :] floats
+    cdef int n
+    table.single = outside.dtype == np.float32
+    if table.single:
+        floats = outside
+        table.data = <char * >&(floats[0, 0, 0, 0])
+        for n in range(4):
+            table.strides[n] = floats.strides[n]
+    else:
+        doubles = outside
+        table.data = <char * >&(doubles[0, 0, 0, 0])
+        for n in range(4):
+            table.strides[n] = doubles.strides[n]
+    return 0
+
+
+cdef inline double getestimate(EstimateTable * table, uint32_t label,
+                               int a, int b, int c):
+    """Look up the estimate ``outside[label, a, b, c]``."""
+    cdef char * ptr = (table.data + label * table.strides[0]
+                       + a * table.strides[1] + b * table.strides[2]
+                       + c * table.strides[3])
+    if table.single:
+        return (<float * >ptr)[0]
+    return (<double * >ptr)[0]
 
 
 cdef parse_symbolic(LCFRSChart_fused chart, LCFRSItem_fused goal,
                     sent, Grammar grammar, tags,
-                    list whitelist, bint splitprune, bint markorigin):
+                    whitelist, bint splitprune, bint markorigin):
     cdef:
         list agenda = [set() for _ in sent]  # an agenda for each span length
         list items = chart.probs  # tracks items for each label
@@ -990,7 +1784,7 @@ cdef parse_symbolic(LCFRSChart_fused chart, LCFRSItem_fused goal,
 
 cdef inline bint process_edge_symbolic(LCFRSItem_fused newitem, ProbRule * rule,
                                        LCFRSItem_fused left, list agenda, LCFRSChart_fused chart,
-                                       list whitelist, bint splitprune, bint markorigin):
+                                       whitelist, bint splitprune, bint markorigin):
     """Decide what to do with a newly derived edge.
 
     :returns: ``True`` when edge is accepted in the chart, ``False`` when
@@ -1017,7 +1811,7 @@ cdef inline bint process_edge_symbolic(LCFRSItem_fused newitem, ProbRule * rule,
 
 
 # def newparser(sent, Grammar grammar, tags=None, start=1,
-# 		bint exhaustive=True, list whitelist=None, bint splitprune=False,
+# 		bint exhaustive=True, whitelist=None, bint splitprune=False,
 # 		bint markorigin=False, estimates=None):
 # 	# assign POS tags, unaries on POS tags
 # 	for length in range(2, len(sent) + 1):
@@ -1112,5 +1906,6 @@ def test():
     assert do('Daruber muss nachgedacht ' + ' '.join(64 * ['werden']), grammar)
 
 
-__all__ = ['Agenda', 'DoubleAgenda', 'LCFRSChart', 'SmallLCFRSChart',
-           'FatLCFRSChart', 'getparent', 'merge', 'parse']
+__all__ = ['Agenda', 'DoubleAgenda', 'RadixAgenda', 'LCFRSChart',
+           'SmallLCFRSChart', 'FatLCFRSChart', 'PackedLCFRSChart', 'getparent',
+           'merge', 'parse']
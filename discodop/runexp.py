@@ -8,6 +8,7 @@ import os
 import re
 import csv
 import sys
+import gc
 import json
 import gzip
 import time
@@ -33,6 +34,7 @@ from . import __version__, treebank, treebanktransforms, treetransforms, \
 from .treetransforms import binarizetree
 from .util import workerfunc
 from .containers import Grammar
+from .disambiguation import compilebacktransform
 
 INTERNALPARAMS = None
 
@@ -208,8 +210,13 @@ def startexp(
     deletelabel = evalparam.get('DELETE_LABEL', ())
     deleteword = evalparam.get('DELETE_WORD', ())
 
-    begin = time.clock()
     theparser = parser.Parser(prm, funcclassifier=funcclassifier)
+    if any((stage.ktarget_time or stage.ktarget_items)
+           and stage.ktable is None for stage in prm.stages):
+        logging.info('tuning k on calibration corpus')
+        parser.calibratek(theparser, loadcalibrationcorpus(prm, usetags),
+                          resultdir)
+    begin = time.clock()
     results = doparsing(parser=theparser, testset=testset, resultdir=resultdir,
                         usetags=usetags, numproc=prm.numproc, deletelabel=deletelabel,
                         deleteword=deleteword, corpusfmt=prm.corpusfmt,
@@ -266,6 +273,29 @@ def loadtraincorpus(corpusfmt, traincorpus, binarization, punct, functions,
     return trees, sents, train_tagged_sents
 
 
+def loadcalibrationcorpus(prm, usetags):
+    """Load the held-out sentences used to tune the pruning parameter k.
+
+    :returns: a list of ``(sent, tags)`` tuples."""
+    calibration = prm.calibration
+    corpus = treebank.READERS[prm.corpusfmt](
+        calibration.path, encoding=calibration.encoding,
+        headrules=prm.binarization.headrules,
+        removeempty=prm.removeempty, morphology=prm.morphology,
+        functions=prm.functions, ensureroot=prm.ensureroot)
+    result = [(item.sent, [tag for _, tag in sorted(item.tree.pos())]
+               if usetags else None)
+              for _, item in corpus.itertrees(
+                  calibration.skip, calibration.skip + calibration.numsents)
+              if 1 <= len(item.sent) <= calibration.maxwords]
+    logging.info('%d calibration sentences after length restriction <= %d',
+                 len(result), calibration.maxwords)
+    if not result:
+        raise ValueError('calibration corpus (selection) should be '
+                         'non-empty.')
+    return result
+
+
 def getposmodel(postagging, train_tagged_sents):
     """Apply unknown word model to sentences before extracting grammar."""
     postagging.update(unknownwordfun=lexicon.UNKNOWNWORDFUNC[postagging.model])
@@ -426,6 +456,9 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
             if stage.estimator != 'rfe':
                 gram.switch('%s' % stage.estimator)
             logging.info(gram.testgrammar()[1])
+            # reload grammar as memory mapped file, shared by parse workers
+            gram.tofile('%s/%s.grammar' % (resultdir, stage.name))
+            gram = Grammar.fromfile('%s/%s.grammar' % (resultdir, stage.name))
             if stage.dop in ('doubledop', 'dop1'):
                 # backtransform keys are line numbers to rules file;
                 # to see them together do:
@@ -492,6 +525,8 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
                 lexiconfile.write(lex)
             gram = Grammar(rules, lex, start=top)
             logging.info(gram.testgrammar()[1])
+            gram.tofile('%s/%s.grammar' % (resultdir, stage.name))
+            gram = Grammar.fromfile('%s/%s.grammar' % (resultdir, stage.name))
             if n and stage.prune:
                 msg = gram.getmapping(stages[prevn].grammar,
                                       striplabelre=None,
@@ -513,22 +548,31 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
                 raise ValueError('estimates require parser w/agenda.')
             begin = time.clock()
             logging.info('computing %s estimates', stage.estimates)
+            outsidefile = '%s/%s.outside.npy' % (resultdir, stage.name)
             if stage.estimates == 'SX':
                 outside = estimates.getpcfgestimates(gram, testmaxwords,
                                                      gram.toid[trees[0].label])
             elif stage.estimates == 'SXlrgaps':
-                outside = estimates.getestimates(gram, testmaxwords,
-                                                 gram.toid[trees[0].label])
+                # write table directly to disk, unless it is to be converted
+                outside = estimates.getestimates(
+                    gram, testmaxwords, gram.toid[trees[0].label],
+                    None if stage.estimates_float32 else outsidefile,
+                    numproc=numproc)
             logging.info('estimates done. cpu time elapsed: %gs',
                          time.clock() - begin)
-            np.savez_compressed('%s/%s.outside.npz' % (
-                resultdir, stage.name), outside=outside)
+            if stage.estimates == 'SX' or stage.estimates_float32:
+                estimates.writeestimates(outside, outsidefile,
+                                         stage.estimates_float32)
+            del outside
+            outside = np.load(outsidefile, mmap_mode='r')
             logging.info('saved %s estimates', stage.estimates)
         elif stage.estimates:
             raise ValueError('unrecognized value; specify SX or SXlrgaps.')
 
+        if backtransform is not None:
+            backtransform = compilebacktransform(backtransform)
         stage.update(grammar=gram, backtransform=backtransform,
-                     outside=outside)
+                     outside=outside, ktable=None)
 
     if any(stage.mapping is not None for stage in stages):
         with codecs.getwriter('utf8')(gzip.open('%s/mapping.json.gz' % (
@@ -558,10 +602,20 @@ def doparsing(**kwds):
         initworker(params)
         dowork = (worker(a) for a in params.testset.items())
     else:
-        pool = multiprocessing.Pool(processes=params.numproc,
-                                    initializer=initworker, initargs=(params,))
-        dowork = pool.imap_unordered(
-            mpworker, params.testset.items())
+        if hasattr(gc, 'freeze'):  # Python 3.7+
+            # Grammars are inherited by the forked workers; memory mapped
+            # grammars are shared, but other objects are copied as soon as
+            # the garbage collector touches them. Exempt them from collection.
+            gc.freeze()
+        pool = parser.forkcontext().Pool(
+            processes=params.numproc, initializer=initworker,
+            initargs=(params,))
+        # parse longest sentences first, to avoid a long tail at the end.
+        items = list(params.testset.items())
+        dowork = parser.mapbycost(
+            pool, worker, items,
+            [parser.parsecost(len(item[1][0])) for item in items],
+            params.numproc or multiprocessing.cpu_count(), ordered=False)
     logging.info('going to parse %d sentences.', len(params.testset))
     # main parse loop over each sentence in test corpus
     for nsent, data in enumerate(dowork, 1):
@@ -635,6 +689,8 @@ def doparsing(**kwds):
         pool.terminate()
         pool.join()
         del dowork, pool
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
 
     writeresults(results, params)
     return results
@@ -378,6 +378,42 @@ class TestHeap(TestCase):
 				sorted(list(d1.keys()) + list(d1.values())))
 
 
+class TestRadixAgenda(TestCase):
+	def test_popitem(self):
+		from random import random, randrange
+		from discodop.plcfrs import RadixAgenda
+		h = RadixAgenda()
+		d = {}
+		last = 0.0
+		for _ in range(1000):
+			if d and random() < 0.3:
+				k, v = h.popitem()
+				self.assertEqual(v, min(d.values()))
+				self.assertEqual(v, d.pop(k))
+				last = v
+			else:
+				# monotone: new priorities are not lower than the last popped
+				k, v = randrange(200), last + random() * randrange(3)
+				if k not in d or v < d[k]:  # insert or decrease-key
+					h[k] = d[k] = v
+			self.assertEqual(len(h), len(d))
+			for k in d:
+				self.assertIn(k, h)
+				self.assertEqual(h[k], d[k])
+		while d:
+			k, v = h.popitem()
+			self.assertEqual(v, min(d.values()))
+			self.assertEqual(v, d.pop(k))
+		self.assertEqual(len(h), 0)
+		self.assertRaises(IndexError, h.popitem)
+
+	def test_negative(self):
+		from discodop.plcfrs import RadixAgenda
+		h = RadixAgenda()
+		with self.assertRaises(ValueError):
+			h[0] = -1.0
+
+
 def test_fragments():
 	from discodop._fragments import getctrees, extractfragments, exactcounts
 	treebank = """\
@@ -407,6 +443,31 @@ def test_fragments():
 			list(fragments.values()))
 	assert len(fragments) == 25
 	assert sum(counts) == 100
+	# skipping pairs without common productions does not change the result
+	assert set(extractfragments(params['trees1'], 0, 0, params['vocab'],
+			disc=True, approx=False, minprods=0)) == set(fragments)
+	# without production index, all pairs are compared
+	params = getctrees(zip(trees, sents), index=False)
+	assert set(extractfragments(params['trees1'], 0, 0, params['vocab'],
+			disc=True, approx=False)) == set(fragments)
+	# all pairs share productions, so the prefilter is turned off halfway
+	params = getctrees(zip(trees * 8, sents * 8))
+	assert extractfragments(params['trees1'], 0, 30, params['vocab'],
+			disc=True, approx=False) == extractfragments(
+			params['trees1'], 0, 30, params['vocab'],
+			disc=True, approx=False, minprods=0)
+	params = getctrees(zip(trees, sents))
+	fragments2 = extractfragments(params['trees1'], 0, 0, params['vocab'],
+			disc=True, approx=False, minprods=8)
+	assert 0 < len(fragments2) < len(fragments)
+	assert set(fragments2) <= set(fragments)
+	# minprods also restricts the pairs compared with adjacent=True
+	fragments = extractfragments(params['trees1'], 0, 0, params['vocab'],
+			disc=True, approx=False, adjacent=True)
+	fragments2 = extractfragments(params['trees1'], 0, 0, params['vocab'],
+			disc=True, approx=False, adjacent=True, minprods=8)
+	assert len(fragments2) < len(fragments)
+	assert set(fragments2) <= set(fragments)
 
 
 def test_allfragments():
@@ -490,7 +551,8 @@ def test_grammar(debug=False):
 	from discodop.containers import Grammar
 	from discodop.treebank import NegraCorpusReader
 	from discodop.treetransforms import addfanoutmarkers, removefanoutmarkers
-	from discodop.disambiguation import recoverfragments
+	from discodop.disambiguation import recoverfragments, TreeNodes, \
+			compilebacktransform
 	from discodop.kbest import lazykbest
 	from math import exp
 	corpus = NegraCorpusReader('alpinosample.export', punct='move')
@@ -517,6 +579,7 @@ def test_grammar(debug=False):
 	if debug:
 		print(grammar)
 	assert grammar.testgrammar()[0], "RFE should sum to 1."
+	compiled = compilebacktransform(backtransform)
 	for tree, sent in zip(corpus.trees().values(), sents):
 		if debug:
 			print("sentence:", ' '.join(a.encode('unicode-escape').decode()
@@ -527,8 +590,12 @@ def test_grammar(debug=False):
 		if chart:
 			mpp, parsetrees = {}, {}
 			derivations, _ = lazykbest(chart, 1000, '}<')
+			nodes = TreeNodes(chart, backtransform)
 			for d, (t, p) in zip(chart.rankededges[chart.root()], derivations):
-				r = Tree(recoverfragments(d.key, chart, backtransform))
+				r = recoverfragments(d.key, chart, backtransform)
+				assert nodes.tostring(nodes.recover(d.key)) == r
+				assert recoverfragments(d.key, chart, compiled) == r
+				r = Tree(r)
 				r = str(removefanoutmarkers(unbinarize(r)))
 				mpp[r] = mpp.get(r, 0.0) + exp(-p)
 				parsetrees.setdefault(r, []).append((t, p))
@@ -552,6 +619,696 @@ def test_grammar(debug=False):
 	Grammar(treebankgrammar([tree], [[str(a) for a in range(10)]]))
 
 
+def test_grammarfile(tmpdir):
+	"""Verify that a compiled grammar file gives the same parses."""
+	import pickle
+	from discodop.grammar import dopreduction
+	from discodop import plcfrs
+	from discodop.containers import Grammar
+	from discodop.treebank import NegraCorpusReader
+	from discodop.kbest import lazykbest
+	corpus = NegraCorpusReader('alpinosample.export', punct='move')
+	sents = list(corpus.sents().values())
+	trees = [binarize(a.copy(True), horzmarkov=1)
+			for a in list(corpus.trees().values())]
+	xgrammar, altweights = dopreduction(trees, sents)
+	grammar = Grammar(xgrammar, start=trees[0].label)
+	grammar.register('shortest', altweights['shortest'])
+	filename = str(tmpdir.join('dop.grammar'))
+	grammar.tofile(filename)
+	grammar1 = Grammar.fromfile(filename)
+	assert str(grammar1) == str(grammar)
+	assert grammar1.modelnames == grammar.modelnames
+	assert grammar1.rulenos == grammar.rulenos
+	assert (grammar1.models == grammar.models).all()
+	for sent in sents[:2]:
+		chart, _ = plcfrs.parse(sent, grammar, exhaustive=True)
+		chart1, _ = plcfrs.parse(sent, grammar1, exhaustive=True)
+		assert lazykbest(chart, 10)[0] == lazykbest(chart1, 10)[0]
+	grammar.switch('shortest', logprob=False)
+	grammar1.switch('shortest', logprob=False)
+	assert str(grammar1) == str(grammar)
+	# pickled by filename
+	assert str(pickle.loads(pickle.dumps(grammar1))) == str(grammar)
+	grammar1.register('other', altweights['shortest'])
+	grammar1.switch('other', logprob=True)
+	grammar.switch('shortest', logprob=True)
+	assert str(grammar1) == str(grammar)
+	grammar1.switch('default', logprob=True)
+	grammar.switch('default', logprob=True)
+	assert str(grammar1) == str(grammar)
+	assert str(pickle.loads(pickle.dumps(grammar1))) == str(grammar)
+	# a compiled grammar older than the text files is not used
+	import gzip
+	from time import time
+	from discodop.grammar import treebankgrammar
+	from discodop.parser import readgrammars, DictObj, DEFAULTSTAGE
+	grammar.tofile(str(tmpdir.join('stage1.grammar')))
+	newgrammar = Grammar(treebankgrammar(trees, sents), start=trees[0].label)
+	for ext, text in (('rules', newgrammar.origrules),
+			('lex', newgrammar.origlexicon)):
+		filename = str(tmpdir.join('stage1.%s.gz' % ext))
+		with gzip.open(filename, 'wb') as out:
+			out.write(text.encode('utf8'))
+		os.utime(filename, (time() + 10, time() + 10))
+	stage = DictObj(DEFAULTSTAGE)
+	readgrammars(str(tmpdir), [stage], top=trees[0].label)
+	assert str(stage.grammar) == str(newgrammar)
+
+
+def simpleparser():
+	"""Return a PLCFRS parser for alpinosample and its sentences."""
+	from discodop.grammar import treebankgrammar
+	from discodop.containers import Grammar
+	from discodop.treebank import NegraCorpusReader
+	from discodop.treetransforms import addfanoutmarkers
+	from discodop.parser import Parser, DictObj, DEFAULTSTAGE
+	corpus = NegraCorpusReader('alpinosample.export', punct='move')
+	sents = list(corpus.sents().values())
+	trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+			for a in list(corpus.trees().values())]
+	stage = DictObj(DEFAULTSTAGE)
+	stage.update(grammar=Grammar(treebankgrammar(trees, sents),
+			start=trees[0].label), backtransform=None, objective='mpd')
+	parser = Parser(DictObj(stages=[stage], transformations=None,
+			binarization=DictObj(tailmarker=None, headrules=None),
+			postagging=None, relationalrealizational=None, verbosity=0))
+	return parser, sents
+
+
+def test_parse_many():
+	"""Batch parsing gives the same results as parsing one by one."""
+	parser, sents = simpleparser()
+	expected = [str(list(parser.parse(sent))[-1].parsetree)
+			for sent in sents]
+	for numproc in (1, 2):
+		results = parser.parse_many([(sent, None) for sent in sents],
+				numproc=numproc)
+		assert [str(a[-1].parsetree) for a in results] == expected
+
+
+def test_budget():
+	"""A stage that exceeds its budget gives a fallback parse."""
+	from discodop import plcfrs
+	parser, sents = simpleparser()
+	grammar = parser.stages[0].grammar
+	chart, msg = plcfrs.parse(sents[0], grammar, maxitems=10)
+	assert chart is None and msg.startswith('budget exceeded')
+	chart, _ = plcfrs.parse(sents[0], grammar, maxitems=10 ** 6)
+	assert chart
+	parser.stages[0].update(budget_items=10)
+	result = list(parser.parse(sents[0]))[-1]
+	assert result.budgetexceeded and result.noparse
+	parser.stages[0].update(budget_items=0, budget_time=60)
+	result = list(parser.parse(sents[0]))[-1]
+	assert not result.budgetexceeded and not result.noparse
+
+
+def test_calibratek(tmpdir):
+	"""Tune k for a pruned stage against a target on chart items."""
+	from discodop.containers import Grammar
+	from discodop.parser import DictObj, calibratek, kcandidates, tunedk
+	parser, sents = simpleparser()
+	coarse = parser.stages[0]
+	fine = DictObj(vars(coarse))
+	fine.update(name='fine', prune=coarse.name, k=50, ktarget_items=1,
+			grammar=Grammar(coarse.grammar.origrules,
+				coarse.grammar.origlexicon, start=coarse.grammar.start))
+	fine.grammar.getmapping(coarse.grammar, striplabelre=None,
+			neverblockre=None, splitprune=False, markorigin=False)
+	parser.stages.append(fine)
+	tunedsents = [(sent, None) for sent in sents]
+	assert kcandidates(fine.k)[-1] == 1
+	# an unattainable target gives the most aggressive pruning
+	table = calibratek(parser, tunedsents, str(tmpdir))['fine']
+	assert all(k == 1 for _, k in table) and fine.ktable == table
+	assert tmpdir.join('fine.ktable.json').check()
+	# a generous target leaves k as it is
+	fine.update(ktarget_items=10 ** 6)
+	table = calibratek(parser, tunedsents)['fine']
+	assert all(k == 50 for _, k in table)
+	assert tunedk(table, 1000) == 50
+	assert not list(parser.parse(sents[0]))[-1].noparse
+	# sentences for which the stage is not reached are ignored
+	parse = parser.parse
+	parser.parse = lambda sent, tags: [
+			a for a in parse(sent, tags) if a.name != 'fine']
+	fine.update(ktarget_items=1)
+	assert all(k == 50 for _, k in calibratek(parser, tunedsents)['fine'])
+
+
+def test_parse_nary(tmpdir):
+	"""Native n-best parsing with a grammar that is not binarized."""
+	import pickle
+	from math import log
+	from discodop.containers import Grammar
+	from discodop import pcfg
+	from discodop.pcfg import parse_nary
+	from discodop.kbest import lazykbest
+	from discodop.util import which
+	rules = ('2\tS\tNP\tVP\n'
+			'1\tS\tNP\tV\tNP\tPP\n'
+			'3\tVP\tV\tNP\n'
+			'1\tVP\tV\tNP\tPP\n'
+			'4\tNP\tNP\tPP\n'
+			'1\tPP\tP\tNP\n')
+	lexicon = ('Mary\tNP 1\nsaw\tV 1\nJohn\tNP 1\nwith\tP 1\n'
+			'binoculars\tNP 1\n')
+	grammar = Grammar(rules, lexicon, start='S', binarized=False)
+	grammar.switch('default', logprob=True)
+	sent = 'Mary saw John with binoculars'.split()
+	chart, _ = parse_nary(sent, grammar, 10)
+	derivs = chart.rankededges[chart.root()]
+	assert len(derivs) == 3
+	assert all('@<' not in deriv for deriv, _ in derivs)
+	assert [prob for _, prob in derivs] == sorted(prob for _, prob in derivs)
+	assert derivs[0][0] == '(S (NP 0) (V 1) (NP 2) (PP (P 3) (NP 4)))'
+	chart, _ = parse_nary('John with'.split(), grammar, 10)
+	assert not chart
+	# the whitelist refers to labels of the original grammar
+	labels = set(range(grammar.nonterminals)) - {grammar.toid['VP']}
+	chart, _ = parse_nary(sent, grammar, 10, whitelist=[labels] * 15)
+	derivs = chart.rankededges[chart.root()]
+	assert [deriv for deriv, _ in derivs] == [
+			'(S (NP 0) (V 1) (NP 2) (PP (P 3) (NP 4)))']
+	chart, _ = parse_nary(sent, grammar, 10, maxitems=1)
+	assert chart is None
+	try:
+		pcfg.parse(sent, grammar)
+	except ValueError:
+		pass
+	else:
+		raise AssertionError('expected ValueError')
+	# the binarized grammar has the weights of the original rules;
+	# P(S => NP V NP PP) = 1/3; P(NP => Mary) = 1/7; P(PP => P NP) = 1.
+	auxgrammar = pcfg.binarizegrammar(grammar)
+	assert str(pickle.loads(pickle.dumps(auxgrammar))) == str(auxgrammar)
+	chart, _ = parse_nary(sent, grammar, 10, auxgrammar=auxgrammar)
+	deriv, prob = chart.rankededges[chart.root()][0]
+	assert abs(prob - log(3 * 7 ** 3)) < 1e-12
+	# a binarized grammar is parsed with directly
+	bingrammar = Grammar(rules.replace('1\tS\tNP\tV\tNP\tPP\n', '').replace(
+			'1\tVP\tV\tNP\tPP\n', '1\tVP\tVP\tPP\n'), lexicon, start='S')
+	bingrammar.switch('default', logprob=True)
+	chart, _ = parse_nary(sent, bingrammar, 10)
+	assert chart.getitems()
+	assert [a for a, _ in chart.rankededges[chart.root()]] == [
+			a for a, _ in lazykbest(pcfg.parse(sent, bingrammar)[0], 10)[0]]
+	# compare with the derivations of bitpar; bitpar always normalizes
+	# weights, so use a grammar with rules and a lexicon that sum to one.
+	try:
+		which('bitpar')
+	except ValueError:
+		return
+	rules = ('0.6\tS\tNP\tVP\n'
+			'0.4\tS\tNP\tV\tNP\tPP\n'
+			'0.7\tVP\tV\tNP\n'
+			'0.3\tVP\tV\tNP\tPP\n'
+			'0.8\tNP\tN\n'
+			'0.2\tNP\tNP\tPP\n'
+			'1.0\tPP\tP\tNP\n')
+	lexicon = ('Mary\tN 0.5\nJohn\tN 0.3\nbinoculars\tN 0.2\n'
+			'saw\tV 1.0\nwith\tP 1.0\n')
+	grammar = Grammar(rules, lexicon, start='S', binarized=False)
+	grammar.switch('default', logprob=True)
+	rulesfile, lexiconfile = tmpdir.join('rules'), tmpdir.join('lexicon')
+	rulesfile.write(rules)
+	lexiconfile.write(lexicon)
+	for sent in ('Mary saw John with binoculars'.split(),
+			'Mary saw John with John with binoculars'.split()):
+		chart1, _ = parse_nary(sent, grammar, 1000)
+		chart2, _, _ = pcfg.parse_bitpar(grammar, str(rulesfile),
+				str(lexiconfile), sent, 1000, 'S', grammar.toid['S'])
+		derivs1 = dict(chart1.rankededges[chart1.root()])
+		derivs2 = dict(chart2.rankededges[chart2.root()])
+		assert set(derivs1) == set(derivs2)
+		assert all(abs(derivs1[a] - derivs2[a]) < 1e-6 for a in derivs1)
+
+
+def test_densechartmemory():
+	"""A dense CFG chart only allocates its triangular arrays."""
+	from discodop.containers import Grammar
+	from discodop.pcfg import DenseCFGChart
+
+	def vmsize():
+		"""Return virtual memory size of this process in kB, if available."""
+		try:
+			with open('/proc/self/status') as inp:
+				for line in inp:
+					if line.startswith('VmSize:'):
+						return int(line.split()[1])
+		except IOError:
+			return None
+
+	numlabels, lensent = 2000, 40
+	rules = ''.join('L%d\tA\t0\t1\n' % n for n in range(numlabels))
+	grammar = Grammar(rules, 'a\tA 1\n', start='L0')
+	sent = ['a'] * lensent
+	before = vmsize()
+	chart = DenseCFGChart(grammar, sent)
+	after = vmsize()
+	if before is None:
+		return
+	# parse forest (16 bytes/item) and probabilities (8 bytes/item) for
+	# cells 0 <= start < end <= lensent; a square array for the parse forest
+	# alone would take 16 * numlabels * lensent ** 2 bytes.
+	triangular = 24 * grammar.nonterminals * lensent * (lensent + 1) // 2
+	square = 16 * grammar.nonterminals * lensent ** 2
+	print('VmSize before: %d kB; after: %d kB; triangular arrays: %d kB; '
+			'square parse forest: %d kB' % (
+			before, after, triangular // 1024, square // 1024))
+	assert after - before < 1.1 * triangular // 1024 < square // 1024
+	del chart
+
+
+def test_insideoutside():
+	"""Posterior probabilities with a CFG and an LCFRS chart."""
+	from math import exp
+	from discodop.containers import Grammar
+	from discodop import pcfg, plcfrs
+	from discodop.kbest import lazykbest
+	from discodop.coarsetofine import posteriorthreshold
+	rules = ('2\tS\tNP\tVP\n'
+			'3\tVP\tV\tNP\n'
+			'1\tVP\tVP\tPP\n'
+			'4\tNP\tNP\tPP\n'
+			'1\tPP\tP\tNP\n')
+	lexicon = ('Mary\tNP 1\nsaw\tV 1\nJohn\tNP 1\nwith\tP 1\n'
+			'binoculars\tNP 1\n')
+	grammar = Grammar(rules, lexicon, start='S')
+	grammar.switch('default', logprob=True)
+	sent = 'Mary saw John with binoculars with John'.split()
+	for parse, kwargs in ((pcfg.parse, {}), (plcfrs.parse, {}),
+			(plcfrs.parse, {'packed': True})):
+		chart, _ = parse(sent, grammar, **kwargs)
+		derivs, _ = lazykbest(chart, 1000)
+		sentprob = sum(exp(-prob) for _, prob in derivs)
+		items, msg = posteriorthreshold(chart, 0.5)
+		assert len(chart.inside) == len(chart.outside) >= len(items) == 12
+		assert abs(float(msg.split('sentprob=')[1]) - sentprob) < 1e-8
+		assert str(chart).count(' ins=') == len(chart.getitems())
+
+
+def test_maxrule():
+	"""Max-rule decoding agrees with rule posteriors of all derivations."""
+	from math import exp
+	from collections import defaultdict
+	from discodop.tree import Tree
+	from discodop.containers import Grammar
+	from discodop.grammar import dopreduction
+	from discodop import plcfrs
+	from discodop.disambiguation import getderivations, marginalize, \
+			REMOVEIDS
+	trees = [Tree(a) for a in (
+			'(ROOT (A (A 0) (B 1)) (C 2))', '(ROOT (C 0) (A (A 1) (B 2)))',
+			'(ROOT (A 0) (C (B 1) (C 2)))', '(ROOT (B (A 0) (B 1)) (C 2))',
+			'(ROOT (B (A 0) (B 1)) (C 2))')]
+	sents = [a.split() for a in ('d b c', 'c a b', 'a e f', 'a b f', 'e f c')]
+	grammar = Grammar(dopreduction(trees, sents)[0])
+	chart, _ = plcfrs.parse('a b c'.split(), grammar, exhaustive=True)
+	derivations, _ = getderivations(chart, 100000)
+	sentprob = sum(exp(-prob) for _, prob in derivations)
+	rules, posterior = {}, defaultdict(float)
+	for deriv, prob in derivations:
+		tree = Tree(REMOVEIDS.sub('', deriv))
+		rules[str(tree)] = [((node.label, tuple(node.leaves())),
+				tuple((child.label, tuple(child.leaves()))
+					if isinstance(child, Tree) else child for child in node))
+				for node in tree.subtrees()]
+		for parent, children in set(rules[str(tree)]):
+			posterior[parent, children] += exp(-prob) / sentprob
+			posterior[parent] += exp(-prob) / sentprob
+	for objective in ('max-rule-product', 'variational'):
+		def score(tree):
+			result = 1.0
+			for parent, children in rules[tree]:
+				result *= posterior[parent, children]
+				if objective == 'variational':
+					result /= posterior[parent]
+			return result
+		(tree, prob, _), = marginalize(objective, [], [], chart)[0]
+		assert tree in rules
+		assert abs(prob - score(tree)) < 1e-8
+		assert all(prob >= score(a) - 1e-8 for a in rules)
+
+
+def test_doprerank():
+	"""Reranking a batch of trees gives their individual DOP probabilities."""
+	from math import exp
+	from discodop.tree import Tree
+	from discodop.containers import Grammar
+	from discodop.grammar import treebankgrammar, dopreduction
+	from discodop.disambiguation import doprerank, dopparseprob
+	from discodop.treetransforms import addbitsets
+	trees = [Tree(a) for a in (
+			'(ROOT (A (A 0) (B 1)) (C 2))', '(ROOT (C 0) (A (A 1) (B 2)))',
+			'(ROOT (A 0) (C (B 1) (C 2)))', '(ROOT (B (A 0) (B 1)) (C 2))',
+			'(ROOT (B (A 0) (B 1)) (C 2))')]
+	sents = [a.split() for a in ('d b c', 'c a b', 'a e f', 'a b f', 'e f c')]
+	coarse = Grammar(treebankgrammar(trees, sents))
+	fine = Grammar(dopreduction(trees, sents)[0])
+	fine.getrulemapping(coarse, re.compile(r'@[-0-9]+\b'))
+	sent = 'a b c'.split()
+	candidates = [('(ROOT (A (A 0) (B 1)) (C 2))', 0.5, None),
+			('(ROOT (B (A 0) (B 1)) (C 2))', 0.3, None),
+			('(ROOT (A 0) (C (B 1) (C 2)))', 0.2, None)]
+	# probabilities of the candidates as scored one by one before batching
+	expected = [0.012186314671521769, 0.015539371870732822,
+			0.0021433267587113738]
+	results, _ = doprerank(candidates, sent, 3, coarse, fine)
+	assert [a for a, _, _ in results] == [a for a, _, _ in candidates]
+	for (tree, prob, _), prob1 in zip(results, expected):
+		assert abs(prob - prob1) < 1e-12
+		assert abs(exp(dopparseprob(addbitsets(tree), sent, coarse, fine))
+				- prob1) < 1e-12
+
+
+def test_estimatesfile(tmpdir):
+	"""Memory-mapped single precision estimates give the same chart."""
+	import numpy as np
+	from discodop.containers import Grammar
+	from discodop.grammar import treebankgrammar
+	from discodop.estimates import getestimates, writeestimates
+	from discodop import plcfrs
+	trees = [Tree('(ROOT (A (a 0) (b 1)))'),
+			Tree('(ROOT (B (a 0) (c 2)) (b 1))'),
+			Tree('(ROOT (B (a 0) (c 2)) (b 1))'),
+			Tree('(ROOT (C (a 0) (c 2)) (b 1))')]
+	sents = [['a', 'b'], ['a', 'b', 'c'], ['a', 'b', 'c'], ['a', 'b', 'c']]
+	grammar = Grammar(treebankgrammar(trees, sents))
+	outside = getestimates(grammar, 4, grammar.toid['ROOT'])
+	filename = str(tmpdir.join('outside.npy'))
+	writeestimates(outside, filename, float32=True)
+	outside32 = np.load(filename, mmap_mode='r')
+	assert outside32.dtype == np.float32
+	assert np.allclose(outside, outside32)
+	chart1, _ = plcfrs.parse(['a', 'b', 'c'], grammar,
+			estimates=('SXlrgaps', outside))
+	chart2, _ = plcfrs.parse(['a', 'b', 'c'], grammar,
+			estimates=('SXlrgaps', outside32))
+	assert chart1 and str(chart1) == str(chart2)
+
+
+def test_estimatesincremental():
+	"""Parallel and incremental estimates equal those computed at once."""
+	import numpy as np
+	from discodop.containers import Grammar
+	from discodop.grammar import treebankgrammar
+	from discodop.estimates import getestimates, getpcfgestimates
+	trees = [Tree('(ROOT (A (a 0) (b 1)))'),
+			Tree('(ROOT (B (a 0) (c 2)) (b 1))'),
+			Tree('(ROOT (C (a 0) (c 2)) (b 1))')]
+	sents = [['a', 'b'], ['a', 'b', 'c'], ['a', 'b', 'c']]
+	grammar = Grammar(treebankgrammar(trees, sents))
+	goal = grammar.toid['ROOT']
+	outside = getestimates(grammar, 5, goal)
+	assert np.array_equal(outside, getestimates(grammar, 5, goal, numproc=2))
+	previous = getestimates(grammar, 3, goal)
+	assert np.array_equal(outside, getestimates(
+			grammar, 5, goal, previous=previous))
+	assert np.array_equal(outside, getestimates(
+			grammar, 5, goal, previous=previous, numproc=2))
+	try:
+		getestimates(grammar, 2, goal, previous=previous)
+	except ValueError as err:
+		assert 'maxlen 3; expected %d labels and maxlen <= 2' % (
+				grammar.nonterminals) in str(err), err
+	else:
+		raise AssertionError('expected ValueError')
+
+	grammar = Grammar('2\tS\tNP\tVP\n3\tVP\tV\tNP\n1\tVP\tVP\tPP\n'
+			'4\tNP\tNP\tPP\n1\tPP\tP\tNP\n1\tS\tVP\n',
+			'Mary\tNP 1\nsaw\tV 1\tNP 1\nwith\tP 1\n', start='S')
+	goal = grammar.toid['S']
+	outside = getpcfgestimates(grammar, 6, goal)
+	assert np.array_equal(outside, getpcfgestimates(
+			grammar, 6, goal, previous=getpcfgestimates(grammar, 3, goal)))
+
+
+def test_twopass():
+	"""Parsing with a recognition pass gives the same derivations."""
+	from discodop.containers import Grammar
+	from discodop.pcfg import parse, recognize
+	from discodop.kbest import lazykbest
+	rules = ('2\tS\tNP\tVP\n'
+			'3\tVP\tV\tNP\n'
+			'1\tVP\tVP\tPP\n'
+			'4\tNP\tNP\tPP\n'
+			'1\tPP\tP\tNP\n'
+			'1\tX\tNP\tV\n'
+			'1\tNP\tX\tNP\n')
+	lexicon = ('Mary\tNP 1\nsaw\tV 1\tNP 1\nJohn\tNP 1\nwith\tP 1\n'
+			'binoculars\tNP 1\n')
+	grammar = Grammar(rules, lexicon, start='S')
+	grammar.switch('default', logprob=True)
+	sent = 'Mary saw John with binoculars with John'.split()
+	chart1, _ = parse(sent, grammar)
+	chart2, _ = parse(sent, grammar, twopass=True)
+	assert len(chart2.getitems()) < len(chart1.getitems())
+	assert lazykbest(chart1, 100)[0] == lazykbest(chart2, 100)[0]
+	chart1.filter()
+	assert (sorted(chart1.itemstr(a) for a in chart1.getitems()
+				if chart1.hasitem(a))
+			== sorted(chart2.itemstr(a) for a in chart2.getitems()))
+	whitelist, msg = recognize('John with'.split(), grammar)
+	assert whitelist is None and msg.startswith('no parse')
+
+
+def test_kbest():
+	"""k-best derivations are unique, sorted, and agree with rankededges."""
+	from discodop.containers import Grammar
+	from discodop.pcfg import parse
+	from discodop.kbest import KBest, lazykbest, getderiv
+	grammar = Grammar('2\tS\tNP\tVP\n3\tVP\tV\tNP\n1\tVP\tVP\tPP\n'
+			'4\tNP\tNP\tPP\n1\tPP\tP\tNP\n1\tS\tVP\n',
+			'Mary\tNP 1\nsaw\tV 1\tNP 1\nwith\tP 1\n', start='S')
+	chart, _ = parse('Mary saw Mary with Mary with Mary'.split(), grammar)
+	# there are 5 ways to attach the two PPs; ask for more derivations
+	derivations, kbest = lazykbest(chart, 100)
+	probs = [prob for _, prob in derivations]
+	assert len(derivations) == len(kbest) == 5
+	assert len(set(deriv for deriv, _ in derivations)) == 5
+	assert probs == sorted(probs)
+	root = chart.root()
+	assert [(getderiv(root, entry.key, chart, None), entry.value)
+			for entry in chart.rankededges[root]] == derivations
+	# only the items used by the derivations are stored
+	assert set(chart.rankededges) <= set(kbest.getitems())
+	assert KBest(chart, 3).derivations() == derivations[:3]
+
+
+def test_samples():
+	"""Sampled derivations follow the distribution over derivations."""
+	import random
+	from collections import Counter
+	import numpy as np
+	from discodop.containers import Grammar
+	from discodop.pcfg import parse
+	from discodop.kbest import lazykbest
+	from discodop.disambiguation import DerivationSampler
+	grammar = Grammar('2\tS\tNP\tVP\n3\tVP\tV\tNP\n1\tVP\tVP\tPP\n'
+			'4\tNP\tNP\tPP\n1\tPP\tP\tNP\n1\tS\tVP\n',
+			'Mary\tNP 1\nsaw\tV 1\tNP 1\nwith\tP 1\n', start='S')
+	chart, _ = parse('Mary saw Mary with Mary with Mary'.split(), grammar)
+	derivations, _ = lazykbest(chart, 100)
+	numranked = len(chart.rankededges[chart.root()])
+	total = sum(np.exp(-p) for _, p in derivations)
+	random.seed(1)
+	sampler = DerivationSampler(chart)
+	samples = sampler.sample(5000) + sampler.sample(5000)
+	counts = Counter(deriv for deriv, _ in samples)
+	for deriv, prob in derivations:
+		assert abs(np.exp(-prob) / total - counts[deriv] / 10000.0) < 0.02
+	assert all(prob == dict(derivations)[deriv] for deriv, prob in samples)
+	assert len(chart.rankededges[chart.root()]) == numranked + 10000
+	random.seed(1)  # seeding the random module makes samples reproducible
+	assert DerivationSampler(chart).sample(100) == samples[:100]
+
+
+def test_threadedcky():
+	"""Parsing with several threads gives the same chart."""
+	from discodop.containers import Grammar
+	from discodop.pcfg import parse
+	from discodop.kbest import lazykbest
+	rules = ('2\tS\tNP\tVP\n'
+			'3\tVP\tV\tNP\n'
+			'1\tVP\tVP\tPP\n'
+			'4\tNP\tNP\tPP\n'
+			'1\tPP\tP\tNP\n'
+			'1\tS\tVP\n')
+	lexicon = ('Mary\tNP 1\nsaw\tV 1\tNP 1\nJohn\tNP 1\nwith\tP 1\n'
+			'binoculars\tNP 1\n')
+	grammar = Grammar(rules, lexicon, start='S')
+	grammar.switch('default', logprob=True)
+	sent = 'Mary saw John with binoculars with John'.split()
+	for kwargs in ({}, {'twopass': True}, {'beam_beta': 1.0}):
+		chart1, _ = parse(sent, grammar, **kwargs)
+		chart2, _ = parse(sent, grammar, numthreads=3, **kwargs)
+		assert list(chart1.getitems()) == list(chart2.getitems())
+		assert lazykbest(chart1, 50)[0] == lazykbest(chart2, 50)[0]
+
+
+def test_whitelist():
+	"""Compact coarse-to-fine whitelists give the same charts as sets."""
+	import numpy as np
+	from discodop.containers import Grammar, LCFRSWhitelist
+	from discodop.grammar import treebankgrammar
+	from discodop.treebank import NegraCorpusReader
+	from discodop.treetransforms import addfanoutmarkers, splitdiscnodes
+	from discodop.coarsetofine import prunechart, whitelistsets
+	from discodop.kbest import lazykbest
+	from discodop import pcfg, plcfrs
+	grammar = Grammar('2\tS\tNP\tVP\n3\tVP\tV\tNP\n1\tVP\tVP\tPP\n'
+			'4\tNP\tNP\tPP\n1\tPP\tP\tNP\n1\tS\tVP\n',
+			'Mary\tNP 1\nsaw\tV 1\tNP 1\nJohn\tNP 1\nwith\tP 1\n',
+			start='S')
+	sent = 'Mary saw John with John'.split()
+	bitsets, _ = pcfg.recognize(sent, grammar)
+	sets = [{label for label in range(grammar.nonterminals)
+			if int(bitsets[cell, label // 64]) >> (label % 64) & 1}
+			for cell in range(len(bitsets))]
+	assert np.array_equal(
+			pcfg.whitelistbitsets(sets, grammar.nonterminals), bitsets)
+	chart1, _ = pcfg.parse(sent, grammar, whitelist=sets)
+	chart2, _ = pcfg.parse(sent, grammar, whitelist=bitsets)
+	assert list(chart1.getitems()) == list(chart2.getitems())
+	for func in (pcfg.parse, pcfg.recognize):
+		try:  # a whitelist for another sentence length is rejected
+			func(sent[:-1], grammar, whitelist=bitsets)
+		except ValueError:
+			pass
+		else:
+			raise AssertionError('expected ValueError')
+
+	corpus = NegraCorpusReader('alpinosample.export', punct='move')
+	sents = list(corpus.sents().values())
+	trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+			for a in list(corpus.trees().values())]
+	coarse = Grammar(treebankgrammar([binarize(splitdiscnodes(
+			a.copy(True), True), childchar=':', dot=True) for a in trees],
+			sents), start=trees[0].label)
+	fine = Grammar(treebankgrammar(trees, sents), start=trees[0].label)
+	fine.getmapping(coarse, striplabelre=None, neverblockre=None,
+			splitprune=True, markorigin=True)
+	for sent in sents:
+		coarsechart, _ = pcfg.parse(sent, coarse)
+		whitelist, items, _ = prunechart(
+				coarsechart, fine, 10, True, True, False, False)
+		assert isinstance(whitelist, LCFRSWhitelist)
+		assert len(whitelist) == len(items)
+		chart, _ = plcfrs.parse(sent, fine, whitelist=whitelist,
+				splitprune=True, markorigin=True)
+		chart1, _ = plcfrs.parse(sent, fine, whitelist=whitelistsets(
+				coarsechart, fine, items, True, True),
+				splitprune=True, markorigin=True)
+		assert chart and chart1
+		assert ({chart.itemstr(a) for a in chart.getitems()}
+				== {chart1.itemstr(a) for a in chart1.getitems()})
+		assert lazykbest(chart, 10)[0] == lazykbest(chart1, 10)[0]
+		unpruned, _ = plcfrs.parse(sent, fine)
+		assert len(chart.getitems()) < len(unpruned.getitems())
+
+
+def test_siblingindex():
+	"""Looking up siblings by position finds all constituents of the trees
+	the grammar was read off from."""
+	from discodop.grammar import treebankgrammar
+	from discodop.containers import Grammar
+	from discodop.treebank import DiscBracketCorpusReader
+	from discodop.treetransforms import addfanoutmarkers
+	from discodop.plcfrs import parse
+	corpus = DiscBracketCorpusReader('tests/longsent.dbr')
+	sents = list(corpus.sents().values())
+	trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+			for a in corpus.trees().values()]
+	grammar = Grammar(treebankgrammar(trees, sents), start=trees[0].label)
+	for tree, sent in zip(trees, sents):
+		chart, msg = parse(sent, grammar, exhaustive=True)
+		assert chart, msg
+		items = {(chart.itemstr(item).split('[')[0],
+				tuple(chart.indices(item))) for item in chart.getitems()}
+		for node in tree.subtrees():
+			assert (node.label, tuple(sorted(node.leaves()))) in items
+
+
+def test_packedchart():
+	"""An array-backed chart contains the same items and derivations."""
+	from discodop.grammar import dopreduction
+	from discodop.containers import Grammar
+	from discodop.treebank import NegraCorpusReader
+	from discodop.treetransforms import addfanoutmarkers
+	from discodop.plcfrs import parse, PackedLCFRSChart
+	from discodop.kbest import lazykbest
+	corpus = NegraCorpusReader('alpinosample.export', punct='move')
+	sents = list(corpus.sents().values())
+	trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+			for a in corpus.trees().values()]
+	grammar = Grammar(dopreduction(trees, sents)[0], start=trees[0].label)
+	for sent in sents:
+		for exhaustive in (True, False):
+			chart1, msg1 = parse(sent, grammar, exhaustive=exhaustive)
+			chart2, msg2 = parse(sent, grammar, exhaustive=exhaustive,
+					packed=True)
+			assert isinstance(chart2, PackedLCFRSChart)
+			assert msg1 == msg2
+			assert ({chart1.itemstr(a) for a in chart1.getitems()}
+					== {chart2.itemstr(a) for a in chart2.getitems()})
+			assert ([a for a, _ in lazykbest(chart1, 10)[0]]
+					== [a for a, _ in lazykbest(chart2, 10)[0]])
+			# the radix agenda breaks ties differently
+			chart3, _ = parse(sent, grammar, exhaustive=exhaustive,
+					packed=True, radix=True)
+			assert ({chart1.itemstr(a) for a in chart1.getitems()}
+					== {chart3.itemstr(a) for a in chart3.getitems()})
+			assert ([round(a, 8) for _, a in lazykbest(chart1, 10)[0]]
+					== [round(a, 8) for _, a in lazykbest(chart3, 10)[0]])
+		# both charts prune the same items with a beam
+		chart1, msg1 = parse(sent, grammar, beam_beta=2.0, beam_delta=40)
+		chart2, msg2 = parse(sent, grammar, beam_beta=2.0, beam_delta=40,
+				packed=True)
+		assert 'blocked 0' not in msg1
+		assert msg1 == msg2
+		assert ({chart1.itemstr(a) for a in chart1.getitems()}
+				== {chart2.itemstr(a) for a in chart2.getitems()})
+		assert ([a for a, _ in lazykbest(chart1, 10)[0]]
+				== [a for a, _ in lazykbest(chart2, 10)[0]])
+
+
+def test_parseserver(tmpdir):
+	"""Send a single and a batch request to a parse server."""
+	import json
+	import socket
+	import threading
+	from discodop.parser import parseserver
+	parser, sents = simpleparser()
+	address = str(tmpdir.join('parser.sock'))
+	server = parseserver(parser, address)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.start()
+	try:
+		conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		conn.connect(address)
+		conn.sendall(b'{"id": "a", "sent": "%s"}\nnot json\n'
+				b'{"id": 2, "sents": [%s]}\n' % (
+				' '.join(sents[0]).encode('utf8'),
+				','.join(json.dumps(sent) for sent in sents[1:3]
+					).encode('utf8')))
+		conn.shutdown(socket.SHUT_WR)
+		responses = [json.loads(line.decode('utf8'))
+				for line in conn.makefile('rb')]
+		conn.close()
+	finally:
+		server.shutdown()
+		server.server_close()
+		thread.join()
+	assert [a['id'] for a in responses] == ['a', None, 2]
+	assert not responses[0]['noparse']
+	assert responses[0]['tree'].startswith('(ROOT')
+	assert 'error' in responses[1]
+	assert len(responses[2]['results']) == 2
+	assert not os.path.exists(address)
+
+
 def test_optimalbinarize():
 	"""Verify that all optimal parsing complexities are lower than or
 	equal to the complexities of right-to-left binarizations."""
@@ -1241,7 +1241,7 @@ APP.wsgi_app = QueryStringRedirectMiddleware(APP.wsgi_app)
 fragments.PARAMS.update(quiet=True, debug=False, disc=False, complete=False,
 		cover=False, quadratic=False, complement=False, adjacent=False,
 		twoterms=False, nofreq=False, approx=True, indices=False,
-		fmt='bracket')
+		minprods=1, fmt='bracket')
 
 # this is redundant but used to support both javascript-enabled /foo
 # as well as non-javascript fallback /?output=foo